@@ -4,6 +4,7 @@ from rpython.rlib import rsignal
 from rpython.rlib.rstring import (
     ParseStringError, ParseStringOverflowError)
 from pydrofoil import mem as mem_mod
+from pydrofoil import imagefile
 from pydrofoil.supportcode import *
 from pydrofoil.supportcode import Globals as BaseGlobals
 
@@ -314,11 +315,11 @@ def load_raw(machine, offsets, filenames):
         load_raw_single(machine, offset, fn)
 
 def load_raw_single(machine, offset, fn):
-    f = open(fn, 'rb')
+    # the file can be gzip or zlib compressed, it is decompressed while it is
+    # loaded
+    f = imagefile.open_image(fn)
     try:
-        content = f.read()
-        for i, byte in enumerate(content):
-            machine.g.mem.write(offset + i, 1, r_uint(ord(byte)))
+        imagefile.load_raw(machine.g.mem, offset, f)
     finally:
         f.close()
 
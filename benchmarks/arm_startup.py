@@ -0,0 +1,77 @@
+""" Measure the startup latency of pydrofoil-arm, i.e. how long loading the
+raw images given with -b takes before the first instruction executes.
+
+Without arguments the raw image loading is measured untranslated, comparing
+the old byte-by-byte loader with imagefile.load_raw, which writes whole words
+straight into the blocks of the block memory. Only relative numbers are
+meaningful then. If the path to a built pydrofoil-arm binary is given, the
+time to the first instruction is measured by running it with an instruction
+limit of 1.
+
+Usage: python benchmarks/arm_startup.py [path/to/pydrofoil-arm]
+"""
+
+import sys
+import os
+import time
+import subprocess
+
+from rpython.rlib.rarithmetic import r_uint
+
+from pydrofoil import imagefile
+from pydrofoil import mem as mem_mod
+
+IMAGES = [
+    (0x80000000, "arm/bootloader.bin"),
+    (0x81000000, "arm/sail.dtb"),
+    (0x82080000, "arm/Image"),
+]
+
+def bytewise_load_raw(mem, start_addr, image_file):
+    data = image_file.read(1 << 30)
+    for i in range(len(data)):
+        mem.write(start_addr + i, 1, r_uint(ord(data[i])))
+    return len(data)
+
+def load_images(loader):
+    mem = mem_mod.BlockMemory()
+    num_bytes = 0
+    t1 = time.time()
+    for offset, fn in IMAGES:
+        f = imagefile.open_image(fn)
+        try:
+            num_bytes += loader(mem, r_uint(offset), f)
+        finally:
+            f.close()
+    t2 = time.time()
+    return num_bytes, t2 - t1
+
+def time_to_first_instruction(binary):
+    cmd = [binary]
+    for offset, fn in IMAGES:
+        cmd += ["-b", "0x%x,%s" % (offset, fn)]
+    cmd += ["-C", "cpu.cpu0.RVBAR=0x80000000", "-C", "cpu.has_tlb=0x0",
+            "-l", "1"]
+    with open(os.devnull, "w") as devnull:
+        t1 = time.time()
+        status = subprocess.call(cmd, stdout=devnull, stderr=devnull)
+        t2 = time.time()
+    return status, t2 - t1
+
+def main():
+    if len(sys.argv) > 1:
+        status, duration = time_to_first_instruction(sys.argv[1])
+        line = "time to first instruction: %.3f s" % duration
+        if status != 0:
+            line += "  (exit status %d)" % status
+        print line
+        return
+    print "%-12s %12s %10s %12s" % ("loader", "bytes", "time (s)", "MB/s")
+    for name, loader in [("bytewise", bytewise_load_raw),
+                         ("load_raw", imagefile.load_raw)]:
+        num_bytes, duration = load_images(loader)
+        print "%-12s %12d %10.3f %12.2f" % (
+            name, num_bytes, duration, num_bytes / duration / 1e6)
+
+if __name__ == '__main__':
+    main()
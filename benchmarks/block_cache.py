@@ -0,0 +1,68 @@
+""" Microbenchmark for the block cache of BlockMemory. Chases pointers through
+a linked list whose nodes are spread over several blocks, while also writing
+to a "stack" and a "memcpy destination" in other blocks, and compares a cache
+with a single entry with the default direct-mapped cache. Runs untranslated,
+so only relative numbers (and the hit rates) are meaningful.
+
+Usage: python benchmarks/block_cache.py [iterations]
+"""
+
+import sys
+import time
+import random
+
+from rpython.rlib.rarithmetic import r_uint
+
+from pydrofoil import mem as mem_mod
+
+NUM_NODES = 4096
+# the nodes of the list are spread over this many blocks
+NUM_BLOCKS = 12
+STACK = r_uint(0x7ff00000)
+MEMCPY_DEST = r_uint(0x40000000)
+
+class SingleEntryBlockMemory(mem_mod.BlockMemory):
+    BLOCK_CACHE_SIZE = 1
+
+def build_list(mem):
+    rng = random.Random(42)
+    nodes = [r_uint(rng.randrange(NUM_BLOCKS) * mem.BLOCK_SIZE +
+                    rng.randrange(mem.BLOCK_SIZE // 16) * 16)
+             for i in range(NUM_NODES)]
+    nodes = sorted(set(nodes))
+    rng.shuffle(nodes)
+    for i in range(len(nodes)):
+        mem.write(nodes[i], 8, nodes[(i + 1) % len(nodes)])
+        mem.write(nodes[i] + 8, 8, r_uint(i))
+    return nodes[0]
+
+def chase(mem, head, iterations):
+    t1 = time.time()
+    for i in range(iterations):
+        node = head
+        offset = r_uint(0)
+        while True:
+            value = mem.read(node + 8, 8)
+            mem.write(STACK + (offset & 0xff) * 8, 8, node)
+            mem.write(MEMCPY_DEST + offset * 8, 8, value)
+            offset += 1
+            node = mem.read(node, 8)
+            if node == head:
+                break
+    return time.time() - t1
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    print "%-8s %10s %10s %10s" % ("entries", "time", "lookups", "hit rate")
+    for memcls in [SingleEntryBlockMemory, mem_mod.BlockMemory]:
+        mem = memcls()
+        head = build_list(mem)
+        mem.set_block_cache_stats(True)
+        duration = chase(mem, head, iterations)
+        lookups, misses = mem.block_cache_stats()
+        print "%-8d %9.3fs %10d %9.1f%%" % (
+            memcls.BLOCK_CACHE_SIZE, duration, lookups,
+            100.0 * (lookups - misses) / lookups)
+
+if __name__ == '__main__':
+    main()
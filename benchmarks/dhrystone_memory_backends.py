@@ -0,0 +1,38 @@
+""" Compare the performance of pydrofoil-riscv running Dhrystone with the flat
+and the block memory backends.
+
+Usage: python benchmarks/dhrystone_memory_backends.py [path/to/pydrofoil-riscv] [runs]
+"""
+
+import sys
+import subprocess
+
+DHRYSTONE = "riscv/input/dhrystone.riscv"
+
+BACKENDS = [
+    ("flat", []),
+    ("block", ["--block-memory"]),
+]
+
+def run(binary, options):
+    cmd = [binary] + options + [DHRYSTONE]
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                         close_fds=True)
+    stdout, stderr = p.communicate()
+    if p.returncode != 0:
+        raise ValueError("%s failed:\n%s%s" % (" ".join(cmd), stdout, stderr))
+    for line in stdout.splitlines():
+        if line.startswith("Perf: "):
+            return float(line.split()[1])
+    raise ValueError("no performance output from %s" % (" ".join(cmd), ))
+
+def main():
+    binary = sys.argv[1] if len(sys.argv) > 1 else "./pydrofoil-riscv"
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    print "%-8s %12s %12s" % ("backend", "best Kips", "mean Kips")
+    for name, options in BACKENDS:
+        results = [run(binary, options) for i in range(runs)]
+        print "%-8s %12.1f %12.1f" % (name, max(results), sum(results) / len(results))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+""" Measure how long loading an ELF file into guest memory takes, i.e. the
+part of the time to the first instruction that the ELF loader is responsible
+for. Compares the old byte-by-byte loader with elf_read_process_image, which
+is where all of the gain comes from (13-15x on dhrystone). It also compares
+loading the segments and the symbols in two passes (as load_sail used to do)
+with elf_load. For a plain file both take the same time (1.0x on dhrystone).
+For a gzip compressed copy, the two passes decompress the file several times,
+but only if it is bigger than imagefile.CHUNK_SIZE (1 MiB); for dhrystone it
+makes no difference either. Runs untranslated, so only relative numbers are
+meaningful. Use a big ELF file (e.g. a Linux kernel with an initramfs) to see
+the difference.
+
+Usage: python benchmarks/elf_loading.py [elf]
+"""
+
+import sys
+import os
+import gzip
+import tempfile
+import time
+
+from rpython.rlib.rarithmetic import r_uint, intmask
+
+from pydrofoil import elf
+from pydrofoil import imagefile
+from pydrofoil import mem as mem_mod
+
+def bytewise_read_process_image(mem, file_obj):
+    ehdr, is_64bit = elf.read_header(file_obj)
+    for program_index in range(ehdr.phnum):
+        file_obj.seek(intmask(ehdr.phoff) + program_index * ehdr.phentsize)
+        phdr = elf.ElfProgramHeader(file_obj.read(ehdr.phentsize), is_64bit)
+        if phdr.type != elf.ElfProgramHeader.PT_LOAD:
+            continue
+        file_obj.seek(intmask(phdr.offset))
+        content = file_obj.read(intmask(phdr.filesz))
+        start_addr = r_uint(phdr.paddr)
+        for i in range(phdr.filesz):
+            mem.write(start_addr + i, 1, r_uint(0xff & ord(content[i])))
+        for i in range(phdr.filesz, phdr.memsz):
+            mem.write(start_addr + i, 1, r_uint(0))
+    return ehdr.entry
+
+def two_passes(mem, f):
+    elf.elf_read_process_image(mem, f)
+    elf.elf_reader(f)
+
+def one_pass(mem, f):
+    elf.elf_load(mem, f)
+
+def measure(load, fn, open_file=open):
+    mem = mem_mod.BlockMemory()
+    t1 = time.time()
+    f = open_file(fn)
+    try:
+        load(mem, f)
+    finally:
+        f.close()
+    return time.time() - t1
+
+def open_plain(fn):
+    return open(fn, "rb")
+
+def main():
+    fn = sys.argv[1] if len(sys.argv) > 1 else "riscv/input/dhrystone.riscv"
+    old = measure(bytewise_read_process_image, fn)
+    new = measure(elf.elf_read_process_image, fn)
+    print "%-10s %10s" % ("loader", "time")
+    print "%-10s %9.3fs" % ("bytewise", old)
+    print "%-10s %9.3fs" % ("wordwise", new)
+    print "speedup: %.1fx" % (old / new, )
+    old = measure(two_passes, fn, open_plain)
+    new = measure(one_pass, fn, open_plain)
+    print "%-10s %9.3fs" % ("2 passes", old)
+    print "%-10s %9.3fs" % ("elf_load", new)
+    print "speedup: %.1fx" % (old / new, )
+    fd, gzfn = tempfile.mkstemp(suffix=".gz")
+    os.close(fd)
+    try:
+        with open(fn, "rb") as f:
+            data = f.read()
+        g = gzip.open(gzfn, "wb")
+        g.write(data)
+        g.close()
+        old = measure(two_passes, gzfn, imagefile.open_image)
+        new = measure(one_pass, gzfn, imagefile.open_image)
+    finally:
+        os.unlink(gzfn)
+    print "compressed:"
+    print "%-10s %9.3fs" % ("2 passes", old)
+    print "%-10s %9.3fs" % ("elf_load", new)
+    print "speedup: %.1fx" % (old / new, )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+""" Measure the peak resident memory and the run time of pydrofoil-riscv for
+different guest RAM sizes.
+
+Usage: python benchmarks/memory_footprint.py [path/to/pydrofoil-riscv] [elf]
+"""
+
+import sys
+import os
+import time
+import subprocess
+
+RAM_SIZES_MB = [64, 1024, 4096]
+
+def run(binary, elf, ram_size_mb):
+    cmd = [binary, "--ram-size", str(ram_size_mb), elf]
+    with open(os.devnull, "w") as devnull:
+        t1 = time.time()
+        p = subprocess.Popen(cmd, stdout=devnull, stderr=devnull, close_fds=True)
+        _, status, rusage = os.wait4(p.pid, 0)
+        t2 = time.time()
+    # ru_maxrss is in KiB on Linux
+    return status, rusage.ru_maxrss / 1024.0, t2 - t1
+
+def main():
+    binary = sys.argv[1] if len(sys.argv) > 1 else "./pydrofoil-riscv"
+    elf = sys.argv[2] if len(sys.argv) > 2 else "riscv/input/rv64ui-p-addi.elf"
+    print "%-12s %14s %10s" % ("ram size", "max rss (MB)", "time (s)")
+    for ram_size_mb in RAM_SIZES_MB:
+        status, rss, duration = run(binary, elf, ram_size_mb)
+        line = "%-12s %14.1f %10.3f" % ("%d MB" % ram_size_mb, rss, duration)
+        if status != 0:
+            line += "  (exit status %d)" % status
+        print line
+
+if __name__ == '__main__':
+    main()
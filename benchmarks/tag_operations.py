@@ -0,0 +1,59 @@
+""" Microbenchmark for the capability tag storage of the tagged memories (as
+used by the CHERIoT emulator). Compares scanning and clearing a range of tags
+bit by bit with the bulk count_tags/clear_tags operations, for the flat and
+the block memory. Runs untranslated, so only relative numbers are meaningful.
+
+Usage: python benchmarks/tag_operations.py [iterations]
+"""
+
+import sys
+import time
+
+from rpython.rlib.rarithmetic import r_uint
+
+from pydrofoil import mem as mem_mod
+
+RANGE_SIZE = 64 * 1024
+
+def bitwise_count(mem, start_addr, num_bytes):
+    count = 0
+    for addr in range(start_addr, start_addr + num_bytes, 8):
+        count += mem.read_tag_bit(r_uint(addr))
+    return count
+
+def bitwise_clear(mem, start_addr, num_bytes):
+    for addr in range(start_addr, start_addr + num_bytes, 8):
+        mem.write_tag_bit(r_uint(addr), False)
+
+def bulk_count(mem, start_addr, num_bytes):
+    return mem.count_tags(r_uint(start_addr), r_uint(num_bytes))
+
+def bulk_clear(mem, start_addr, num_bytes):
+    mem.clear_tags(r_uint(start_addr), r_uint(num_bytes))
+
+def set_tags(mem):
+    for addr in range(0, RANGE_SIZE, 24):
+        mem.write_tag_bit(r_uint(addr), True)
+
+def loop(mem, count, clear, iterations):
+    t1 = time.time()
+    for i in range(iterations):
+        set_tags(mem)
+        count(mem, 0, RANGE_SIZE)
+        clear(mem, 0, RANGE_SIZE)
+        assert count(mem, 0, RANGE_SIZE) == 0
+    return time.time() - t1
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    memories = [("flat", mem_mod.TaggedFlatMemory(False, 1024 * 1024)),
+                ("block", mem_mod.TaggedBlockMemory())]
+    print "%-6s %12s %12s %8s" % ("memory", "bitwise", "bulk", "speedup")
+    for name, mem in memories:
+        old = loop(mem, bitwise_count, bitwise_clear, iterations)
+        new = loop(mem, bulk_count, bulk_clear, iterations)
+        # the time for setting the tags is part of both numbers
+        print "%-6s %11.3fs %11.3fs %7.1fx" % (name, old, new, old / new)
+
+if __name__ == '__main__':
+    main()
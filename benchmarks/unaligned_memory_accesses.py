@@ -0,0 +1,58 @@
+""" Microbenchmark for misaligned guest memory accesses (as they happen for
+packed structs with --enable-misaligned). Loops over a buffer with reads and
+writes at every byte offset, for the flat and the block memory, and compares
+with the old byte-by-byte implementation. Runs untranslated, so only relative
+numbers are meaningful.
+
+Usage: python benchmarks/unaligned_memory_accesses.py [iterations]
+"""
+
+import sys
+import time
+
+from rpython.rlib.rarithmetic import r_uint
+
+from pydrofoil import mem as mem_mod
+
+BUFFER_SIZE = 4096
+
+def bytewise_read(mem, start_addr, num_bytes):
+    value = r_uint(0)
+    for i in range(num_bytes - 1, -1, -1):
+        value = (value << 8) | mem._aligned_read(start_addr + i, 1, False)
+    return value
+
+def bytewise_write(mem, start_addr, num_bytes, value):
+    for i in range(num_bytes):
+        mem._aligned_write(start_addr + i, 1, value & 0xff)
+        value >>= 8
+
+def wordwise_read(mem, start_addr, num_bytes):
+    return mem._unaligned_read(start_addr, num_bytes)
+
+def wordwise_write(mem, start_addr, num_bytes, value):
+    mem._unaligned_write(start_addr, num_bytes, value)
+
+def loop(mem, read, write, num_bytes, iterations):
+    t1 = time.time()
+    for i in range(iterations):
+        addr = r_uint(1)
+        while addr + num_bytes < BUFFER_SIZE:
+            value = read(mem, addr, num_bytes)
+            write(mem, addr, num_bytes, value ^ 1)
+            addr += num_bytes + 1
+    return time.time() - t1
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    memories = [("flat", mem_mod.FlatMemory(False, 1024 * 1024)),
+                ("block", mem_mod.BlockMemory())]
+    print "%-6s %6s %12s %12s %8s" % ("memory", "bytes", "bytewise", "wordwise", "speedup")
+    for name, mem in memories:
+        for num_bytes in [2, 4, 8]:
+            old = loop(mem, bytewise_read, bytewise_write, num_bytes, iterations)
+            new = loop(mem, wordwise_read, wordwise_write, num_bytes, iterations)
+            print "%-6s %6d %11.3fs %11.3fs %7.1fx" % (name, num_bytes, old, new, old / new)
+
+if __name__ == '__main__':
+    main()
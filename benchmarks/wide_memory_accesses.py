@@ -0,0 +1,58 @@
+""" Microbenchmark for guest memory accesses that are wider than 8 bytes (or
+not a power of two), which go through _platform_read_mem_slowpath and
+_platform_write_mem_slowpath. The byte-by-byte implementation is kept here for
+comparison. Runs untranslated, so only relative numbers are meaningful.
+
+Usage: python benchmarks/wide_memory_accesses.py [iterations]
+"""
+
+import sys
+import time
+
+from rpython.rlib.rarithmetic import r_uint
+from rpython.rlib.rbigint import rbigint
+
+from pydrofoil import bitvector, mem as mem_mod
+from pydrofoil.supportcode import (_platform_read_mem_slowpath,
+        _platform_write_mem_slowpath)
+
+WIDTHS = [3, 16, 32, 64, 128, 256]
+
+def bytewise_read(machine, mem, read_kind, addr, n):
+    value = None
+    for i in range(n - 1, -1, -1):
+        nextbyte = bitvector.SmallBitVector(8, mem.read(addr + i, 1))
+        if value is None:
+            value = nextbyte
+        else:
+            value = value.append(nextbyte)
+    return value
+
+def bytewise_write(machine, mem, write_kind, addr, n, data):
+    for i in range(n):
+        mem.write(addr + i, 1, data.subrange_unwrapped_res(i * 8 + 7, i * 8))
+
+def bench(func, args, iterations):
+    t1 = time.time()
+    for i in range(iterations):
+        func(*args)
+    return (time.time() - t1) / iterations * 1e6
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    mem = mem_mod.FlatMemory(False, 1024 * 1024)
+    addr = r_uint(0x1000)
+    print "%6s %14s %14s %14s %14s" % ("bytes", "read bytewise", "read wordwise",
+                                       "write bytewise", "write wordwise")
+    for n in WIDTHS:
+        data = bitvector.from_bigint(n * 8, rbigint.fromlong((1 << (n * 8)) - 12345))
+        results = [
+            bench(bytewise_read, (None, mem, None, addr, n), iterations),
+            bench(_platform_read_mem_slowpath, (None, mem, None, addr, n), iterations),
+            bench(bytewise_write, (None, mem, None, addr, n, data), iterations),
+            bench(_platform_write_mem_slowpath, (None, mem, None, addr, n, data), iterations),
+        ]
+        print "%6d %12.1fus %12.1fus %12.1fus %12.1fus" % tuple([n] + results)
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,9 @@ import os
 from pydrofoil.supportcode import *
 from pydrofoil.bitvector import Integer
 from pydrofoil import elf
+from pydrofoil import imagefile
 from pydrofoil import mem as mem_mod
+from pydrofoil import console
 
 from rpython.rlib.nonconst import NonConstant
 from rpython.rlib.objectmodel import we_are_translated, always_inline, specialize
@@ -98,12 +100,15 @@ class Globals(object):
 
         self.dtb = None
 
-        self.term_fd = 1
+        # where the output of the guest goes
+        self.console = console.ConsoleOutput(1)
 
         self.reservation = r_uint(0)
         self.reservation_valid = False
 
         self.dump_dict = {}
+        # the symbols of the loaded ELF file, to annotate addresses
+        self.symbol_index = None
 
         self.config_print_instr = True
         self.config_print_reg = True
@@ -250,8 +255,7 @@ def cancel_reservation(machine, _):
     return ()
 
 def plat_term_write(machine, s):
-    import os
-    os.write(machine.g.term_fd, chr(s & 0xff))
+    machine.g.console.write_char(chr(s & 0xff))
     return ()
 
 def plat_insns_per_tick(machine, _):
@@ -321,6 +325,7 @@ Usage: %s [options] <elf_file>
 
 Run the CHERIoT emulator on elf_file.
 
+--console-output <file>         write the output of the guest to file instead of the terminal
 --help                          print this information and exit
 """
 
@@ -403,6 +408,7 @@ def _main(argv, *machineclasses):
     disable_vext = parse_flag(argv, "--disable-vext")
 
     verbose = parse_flag(argv, "--verbose")
+    console_output = parse_args(argv, "--console-output")
 
     print_kips = parse_flag(argv, "--print-kips")
 
@@ -425,6 +431,11 @@ def _main(argv, *machineclasses):
     #init_logs()
 
     machine = machinecls()
+    if console_output:
+        machine.g.console = console.open_console_output(console_output)
+    elif verbose:
+        # keep the output of the guest in order with the trace
+        machine.g.console = console.ConsoleOutput(1, buffer_size=1)
     if blob:
         if check_file_missing(blob):
             return -1
@@ -460,10 +471,15 @@ def _main(argv, *machineclasses):
     if we_are_translated():
         rsignal.pypysig_setflag(rsignal.SIGINT)
 
-    for i in range(iterations):
-        machine.run_sail(limit, print_kips)
-        if i:
-            init_sail(machine, entry)
+    try:
+        for i in range(iterations):
+            machine.run_sail(limit, print_kips)
+            if i:
+                init_sail(machine, entry)
+    finally:
+        # the end of the output of the guest is the most interesting part
+        # after a crash, write it out on every way out
+        machine.g.console.close()
     #flush_logs()
     #close_logs()
     return 0
@@ -475,15 +491,19 @@ def load_sail(machine, fn):
     oldmem = g.mem
     if oldmem:
         oldmem.close()
-    mem = mem_mod.TaggedFlatMemory(size=g.rv_ram_size, base_addr=g.rv_ram_base)
+    mem = mem_mod.TaggedFlatMemory(mmap=True, size=g.rv_ram_size, base_addr=g.rv_ram_base)
     #mem = mem_mod.TaggedBlockMemory()
     g.mem = mem
-    with open(fn, "rb") as f:
-        entrypoint = elf.elf_read_process_image(mem, f) # load process image
-    with open(fn, "rb") as f:
-        img = elf.elf_reader(f) # for the symbols
+    # the ELF file can be gzip or zlib compressed
+    f = imagefile.open_image(fn)
+    try:
+        # load process image and symbols
+        entrypoint, img = elf.elf_load(mem, f)
+    finally:
+        f.close()
 
     g.rv_htif_tohost = r_uint(img.get_symbol('tohost'))
+    g.symbol_index = img.get_symbol_index()
     print "tohost located at 0x%x" % g.rv_htif_tohost
 
     print "ELF Entry @ 0x%x" % entrypoint
@@ -560,6 +580,16 @@ def patch_checked_mem_function(outriscv, name):
         setattr(outriscv, name, patched)
 
 
+def symbol_suffix(g, pc):
+    """ Return " <symbol+0xoffset>" for pc, if it belongs to a symbol of the
+    loaded ELF file. """
+    if g.symbol_index is None:
+        return ''
+    location = g.symbol_index.format_address(pc)
+    if not location:
+        return ''
+    return " <%s>" % (location, )
+
 def get_main(outriscv):
     if "g" not in RegistersBase._immutable_fields_:
         RegistersBase._immutable_fields_.append("g")
@@ -572,7 +602,7 @@ def get_main(outriscv):
         capstring = outriscv.func_zcapToString(None, outriscv.func_zcapBitsToCapability(None, True, pcc_bits))
         if g.dump_dict and pc in g.dump_dict:
             return "%s %s: %s" % (prefix, capstring, g.dump_dict[pc])
-        return capstring
+        return capstring + symbol_suffix(g, pc)
 
     driver = JitDriver(
         get_printable_location=get_printable_location,
@@ -645,6 +675,7 @@ def get_main(outriscv):
                         insn_cnt = 0
                         self.tick_clock()
                         self.tick_platform()
+                        g.console.tick()
                     else:
                         assert do_show_times and (step_no & 0xfffff) == 0
                         curr = time.time()
@@ -662,6 +693,7 @@ def get_main(outriscv):
                 prev_pc = self._reg_zPC
                 stepped = self.step(Integer.fromint(step_no))
                 if self.have_exception:
+                    g.console.flush()
                     print "ended with exception!"
                     print self.current_exception
                     print "from", self.throw_location
@@ -694,6 +726,7 @@ def get_main(outriscv):
 
             # loop end
 
+            g.console.flush()
             interval_end = time.time()
             p = rsignal.pypysig_getaddr_occurred()
             ctrlc = False
@@ -0,0 +1,124 @@
+# The console of the emulated machines. The guest writes its output one
+# character at a time, collecting the characters in a buffer and writing them
+# with a single syscall saves a lot of time for guests that print a lot.
+# Input is read without blocking, so the emulator can poll for it while the
+# guest keeps running.
+
+import os
+import stat
+
+from rpython.rlib import rpoll
+from rpython.rlib.rstring import StringBuilder
+
+# flush the output buffer once it contains this many characters
+OUTPUT_BUFFER_SIZE = 4096
+
+# read this many characters of input at once
+INPUT_CHUNK_SIZE = 4096
+# a terminal or pipe is only polled for new input every this many calls to
+# ConsoleInput.read_char, polling needs a syscall
+INPUT_POLL_INTERVAL = 16
+
+
+class ConsoleOutput(object):
+    """ Buffered output to the file descriptor fd. If interactive is True
+    (e.g. for a terminal), the buffer is also flushed after every newline and
+    whenever the emulator ticks the clock, so that the output of the guest
+    shows up in a timely manner. Otherwise (e.g. for a log file), it is only
+    written when the buffer is full and when the emulator exits. """
+
+    def __init__(self, fd, interactive=True, buffer_size=OUTPUT_BUFFER_SIZE):
+        self.fd = fd
+        self.interactive = interactive
+        self.buffer_size = buffer_size
+        self.buffer = StringBuilder()
+
+    def write_char(self, c):
+        self.buffer.append(c)
+        if ((self.interactive and c == '\n') or
+                self.buffer.getlength() >= self.buffer_size):
+            self.flush()
+
+    def tick(self):
+        """ Called by the emulator when it ticks the clock. """
+        if self.interactive and self.buffer.getlength():
+            self.flush()
+
+    def flush(self):
+        if not self.buffer.getlength():
+            return
+        data = self.buffer.build()
+        self.buffer = StringBuilder()
+        while data:
+            written = os.write(self.fd, data)
+            assert written >= 0
+            data = data[written:]
+
+    def close(self):
+        self.flush()
+        if self.fd > 2:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def open_console_output(fn):
+    """ Return a ConsoleOutput that writes the output of the guest to the file
+    fn, replacing its content. """
+    fd = os.open(fn, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+    return ConsoleOutput(fd, interactive=False)
+
+
+class ConsoleInput(object):
+    """ Input for the console of the guest, read from the file descriptor fd
+    without ever blocking the emulator. fd can be a terminal or pipe, or a
+    file with scripted input, which is then fed to the guest character by
+    character as fast as the guest consumes it. """
+
+    def __init__(self, fd):
+        self.fd = fd
+        # regular files are always readable, only poll other fds
+        self.needs_poll = not stat.S_ISREG(os.fstat(fd).st_mode)
+        self.poll_countdown = 0
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def read_char(self):
+        """ Return the next input character as an int, or -1 if there is no
+        input available right now. """
+        if self.pos == len(self.buffer) and not self._fill():
+            return -1
+        c = ord(self.buffer[self.pos])
+        self.pos += 1
+        return c
+
+    def _fill(self):
+        if self.eof:
+            return False
+        if self.needs_poll:
+            if self.poll_countdown > 0:
+                self.poll_countdown -= 1
+                return False
+            self.poll_countdown = INPUT_POLL_INTERVAL
+            if not rpoll.poll({self.fd: rpoll.POLLIN}, 0):
+                return False
+        data = os.read(self.fd, INPUT_CHUNK_SIZE)
+        if not data:
+            self.eof = True
+            return False
+        self.buffer = data
+        self.pos = 0
+        return True
+
+    def close(self):
+        if self.fd > 2:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def open_console_input(fn):
+    """ Return a ConsoleInput that reads the input of the guest from the file
+    fn, or from stdin if fn is "-". """
+    if fn == "-":
+        return ConsoleInput(0)
+    return ConsoleInput(os.open(fn, os.O_RDONLY, 0))
@@ -30,6 +30,9 @@ import struct
 from rpython.rlib.rstruct.runpack import runpack
 from rpython.rlib.rarithmetic import intmask, r_uint
 from rpython.rlib import objectmodel
+from rpython.rlib.listsort import make_timsort_class
+
+from pydrofoil import imagefile
 
 import binascii
 
@@ -39,6 +42,20 @@ def unpack(fmt, data):
         return runpack(fmt, data)
     return struct.unpack(fmt, data)
 
+@objectmodel.specialize.memo()
+def calcsize(fmt):
+    return struct.calcsize(fmt)
+
+@objectmodel.specialize.arg(0)
+def unpack_from(fmt, data, offset):
+    """ Unpack the struct at offset in data, without making a copy of data
+    when running untranslated. """
+    if objectmodel.we_are_translated():
+        size = calcsize(fmt)
+        assert offset >= 0
+        return runpack(fmt, data[offset:offset + size])
+    return struct.unpack_from(fmt, data, offset)
+
 class SparseMemoryImage(object):
     class Section(object):
         def __init__(self, name="", addr=0x00000000, data=bytearray()):
@@ -61,6 +78,9 @@ class SparseMemoryImage(object):
     def __init__(self):
         self.sections = []
         self.symbols = {}
+        # (addr, size, name) for every symbol, in the order of the symbol
+        # table
+        self.symbol_entries = []
 
     def add_section(self, section, addr=None, data=None):
         if isinstance(section, SparseMemoryImage.Section):
@@ -89,8 +109,13 @@ class SparseMemoryImage(object):
             )
             idx += 1
 
-    def add_symbol(self, symbol_name, symbol_addr):
+    def add_symbol(self, symbol_name, symbol_addr, symbol_size=0):
         self.symbols[symbol_name] = symbol_addr
+        self.symbol_entries.append(
+            (r_uint(symbol_addr), r_uint(symbol_size), symbol_name))
+
+    def get_symbol_index(self):
+        return SymbolIndex(self.symbol_entries)
 
     def get_symbol(self, symbol_name):
         return self.symbols[symbol_name]
@@ -106,6 +131,71 @@ class SparseMemoryImage(object):
             print(" {:0>8x} {}".format(value, key))
 
 
+# sort by address, symbols with a size before those without one (labels)
+# at the same address
+def _symbol_lt(a, b):
+    return a[0] < b[0] or (a[0] == b[0] and a[1] > b[1])
+
+SymbolSort = make_timsort_class(lt=_symbol_lt)
+
+class SymbolIndex(object):
+    """ The symbols of an ELF file, sorted by address, to find the symbol
+    (usually a function) that an address belongs to. """
+
+    def __init__(self, entries):
+        entries = entries[:]
+        SymbolSort(entries).sort()
+        self.addrs = []
+        self.sizes = []
+        self.names = []
+        for addr, size, name in entries:
+            # keep only the first symbol per address
+            if self.addrs and self.addrs[-1] == addr:
+                continue
+            self.addrs.append(addr)
+            self.sizes.append(size)
+            self.names.append(name)
+
+    def __len__(self):
+        return len(self.addrs)
+
+    def find(self, addr):
+        """ Return the index of the symbol that contains addr, or -1. A
+        symbol without a size extends up to the next symbol. """
+        low = 0
+        high = len(self.addrs)
+        # find the last symbol that starts at or before addr
+        while low < high:
+            middle = (low + high) >> 1
+            if self.addrs[middle] <= addr:
+                low = middle + 1
+            else:
+                high = middle
+        index = low - 1
+        if index < 0:
+            return -1
+        size = self.sizes[index]
+        if size and addr - self.addrs[index] >= size:
+            return -1
+        return index
+
+    def lookup(self, addr):
+        """ Return the name of the symbol containing addr and the offset of
+        addr in it. The name is empty if there is no such symbol. """
+        index = self.find(addr)
+        if index < 0:
+            return "", r_uint(0)
+        return self.names[index], addr - self.addrs[index]
+
+    def format_address(self, addr):
+        """ Return "symbol+0xoffset" for addr, or "" if it doesn't belong to
+        a symbol. """
+        name, offset = self.lookup(addr)
+        if not name or not offset:
+            return name
+        return "%s+0x%x" % (name, offset)
+
+
 # -------------------------------------------------------------------------
 # ELF File Format Types
 # -------------------------------------------------------------------------
@@ -670,66 +760,100 @@ def read_header(file_obj):
     ehdr = ElfHeader(ehdr_data, is_64bit=is_64bit)
     return ehdr, is_64bit
 
+def read_section_headers(file_obj, ehdr, is_64bit):
+    # read the whole section header table at once
+    file_obj.seek(intmask(ehdr.shoff))
+    shdrs_data = file_obj.read(ehdr.shnum * ehdr.shentsize)
+    shdr_nbytes = ElfSectionHeader.NBYTES64 if is_64bit else ElfSectionHeader.NBYTES
+    shdrs = []
+    for section_idx in range(ehdr.shnum):
+        start = section_idx * ehdr.shentsize
+        shdr_data = shdrs_data[start: start + ehdr.shentsize]
+        # Pad the returned string in case the section header is not long
+        # enough (otherwise the unpack function would not work)
+        fill = "\0" * (shdr_nbytes - len(shdr_data))
+        shdrs.append(ElfSectionHeader(shdr_data + fill, is_64bit=is_64bit))
+    return shdrs
+
+def read_section_data(file_obj, shdr):
+    file_obj.seek(intmask(shdr.offset))
+    return file_obj.read(intmask(shdr.size))
+
+def _find_name(strtab_data, start):
+    assert start >= 0
+    end = strtab_data.find('\0', start)
+    assert end >= 0
+    return strtab_data[start:end]
+
+def read_symbols(symtab_data, strtab_data, is_64bit, mem_image):
+    # the symbol table entries are unpacked directly from the section data,
+    # without making an ElfSymTabEntry (or a copy of the entry) for each
+    if is_64bit:
+        symtabentry_nbytes = ElfSymTabEntry.NBYTES64
+    else:
+        symtabentry_nbytes = ElfSymTabEntry.NBYTES
+    num_symbols = len(symtab_data) // symtabentry_nbytes
+    # We skip the first symbol since it both "designates the first entry in
+    # the table and serves as the undefined symbol index".
+    for sym_idx in xrange(1, num_symbols):
+        start = sym_idx * symtabentry_nbytes
+        if is_64bit:
+            sym_list = unpack_from(ElfSymTabEntry.FORMAT64, symtab_data, start)
+            name = sym_list[0]
+            info = sym_list[1]
+            value = r_uint(sym_list[4])
+            size = r_uint(sym_list[5])
+        else:
+            sym_list = unpack_from(ElfSymTabEntry.FORMAT, symtab_data, start)
+            name = sym_list[0]
+            info = sym_list[3]
+            value = r_uint(sym_list[1])
+            size = r_uint(sym_list[2])
+        # Check to see if symbol is one of the three types we want to load
+        sym_type = info & 0xf
+        if (sym_type != ElfSymTabEntry.TYPE_NOTYPE and
+                sym_type != ElfSymTabEntry.TYPE_OBJECT and
+                sym_type != ElfSymTabEntry.TYPE_FUNC):
+            continue
+        # Add symbol to the sparse memory image
+        mem_image.add_symbol(_find_name(strtab_data, name), value, size)
+
+def read_symbol_table(file_obj, ehdr, is_64bit, shdrs, mem_image):
+    for shdr in shdrs:
+        if shdr.type != ElfSectionHeader.TYPE_SYMTAB:
+            continue
+        symtab_data = read_section_data(file_obj, shdr)
+        # the string table of the symbol names is given by the link field
+        strtab_data = read_section_data(file_obj, shdrs[shdr.link])
+        read_symbols(symtab_data, strtab_data, is_64bit, mem_image)
+        return True
+    return False
+
 def elf_reader(file_obj):
     # Opens and parses an ELF file into a sparse memory image object.
     ehdr, is_64bit = read_header(file_obj)
+    shdrs = read_section_headers(file_obj, ehdr, is_64bit)
 
     # We need to find the section string table so we can figure out the
     # name of each section. We know that the section header for the section
-    # string table is entry shstrndx, so we first get the data for this
-    # section header.
-
-    file_obj.seek(intmask(ehdr.shoff) + ehdr.shstrndx * ehdr.shentsize)
-    shdr_data = file_obj.read(ehdr.shentsize)
-
-    # Construct a section header object for the section string table
+    # string table is entry shstrndx.
 
-    shdr = ElfSectionHeader(shdr_data, is_64bit=is_64bit)
-
-    # Read the data for the section header table
-
-    file_obj.seek(intmask(shdr.offset))
-    shstrtab_data = file_obj.read(intmask(shdr.size))
-
-    # Load sections
-
-    symtab_data = None
-    strtab_data = None
+    shstrtab_data = read_section_data(file_obj, shdrs[ehdr.shstrndx])
 
     mem_image = SparseMemoryImage()
 
-    for section_idx in range(ehdr.shnum):
-
-        # Read the data for the section header
-
-        file_obj.seek(intmask(ehdr.shoff) + section_idx * ehdr.shentsize)
-        shdr_data = file_obj.read(ehdr.shentsize)
-
-        # Pad the returned string in case the section header is not long
-        # enough (otherwise the unpack function would not work)
-
-        # shdr_data = shdr_data.ljust( ElfSectionHeader.NBYTES, '\0' )
-        shdr_nbytes = ElfSectionHeader.NBYTES64 if is_64bit else ElfSectionHeader.NBYTES
-        fill = "\0" * (shdr_nbytes - len(shdr_data))
-        shdr_data = shdr_data + fill
-
-        # Construct a section header object
-
-        shdr = ElfSectionHeader(shdr_data, is_64bit=is_64bit)
-
-        # Find the section name
-
-        idx = shdr.name
-        assert idx >= 0
-        end = shstrtab_data.find('\0', idx)
-        assert end >= 0
-        section_name = shstrtab_data[idx:end]
+    # Load sections
 
-        # Read the section data if it exists
+    for shdr in shdrs:
+        # only sections marked as alloc should be written to memory
+        if (shdr.type == ElfSectionHeader.TYPE_STRTAB or
+                shdr.type == ElfSectionHeader.TYPE_SYMTAB or
+                not shdr.flags & ElfSectionHeader.FLAGS_ALLOC):
+            continue
+        section_name = _find_name(shstrtab_data, shdr.name)
 
         if section_name not in [".sbss", ".bss"]:
-            file_obj.seek(intmask(shdr.offset))
-            data = file_obj.read(intmask(shdr.size))
+            data = read_section_data(file_obj, shdr)
         else:
             # NOTE: the .bss and .sbss sections don't actually contain any
             # data in the ELF.  These sections should be initialized to zero.
@@ -738,79 +862,103 @@ def elf_reader(file_obj):
             # - http://stackoverflow.com/questions/610682/bss-section-in-elf-file
             data = "\0" * shdr.size
 
-        if shdr.type == ElfSectionHeader.TYPE_STRTAB:
-            # Save the data holding the symbol string table
-            if section_idx != ehdr.shstrndx:
-                strtab_data = data
-        elif shdr.type == ElfSectionHeader.TYPE_SYMTAB:
-            # Save the data holding the symbol table
-            symtab_data = data
-        elif shdr.flags & ElfSectionHeader.FLAGS_ALLOC:
-            # Otherwise create section and append it to our list of sections
-            # only sections marked as alloc should be written to memory
-            section = SparseMemoryImage.Section(section_name, shdr.addr, data)
-            mem_image.add_section(section)
+        section = SparseMemoryImage.Section(section_name, shdr.addr, data)
+        mem_image.add_section(section)
 
     # Load symbols
-    assert strtab_data is not None
-    assert symtab_data is not None
-
-    symtabentry_nbytes = ElfSymTabEntry.NBYTES64 if is_64bit else ElfSymTabEntry.NBYTES
-    num_symbols = len(symtab_data) / symtabentry_nbytes
-    valid_sym_types = [
-        ElfSymTabEntry.TYPE_NOTYPE,
-        ElfSymTabEntry.TYPE_OBJECT,
-        ElfSymTabEntry.TYPE_FUNC,
-    ]
-    for sym_idx in xrange(num_symbols):
-        # Read the data for a symbol table entry
-        start = sym_idx * symtabentry_nbytes
-        sym_data = symtab_data[start: start + symtabentry_nbytes]
-        if sym_idx == 0:
-            # We skip the first symbol since it both "designates the first
-            # entry in the table and serves as the undefined symbol index".
-            assert sym_data == b"\x00" * len(sym_data)
-            continue
-
-        # Construct a symbol table entry
-        sym = ElfSymTabEntry(sym_data, is_64bit)
-
-        # Get the symbol type
-        sym_type  = sym.info & 0xf
-
-        # Get the symbol name from the string table
-        start = sym.name
-        assert start >= 0
-        end = strtab_data.find('\0', start)
-        assert end >= 0
-        name = strtab_data[start: end]
-
-        # Check to see if symbol is one of the three types we want to load
-        if sym_type not in valid_sym_types:
-            continue
-
-        # Add symbol to the sparse memory image
-        mem_image.add_symbol(name, sym.value)
-
+    found = read_symbol_table(file_obj, ehdr, is_64bit, shdrs, mem_image)
+    assert found
     return mem_image
 
+# segments are read from the file and written to memory in chunks of this many
+# bytes (a multiple of 8, so that all chunks but the first start word-aligned)
+LOAD_CHUNK_SIZE = 1024 * 1024
+
 def elf_read_process_image(mem, file_obj):
-    from rpython.rlib.rarithmetic import r_uint, intmask
     ehdr, is_64bit = read_header(file_obj)
+    load_segments(mem, file_obj, ehdr, is_64bit)
+    return ehdr.entry
 
+def load_segments(mem, file_obj, ehdr, is_64bit):
+    """ Load the PT_LOAD segments into mem. Returns the file offset where the
+    data of the last segment ends. """
+    # read the whole program header table at once
+    file_obj.seek(intmask(ehdr.phoff))
+    phdrs_data = file_obj.read(ehdr.phnum * ehdr.phentsize)
+    end_of_segments = 0
     for program_index in range(ehdr.phnum):
-        file_obj.seek(intmask(ehdr.phoff) + program_index * ehdr.phentsize)
-        phdr_data = file_obj.read(ehdr.phentsize)
+        start = program_index * ehdr.phentsize
+        phdr_data = phdrs_data[start: start + ehdr.phentsize]
         # load block
         phdr = ElfProgramHeader(phdr_data, is_64bit)
         if phdr.type != ElfProgramHeader.PT_LOAD:
             continue
-        file_obj.seek(intmask(phdr.offset))
-        content = file_obj.read(intmask(phdr.filesz))
         start_addr = r_uint(phdr.paddr)
-        for i in range(phdr.filesz):
-            mem.write(start_addr + i, 1, r_uint(0xff & ord(content[i])))
+        filesz = intmask(phdr.filesz)
+        end_of_segments = max(end_of_segments, intmask(phdr.offset) + filesz)
+        file_obj.seek(intmask(phdr.offset))
+        offset = 0
+        while offset < filesz:
+            content = file_obj.read(min(LOAD_CHUNK_SIZE, filesz - offset))
+            if not content:
+                raise ValueError("ELF file is truncated")
+            mem.write_bytes(start_addr + offset, content)
+            offset += len(content)
         # fill rest with 0
-        for i in range(phdr.filesz, phdr.memsz):
-            mem.write(start_addr + i, 1, r_uint(0))
-    return ehdr.entry
+        if phdr.memsz > phdr.filesz:
+            mem.fill(start_addr + filesz, intmask(phdr.memsz - phdr.filesz))
+    return end_of_segments
+
+# the part of an ELF file after its segments (symbol table, string tables,
+# section headers, debug info) is read into memory at once if it is at most
+# this big, see elf_load
+MAX_TAIL_SIZE = 64 * 1024 * 1024
+
+class FileTail(imagefile.ImageFile):
+    """ The part of file_obj from offset start to end, read with a single
+    read call. Reads that aren't completely in that part (e.g. of a string
+    table after the section headers) are passed on to file_obj. """
+
+    def __init__(self, file_obj, start, end):
+        self.file_obj = file_obj
+        self.start = start
+        file_obj.seek(start)
+        self.data = file_obj.read(end - start)
+        self.pos = start
+
+    def read(self, num_bytes):
+        index = self.pos - self.start
+        if index < 0 or index + num_bytes > len(self.data):
+            self.file_obj.seek(self.pos)
+            res = self.file_obj.read(num_bytes)
+        else:
+            res = self.data[index:index + num_bytes]
+        self.pos += len(res)
+        return res
+
+    def seek(self, pos):
+        self.pos = pos
+
+    def close(self):
+        self.file_obj.close()
+
+def elf_load(mem, file_obj):
+    """ Load the segments of the ELF file into mem and read its symbols, in
+    one pass over the file. Returns the entry point and a SparseMemoryImage
+    with the symbols (but without sections). """
+    ehdr, is_64bit = read_header(file_obj)
+    end_of_segments = load_segments(mem, file_obj, ehdr, is_64bit)
+    mem_image = SparseMemoryImage()
+    if ehdr.shnum:
+        # the section headers are usually at the very end of the file, and
+        # the symbol table comes before them. Read everything after the
+        # segments at once, instead of seeking backwards from the section
+        # headers to the symbol table, which would decompress a compressed
+        # file a second time.
+        shoff = intmask(ehdr.shoff)
+        end = shoff + ehdr.shnum * ehdr.shentsize
+        if end_of_segments <= shoff and end - end_of_segments <= MAX_TAIL_SIZE:
+            file_obj = FileTail(file_obj, end_of_segments, end)
+        shdrs = read_section_headers(file_obj, ehdr, is_64bit)
+        read_symbol_table(file_obj, ehdr, is_64bit, shdrs, mem_image)
+    return ehdr.entry, mem_image
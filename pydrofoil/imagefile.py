@@ -0,0 +1,155 @@
+# Reading guest images (ELF files and raw binaries) from disk. Images can be
+# gzip or zlib compressed, in which case they are decompressed on the fly
+# while they are loaded, without ever writing the uncompressed image to disk
+# or keeping it in memory as a whole.
+
+from rpython.rlib import rzlib
+from rpython.rlib.rstring import StringBuilder
+
+# number of bytes that are read from the file (and decompressed) at once
+CHUNK_SIZE = 1024 * 1024
+
+GZIP_MAGIC = "\x1f\x8b"
+
+def is_compressed(magic):
+    """ Check whether the first two bytes of a file are the header of gzip or
+    zlib compressed data. """
+    if len(magic) < 2:
+        return False
+    if magic == GZIP_MAGIC:
+        return True
+    # zlib: compression method deflate, and a header checksum
+    cmf = ord(magic[0])
+    flg = ord(magic[1])
+    return cmf & 0x0f == 8 and cmf >> 4 <= 7 and (cmf * 256 + flg) % 31 == 0
+
+def open_image(fn):
+    """ Open the image file fn for reading, returns an ImageFile. """
+    f = open(fn, "rb")
+    magic = f.read(2)
+    f.seek(0)
+    if is_compressed(magic):
+        return CompressedImageFile(f)
+    return PlainImageFile(f)
+
+
+class ImageFile(object):
+    """ The subset of the file interface that the image loaders use. """
+
+    def read(self, num_bytes):
+        """ Read up to num_bytes bytes, fewer only at the end of the file. """
+        raise NotImplementedError
+
+    def seek(self, pos):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+
+class PlainImageFile(ImageFile):
+    def __init__(self, f):
+        self.f = f
+
+    def read(self, num_bytes):
+        return self.f.read(num_bytes)
+
+    def seek(self, pos):
+        self.f.seek(pos)
+
+    def close(self):
+        self.f.close()
+
+
+class CompressedImageFile(ImageFile):
+    """ A gzip or zlib compressed file. Reading decompresses the data in
+    chunks. Seeking forward decompresses and skips the data in between,
+    seeking backwards before the current chunk starts decompressing from the
+    beginning of the file again. """
+
+    def __init__(self, f):
+        self.f = f
+        self.stream = rzlib.null_stream
+        self._start()
+
+    def _start(self):
+        if self.stream:
+            rzlib.inflateEnd(self.stream)
+        self.f.seek(0)
+        # 32 + MAX_WBITS accepts both the gzip and the zlib header
+        self.stream = rzlib.inflateInit(wbits=32 + rzlib.MAX_WBITS)
+        # compressed data that was read from f but not decompressed yet
+        self.pending = ""
+        self.finished = False
+        # the current chunk of decompressed data, and the position of its
+        # first byte in the decompressed file
+        self.buffer = ""
+        self.buffer_start = 0
+        self.buffer_pos = 0
+
+    def _decompress_chunk(self):
+        """ Replace the buffer with the next chunk of decompressed data.
+        Returns False at the end of the data. """
+        while not self.finished:
+            at_eof = False
+            if not self.pending:
+                self.pending = self.f.read(CHUNK_SIZE)
+                # zlib can still have buffered output at the end of the file
+                at_eof = not self.pending
+            data, finished, unused = rzlib.decompress(
+                self.stream, self.pending, max_length=CHUNK_SIZE)
+            start = len(self.pending) - unused
+            assert start >= 0
+            self.pending = self.pending[start:]
+            self.finished = finished
+            if data:
+                self.buffer_start += len(self.buffer)
+                self.buffer = data
+                self.buffer_pos = 0
+                return True
+            if at_eof and not finished:
+                raise rzlib.RZlibError("compressed image is truncated")
+        return False
+
+    def tell(self):
+        return self.buffer_start + self.buffer_pos
+
+    def read(self, num_bytes):
+        res = StringBuilder(min(num_bytes, CHUNK_SIZE))
+        while num_bytes > 0:
+            if self.buffer_pos == len(self.buffer):
+                if not self._decompress_chunk():
+                    break
+            end = min(len(self.buffer), self.buffer_pos + num_bytes)
+            res.append_slice(self.buffer, self.buffer_pos, end)
+            num_bytes -= end - self.buffer_pos
+            self.buffer_pos = end
+        return res.build()
+
+    def seek(self, pos):
+        if pos < self.buffer_start:
+            self._start()
+        while pos > self.buffer_start + len(self.buffer):
+            self.buffer_pos = len(self.buffer)
+            if not self._decompress_chunk():
+                break
+        self.buffer_pos = min(pos - self.buffer_start, len(self.buffer))
+
+    def close(self):
+        if self.stream:
+            rzlib.inflateEnd(self.stream)
+            self.stream = rzlib.null_stream
+        self.f.close()
+
+
+def load_raw(mem, start_addr, image_file):
+    """ Write the content of image_file to mem, starting at start_addr.
+    Returns the number of bytes written. """
+    offset = 0
+    while True:
+        data = image_file.read(CHUNK_SIZE)
+        if not data:
+            break
+        mem.write_bytes(start_addr + offset, data)
+        offset += len(data)
+    return offset
@@ -367,6 +367,24 @@ class Codegen(specialize.FixpointSpecializer):
                     self.emit("return space.interp_w(%s, w_value)" % (pyname, ))
             structtyp.convert_to_pypy = "%s.convert_to_pypy" % pyname
             structtyp.convert_from_pypy = "%s.convert_from_pypy" % pyname
+            self.emit("@staticmethod")
+            with self.emit_indent("def snapshot_save(writer, self):"):
+                for name in structtyp.names:
+                    fieldtyp = structtyp.fieldtyps[name]
+                    self.emit("%s(writer, %s)" % (
+                        fieldtyp.snapshot_save, fieldtyp.packed_field_read('self.%s' % name)))
+            self.emit("@staticmethod")
+            with self.emit_indent("def snapshot_load(reader):"):
+                for index, name in enumerate(structtyp.names):
+                    fieldtyp = structtyp.fieldtyps[name]
+                    value = "%s(reader)" % (fieldtyp.snapshot_load, )
+                    if isinstance(structtyp.internalfieldtyps[name], types.Packed):
+                        value = fieldtyp.packed_field_pack(value)
+                    self.emit("arg%s = %s" % (index, value))
+                self.emit("return %s(%s)" % (pyname, ", ".join(
+                    ["arg%s" % index for index in range(len(structtyp.names))])))
+            structtyp.snapshot_save = "%s.snapshot_save" % pyname
+            structtyp.snapshot_load = "%s.snapshot_load" % pyname
         if emit_pypy_typ:
             self.emit("Machine._all_type_names.append((%r, %r, %s, %r))" % (
                 pyname, demangle(structtyp.name), pyname, repr(structtyp)))
@@ -403,6 +421,7 @@ def parse_and_make_code(s, support_code, promoted_registers=set(), should_inline
         c.emit("class Machine(supportcode.RegistersBase):")
         c.emit("    _immutable_fields_ = ['g']")
         c.emit("    _all_register_names = []")
+        c.emit("    _all_register_snapshot = []")
         c.emit("    _all_type_names = []")
         c.emit("    _all_functions = []")
         c.emit("    l = Lets()")
@@ -487,6 +506,8 @@ class __extend__(parse.Enum):
                     codegen.emit("raise ValueError")
                 typ.convert_to_pypy = "supportcode.generate_convert_to_pypy_enum(%s, %r)" % (self.pyname, self.name.lstrip('z'))
                 typ.convert_from_pypy = "supportcode.generate_convert_from_pypy_enum(%s, %r)" % (self.pyname, self.name.lstrip('z'))
+                typ.snapshot_save = "supportcode.snapshot_save_machineint"
+                typ.snapshot_load = "supportcode.snapshot_load_machineint"
 
 
 class __extend__(parse.Union):
@@ -564,6 +585,7 @@ class __extend__(parse.Union):
                         codegen.emit("%s.singleton = %s()" % (subclassname, subclassname))
                 codegen.emit("%s._all_subclasses.append((%r, %r, %s))" % (
                     self.pyname, pyname, demangle(name), pyname))
+            self.make_snapshot(codegen, uniontyp)
 
         if self.name == "zexception":
             codegen.add_global("current_exception", "machine.current_exception", uniontyp, self, "machine.current_exception")
@@ -632,6 +654,30 @@ class __extend__(parse.Union):
         with codegen.emit_indent("def check_variant(inst):"):
             codegen.emit("return isinstance(inst, %s)" % pyname)
 
+    def make_snapshot(self, codegen, uniontyp):
+        # the variant is stored as its index, -1 for the uninitialized value
+        with codegen.emit_indent("def snapshot_save_%s(writer, arg):" % self.name):
+            for index, (pyname, typ) in enumerate(zip(self.pynames, self.types)):
+                rtyp = typ.resolve_type(codegen)
+                with codegen.emit_indent("if isinstance(arg, %s):" % (pyname, )):
+                    codegen.emit("writer.write_int(%s)" % (index, ))
+                    if rtyp is not types.Unit():
+                        codegen.emit("%s(writer, %s.convert(arg))" % (rtyp.snapshot_save, pyname))
+                    codegen.emit("return")
+            codegen.emit("writer.write_int(-1)")
+        with codegen.emit_indent("def snapshot_load_%s(reader):" % self.name):
+            codegen.emit("index = reader.read_int()")
+            for index, (pyname, typ) in enumerate(zip(self.pynames, self.types)):
+                rtyp = typ.resolve_type(codegen)
+                with codegen.emit_indent("if index == %s:" % (index, )):
+                    if rtyp is types.Unit():
+                        codegen.emit("return %s.singleton" % (pyname, ))
+                    elif type(rtyp) is types.Enum:
+                        codegen.emit("return %s.construct(%s(reader))" % (pyname, rtyp.snapshot_load))
+                    else:
+                        codegen.emit("return %s(%s(reader))" % (pyname, rtyp.snapshot_load))
+            codegen.emit("return %s" % (uniontyp.uninitialized_value, ))
+
     def constructor(self, info, op, args, argtyps):
         if info.typ.compact_union or (len(argtyps) == 1 and type(argtyps[0]) is types.Enum):
             return "%s.construct(%s)" % (op, args)
@@ -718,6 +764,10 @@ class __extend__(parse.Union):
             codegen.emit("return w_arg.to_sail()")
         with codegen.emit_indent("def convert_to_pypy_%s(space, arg):" % self.name):
             codegen.emit("return %s.convert_to_pypy(arg)" % wrapped_basename)
+        with codegen.emit_indent("def snapshot_save_%s(writer, arg):" % self.name):
+            codegen.emit("writer.write_uint(arg)")
+        with codegen.emit_indent("def snapshot_load_%s(reader):" % self.name):
+            codegen.emit("return reader.read_uint()")
         codegen.emit("Machine._all_type_names.append((%r, %r, %s, %r))" % (
             self.pyname, demangle(self.name), wrapped_basename, repr(uniontyp)))
 
@@ -846,6 +896,7 @@ class __extend__(parse.Register):
             codegen.emit("Machine._all_register_names.append((%r, %r, %s, %s, %r))" % (
                 self.pyname, demangle(self.name), typ.convert_to_pypy, typ.convert_from_pypy,
                 repr(typ)))
+            self.make_snapshot(codegen, typ, read_pyname, write_pyname)
 
         if self.body is None:
             return
@@ -857,6 +908,18 @@ class __extend__(parse.Register):
         if codegen.program_entrypoints:
             codegen.program_entrypoints.append(graph.name)
 
+    def make_snapshot(self, codegen, typ, read_pyname, write_pyname):
+        with codegen.emit_indent("def snapshot_save_%s(machine, writer):" % (self.pyname, )):
+            codegen.emit("%s(writer, %s)" % (typ.snapshot_save, read_pyname))
+        with codegen.emit_indent("def snapshot_load_%s(machine, reader):" % (self.pyname, )):
+            value = "%s(reader)" % (typ.snapshot_load, )
+            if "%" not in write_pyname:
+                codegen.emit("%s = %s" % (write_pyname, value))
+            else:
+                codegen.emit(write_pyname % (value, ))
+        codegen.emit("Machine._all_register_snapshot.append((%r, snapshot_save_%s, snapshot_load_%s))" % (
+            demangle(self.name), self.pyname, self.pyname))
+
     def make_register_ref(self, codegen, read_pyname=None):
         if hasattr(self, 'register_ref_name'):
             return self.register_ref_name
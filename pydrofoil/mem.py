@@ -1,8 +1,11 @@
+import os
 from rpython.rlib.nonconst import NonConstant
-from rpython.rlib.objectmodel import we_are_translated, always_inline
+from rpython.rlib.objectmodel import we_are_translated, always_inline, specialize
 from rpython.rlib.rarithmetic import r_uint, intmask
 from rpython.rlib import jit, debug as rdebug
-from rpython.rlib import rmmap
+from rpython.rlib import rmmap, rposix
+from rpython.rlib.unroll import unrolling_iterable
+from rpython.rlib.rstring import StringBuilder
 from rpython.rtyper.lltypesystem import rffi, lltype
 
 class MemBase(object):
@@ -30,13 +33,23 @@ class MemBase(object):
     def _aligned_read(self, start_addr, num_bytes, executable_flag):
         raise NotImplementedError
 
-    @jit.unroll_safe
+    # unaligned accesses are served from the (at most two) aligned words that
+    # they overlap, combined with shifts and masks
+
     def _unaligned_read(self, start_addr, num_bytes, executable_flag=False):
-        value = r_uint(0)
-        for i in range(num_bytes - 1, -1, -1):
-            value = value << 8
-            value = value | self._aligned_read(start_addr + i, 1, executable_flag)
-        return value
+        inword_addr = start_addr & 0b111
+        word_addr = start_addr - inword_addr
+        shift = inword_addr * 8
+        if num_bytes == 8:
+            mask = r_uint(-1)
+        else:
+            mask = (r_uint(1) << (num_bytes * 8)) - 1
+        low = self._aligned_read(word_addr, 8, executable_flag) >> shift
+        if inword_addr + num_bytes <= 8:
+            return low & mask
+        # crosses a word boundary, inword_addr != 0 here
+        high = self._aligned_read(word_addr + 8, 8, executable_flag) << (64 - shift)
+        return (low | high) & mask
 
     def write(self, start_addr, num_bytes, value):
         if not self.is_aligned(start_addr, num_bytes):
@@ -47,20 +60,231 @@ class MemBase(object):
     def _aligned_write(self, start_addr, num_bytes, value):
         raise NotImplementedError
 
-    @jit.unroll_safe
     def _unaligned_write(self, start_addr, num_bytes, value):
-        for i in range(num_bytes):
-            self._aligned_write(start_addr + i, 1, value & 0xff)
-            value = value >> 8
-        assert not value
+        inword_addr = start_addr & 0b111
+        word_addr = start_addr - inword_addr
+        shift = inword_addr * 8
+        if num_bytes == 8:
+            mask = r_uint(-1)
+        else:
+            mask = (r_uint(1) << (num_bytes * 8)) - 1
+        assert value & ~mask == 0
+        olddata = self._aligned_read(word_addr, 8, False)
+        self._aligned_write(word_addr, 8, (olddata & ~(mask << shift)) | (value << shift))
+        if inword_addr + num_bytes <= 8:
+            return
+        # crosses a word boundary, inword_addr != 0 here
+        high_shift = 64 - shift
+        olddata = self._aligned_read(word_addr + 8, 8, False)
+        self._aligned_write(word_addr + 8, 8, (olddata & ~(mask >> high_shift)) | (value >> high_shift))
 
     def memory_info(self):
         return None
 
+    def used_ranges(self):
+        """ Return a sorted list of (start, end) address ranges outside of
+        which the memory contains only zeroes, e.g. to save a snapshot without
+        looking at memory the guest never used. Without any knowledge about
+        that, these are the ranges of memory_info. """
+        return self.memory_info()
+
+    # bulk operations. they work word by word where possible and go through
+    # _aligned_read/_aligned_write, so the code tracking of the memory classes
+    # stays correct
+
+    def read_bytes(self, start_addr, num_bytes):
+        """ Read num_bytes bytes starting at start_addr, returned as a
+        string. """
+        res = StringBuilder(num_bytes)
+        addr = start_addr
+        end = start_addr + num_bytes
+        while addr < end and addr & 0b111:
+            res.append(chr(self._aligned_read(addr, 1, False)))
+            addr += 1
+        while end - addr >= 8:
+            value = self._aligned_read(addr, 8, False)
+            for i in range(8):
+                res.append(chr(value & 0xff))
+                value >>= 8
+            addr += 8
+        while addr < end:
+            res.append(chr(self._aligned_read(addr, 1, False)))
+            addr += 1
+        return res.build()
+
+    def write_bytes(self, start_addr, data):
+        """ Write the string data to memory, starting at start_addr. """
+        addr = start_addr
+        end = start_addr + len(data)
+        index = 0
+        while addr < end and addr & 0b111:
+            self._aligned_write(addr, 1, r_uint(ord(data[index])))
+            addr += 1
+            index += 1
+        while end - addr >= 8:
+            value = word_from_string(data, index)
+            self._aligned_write(addr, 8, value)
+            addr += 8
+            index += 8
+        while addr < end:
+            self._aligned_write(addr, 1, r_uint(ord(data[index])))
+            addr += 1
+            index += 1
+
+    def fill(self, start_addr, num_bytes, byte=0):
+        """ Set num_bytes bytes starting at start_addr to byte. """
+        byte = r_uint(byte & 0xff)
+        addr = start_addr
+        end = start_addr + num_bytes
+        while addr < end and addr & 0b111:
+            self._aligned_write(addr, 1, byte)
+            addr += 1
+        value = byte * r_uint(0x0101010101010101)
+        while end - addr >= 8:
+            self._aligned_write(addr, 8, value)
+            addr += 8
+        while addr < end:
+            self._aligned_write(addr, 1, byte)
+            addr += 1
+
+    def set_smc_threshold(self, threshold):
+        """ Set the number of code invalidations after which a page is pinned
+        as permanently mutable. 0 disables pinning. """
+        pass
+
+    def page_invalidation_stats(self):
+        """ Return a list of tuples (page_address, invalidation_count, pinned)
+        for all pages that had their code invalidated at least once. """
+        return []
+
+    def set_dirty_tracking(self, enabled):
+        """ Switch the tracking of dirty pages on or off. """
+        pass
+
+    def dirty_pages(self):
+        """ Return the sorted list of the addresses of all pages that were
+        written to since dirty tracking was switched on or the last call to
+        reset_dirty_pages. """
+        return []
+
+    def reset_dirty_pages(self):
+        """ Mark all pages as clean. """
+        pass
+
+    def set_block_cache_stats(self, enabled):
+        """ Switch the collection of block cache statistics on or off (and
+        reset them). """
+        pass
+
+    def block_cache_stats(self):
+        """ Return a tuple (lookups, misses) of the block cache statistics.
+        Only block memories have a block cache. """
+        return 0, 0
+
+@always_inline
+def word_from_string(data, index):
+    """ Return the little endian word at data[index:index + 8]. """
+    value = r_uint(0)
+    for i in range(7, -1, -1):
+        value = (value << 8) | r_uint(ord(data[index + i]))
+    return value
+
+# anonymous mappings are zero-filled by the OS on first access, so guest memory
+# that is backed by them only uses host memory for the pages that the guest
+# actually touches. MAP_NORESERVE makes sure that even very large guest memories
+# don't count against the overcommit limit of the host.
+MAP_NORESERVE = rmmap.MAP_NORESERVE or 0
+
+def mmap_zeroed(size):
+    if we_are_translated():
+        nc = NonConstant
+    else:
+        nc = lambda x: x
+    res = rmmap.c_mmap(
+        nc(rmmap.NULL),
+        nc(size),
+        nc(rmmap.PROT_READ | rmmap.PROT_WRITE),
+        nc(rmmap.MAP_PRIVATE | rmmap.MAP_ANONYMOUS | MAP_NORESERVE),
+        nc(-1), nc(0))
+    if rffi.cast(lltype.Signed, res) == -1:
+        raise MemoryError
+    return res
+
+def mmap_image(ptr, image, size, shared):
+    """ Map the file image over the start of the anonymous mapping ptr of
+    length size. With shared=False the mapping is private: the guest sees the
+    content of the file, but its writes are copy-on-write and never reach the
+    file. With shared=True writes go through to the file. In both cases all
+    processes mapping the same file share its clean pages in the page cache.
+    The image is a raw little-endian memory dump, the part of the mapping after
+    the end of the file stays zero-filled. Returns the number of bytes of the
+    file that were mapped. """
+    if we_are_translated():
+        nc = NonConstant
+    else:
+        nc = lambda x: x
+    if shared:
+        fd = os.open(image, os.O_RDWR, 0)
+        flags = rmmap.MAP_SHARED
+    else:
+        fd = os.open(image, os.O_RDONLY, 0)
+        flags = rmmap.MAP_PRIVATE
+    try:
+        map_size = intmask(size)
+        file_size = intmask(os.fstat(fd).st_size)
+        if file_size < map_size:
+            map_size = file_size
+        if not map_size:
+            return 0
+        res = rmmap.c_mmap(
+            ptr,
+            nc(map_size),
+            nc(rmmap.PROT_READ | rmmap.PROT_WRITE),
+            nc(flags | rmmap.MAP_FIXED),
+            nc(fd), nc(0))
+        if rffi.cast(lltype.Signed, res) == -1:
+            raise OSError(rposix.get_saved_errno(), "mmap failed")
+    finally:
+        os.close(fd)
+    return map_size
+
+def munmap(ptr, size):
+    if we_are_translated():
+        nc = NonConstant
+    else:
+        nc = lambda x: x
+    rmmap.c_munmap_safe(rffi.cast(rffi.CCHARP, ptr), nc(size))
+
 # every word starts out as NORMAL. can transition to IMMUTABLE when used as
 # executable memory, which does not need a version change. transitioning from
 # NORMAL to MUTABLE does not need a version change either. only a transition
 # IMMUTABLE to MUTABLE needs one.
+#
+# the versions are kept per page of memory: writing to a word that was used as
+# code only invalidates the traces that read code from the same page, traces
+# that were built from instructions in other pages stay valid.
+#
+# pages that have their code invalidated over and over again (because they mix
+# code and data, or because the guest keeps generating code into them) are
+# pinned as mutable once they reach smc_threshold invalidations: all their words
+# become MUTABLE and no word in them will become IMMUTABLE again. Instruction
+# fetches from pinned pages are not constant-folded by the JIT any more, which
+# is slower than folding but much cheaper than retracing all the time.
+
+# default number of invalidations after which a page is pinned as mutable
+DEFAULT_SMC_THRESHOLD = 16
+
+# dirty pages: when dirty tracking is switched on, every write to a page (of
+# the data or of a tag) sets its entry in a map with one char per page. the
+# flag is quasi-immutable, so traces don't contain any dirty tracking code at
+# all while tracking is off, and a single store while it is on. switching it
+# invalidates all traces that write memory, which happens rarely.
+# reset_dirty_pages marks dirty pages as WRITTEN, so a memory that tracks
+# dirty pages since it was created knows all pages that were ever written to.
+
+DIRTY = '\x01'
+CLEAN = '\x00'
+WRITTEN = '\x02'
 
 MEM_STATUS_IMMUTABLE = 'i'
 MEM_STATUS_NORMAL = 'n'
@@ -70,42 +294,132 @@ class Version(object):
     pass
 
 
+class CodePage(object):
+    """ Code-tracking information for one page of a FlatMemory. Only pages
+    that were used for instruction fetches (or read at constant addresses by
+    the JIT) get one, all words in pages without a CodePage are NORMAL. The
+    status of the words is stored as two bitmaps, one bit per word. """
+
+    _immutable_fields_ = ['version?', 'immutable_bits', 'mutable_bits']
+
+    def __init__(self, num_words):
+        self.version = Version()
+        # does the page contain at least one IMMUTABLE word?
+        self.has_code = False
+        self.invalidation_count = 0
+        # pinned pages never get IMMUTABLE words again
+        self.pinned_mutable = False
+        bitmap_size = (num_words + 63) // 64
+        self.immutable_bits = [r_uint(0)] * bitmap_size
+        self.mutable_bits = [r_uint(0)] * bitmap_size
+
+    def get_status(self, index):
+        mask = r_uint(1) << (index & 63)
+        if self.mutable_bits[index >> 6] & mask:
+            return MEM_STATUS_MUTABLE
+        if self.immutable_bits[index >> 6] & mask:
+            return MEM_STATUS_IMMUTABLE
+        return MEM_STATUS_NORMAL
+
+    def is_immutable(self, index):
+        return bool(self.immutable_bits[index >> 6] & (r_uint(1) << (index & 63)))
+
+    def set_immutable(self, index):
+        self.immutable_bits[index >> 6] |= r_uint(1) << (index & 63)
+        self.has_code = True
+
+    def set_mutable(self, index):
+        mask = r_uint(1) << (index & 63)
+        self.immutable_bits[index >> 6] &= ~mask
+        self.mutable_bits[index >> 6] |= mask
+
+    def pin_mutable(self):
+        for i in range(len(self.immutable_bits)):
+            self.mutable_bits[i] |= self.immutable_bits[i]
+            self.immutable_bits[i] = r_uint(0)
+        self.pinned_mutable = True
+
+    def invalidate(self, index, smc_threshold):
+        """ The IMMUTABLE word index was changed. Invalidates the traces that
+        depend on the page and returns True if the page got pinned as mutable
+        because of that. """
+        self.version = Version()
+        self.set_mutable(index)
+        self.invalidation_count += 1
+        if smc_threshold and self.invalidation_count >= smc_threshold:
+            # the page keeps being modified, stop treating its words as code
+            self.pin_mutable()
+            return True
+        return False
+
+
+@jit.dont_look_inside
+def _debug_print_invalidating(mem_offset, page_index, survivors):
+    rdebug.debug_start("pydrofoil-mem")
+    rdebug.debug_print("invalidating", mem_offset, "page", page_index,
+                       "unaffected code pages", survivors)
+    rdebug.debug_stop("pydrofoil-mem")
+
+@jit.dont_look_inside
+def _debug_print_pinning(page_index, count):
+    rdebug.debug_start("pydrofoil-mem")
+    rdebug.debug_print("pinning page", page_index, "as mutable after",
+                       count, "invalidations")
+    rdebug.debug_stop("pydrofoil-mem")
+
+
 class FlatMemory(MemBase):
     SIZE = 64 * 1024 * 1024 // 8 # 64 MB
 
-    _immutable_fields_ = ['mem?', 'version?', 'status', 'base_addr']
+    # page size for the code versions and the word status, 4 KiB
+    PAGE_BITS = 12
+    WORDS_PER_PAGE_BITS = PAGE_BITS - 3
+    WORDS_PER_PAGE = 1 << WORDS_PER_PAGE_BITS
+
+    _immutable_fields_ = ['mem?', 'code_pages', 'dirty', 'base_addr', 'track_dirty?']
 
-    def __init__(self, mmap=False, size=SIZE, base_addr=0):
+    def __init__(self, mmap=False, size=SIZE, base_addr=0, image=None, shared=False,
+                 track_dirty=False):
         self.size = size
+        self.image_size = 0
         if mmap:
-            if we_are_translated():
-                nc = NonConstant
-            else:
-                nc = lambda x: x
-            mem = rmmap.c_mmap(
-                nc(rmmap.NULL),
-                nc(size),
-                nc(rmmap.PROT_READ | rmmap.PROT_WRITE),
-                nc(rmmap.MAP_PRIVATE | rmmap.MAP_ANONYMOUS),
-                nc(-1), nc(0))
-            mem = rffi.cast(rffi.UNSIGNEDP, mem)
+            ptr = mmap_zeroed(size)
+            if image is not None:
+                try:
+                    self.image_size = mmap_image(ptr, image, size, shared)
+                except OSError:
+                    munmap(ptr, size)
+                    raise
+            mem = rffi.cast(rffi.UNSIGNEDP, ptr)
         else:
+            assert image is None, "memory images need mmap=True"
             mem = [r_uint(0)] * (size // 8)
         self.mem = mem
-        self.status = [MEM_STATUS_NORMAL] * (size // 8)
-        self.version = Version()
+        num_pages = ((size // 8) >> self.WORDS_PER_PAGE_BITS) + 1
+        self.code_pages = [None] * num_pages
+        self.dirty = [CLEAN] * num_pages
+        self.track_dirty = track_dirty
+        # dirty pages were tracked since the memory was created, only the
+        # image and the pages that aren't CLEAN can contain anything but
+        # zeroes, see used_ranges
+        self.all_writes_tracked = track_dirty
 
         self.mmap = mmap
         self.base_addr = base_addr
 
+        # statistics about code invalidation
+        self.num_code_pages = 0
+        self.invalidation_count = 0
+        # sum over all invalidations of the number of code pages that were
+        # *not* affected by the invalidation
+        self.invalidation_survivors = 0
+        self.num_pinned_pages = 0
+        self.smc_threshold = DEFAULT_SMC_THRESHOLD
+
     def close(self):
-        if not self.mmap:
+        if not self.mmap or not self.mem:
             return
-        if we_are_translated():
-            nc = NonConstant
-        else:
-            nc = lambda x: x
-        rmmap.c_munmap_safe(rffi.cast(rffi.CCHARP, self.mem), nc(self.SIZE))
+        munmap(self.mem, self.size)
         self.mem = lltype.nullptr(rffi.UNSIGNEDP.TO)
 
     @always_inline
@@ -120,6 +434,17 @@ class FlatMemory(MemBase):
             mask = (r_uint(1) << (num_bytes * 8)) - 1
         return mem_offset, inword_addr, mask
 
+    @jit.elidable
+    def _get_code_page(self, page_index):
+        page = self.code_pages[page_index]
+        if page is None:
+            page = self.code_pages[page_index] = CodePage(self.WORDS_PER_PAGE)
+        return page
+
+    @always_inline
+    def _get_version(self, mem_offset):
+        return self._get_code_page(mem_offset >> self.WORDS_PER_PAGE_BITS).version
+
     def _aligned_read(self, start_addr, num_bytes, executable_flag):
         if executable_flag:
             jit.promote(start_addr)
@@ -128,8 +453,8 @@ class FlatMemory(MemBase):
             self.mark_word_immutable(start_addr)
 
         if ((executable_flag or jit.isconstant(mem_offset)) and
-                self._get_status_word(mem_offset, self.version) == MEM_STATUS_IMMUTABLE):
-            data = self._immutable_read(mem_offset, self.version)
+                self._get_status_word(mem_offset, self._get_version(mem_offset)) == MEM_STATUS_IMMUTABLE):
+            data = self._immutable_read(mem_offset, self._get_version(mem_offset))
         else:
             data = self.mem[mem_offset]
             if executable_flag:
@@ -141,13 +466,19 @@ class FlatMemory(MemBase):
 
     @jit.elidable_promote('all')
     def _immutable_read(self, mem_offset, version):
-        assert version is self.version
+        assert version is self._get_version(mem_offset)
         return self.mem[mem_offset]
 
     @jit.elidable_promote('all')
     def _get_status_word(self, mem_offset, version):
-        assert version is self.version
-        return self.status[mem_offset]
+        assert version is self._get_version(mem_offset)
+        return self.get_status(mem_offset)
+
+    def get_status(self, mem_offset):
+        page = self.code_pages[mem_offset >> self.WORDS_PER_PAGE_BITS]
+        if page is None:
+            return MEM_STATUS_NORMAL
+        return page.get_status(mem_offset & (self.WORDS_PER_PAGE - 1))
 
     def _aligned_write(self, start_addr, num_bytes, value):
         mem_offset, inword_addr, mask = self._split_addr(start_addr, num_bytes)
@@ -162,51 +493,192 @@ class FlatMemory(MemBase):
         self._write_word(mem_offset, (olddata & ~mask) | value)
 
     def _write_word(self, mem_offset, value):
-        if self.status[mem_offset] == MEM_STATUS_IMMUTABLE:
+        if self.track_dirty:
+            self.dirty[mem_offset >> self.WORDS_PER_PAGE_BITS] = DIRTY
+        page = self.code_pages[mem_offset >> self.WORDS_PER_PAGE_BITS]
+        if page is not None and page.is_immutable(mem_offset & (self.WORDS_PER_PAGE - 1)):
             oldval = self.mem[mem_offset]
             if oldval != value:
                 self._invalidate(mem_offset)
         self.mem[mem_offset] = value
 
     def _invalidate(self, mem_offset):
-        self.version = Version()
-        self.status[mem_offset] = MEM_STATUS_MUTABLE
-        self._debug_print_invalidating(mem_offset)
-
-    @jit.dont_look_inside
-    def _debug_print_invalidating(self, mem_offset):
-        rdebug.debug_start("pydrofoil-mem")
-        rdebug.debug_print("invalidating", mem_offset)
-        rdebug.debug_stop("pydrofoil-mem")
+        page_index = mem_offset >> self.WORDS_PER_PAGE_BITS
+        page = self._get_code_page(page_index)
+        # only the traces that depend on code from this page are invalidated
+        pinned = page.invalidate(mem_offset & (self.WORDS_PER_PAGE - 1), self.smc_threshold)
+        survivors = self.num_code_pages - 1
+        self.invalidation_count += 1
+        self.invalidation_survivors += survivors
+        _debug_print_invalidating(mem_offset, page_index, survivors)
+        if pinned:
+            self.num_pinned_pages += 1
+            _debug_print_pinning(page_index, page.invalidation_count)
 
     @jit.not_in_trace
     def mark_word_immutable(self, addr):
         mem_offset, inword_addr, mask = self._split_addr(addr, 1)
-        status = self._get_status_word(mem_offset, self.version)
+        status = self._get_status_word(mem_offset, self._get_version(mem_offset))
         if status != MEM_STATUS_NORMAL:
             return
         #print "mark_word_immutable", mem_offset
-        self.status[mem_offset] = MEM_STATUS_IMMUTABLE
+        page = self._get_code_page(mem_offset >> self.WORDS_PER_PAGE_BITS)
+        if page.pinned_mutable:
+            return
+        if not page.has_code:
+            self.num_code_pages += 1
+        page.set_immutable(mem_offset & (self.WORDS_PER_PAGE - 1))
 
     def memory_info(self):
         return [(r_uint(0), r_uint(self.size))]
 
+    def used_ranges(self):
+        if not self.all_writes_tracked:
+            return self.memory_info()
+        res = []
+        base_addr = r_uint(self.base_addr)
+        if self.image_size:
+            res.append((base_addr, base_addr + r_uint(self.image_size)))
+        for page_index in range(len(self.dirty)):
+            if self.dirty[page_index] == CLEAN:
+                continue
+            start = base_addr + (r_uint(page_index) << self.PAGE_BITS)
+            end = min(start + (r_uint(1) << self.PAGE_BITS), base_addr + r_uint(self.size))
+            if res and res[-1][1] >= start:
+                if end > res[-1][1]:
+                    res[-1] = (res[-1][0], end)
+            else:
+                res.append((start, end))
+        return res
+
+    def set_smc_threshold(self, threshold):
+        self.smc_threshold = threshold
+
+    def page_invalidation_stats(self):
+        res = []
+        for page_index, page in enumerate(self.code_pages):
+            if page is None or not page.invalidation_count:
+                continue
+            addr = r_uint(self.base_addr) + (r_uint(page_index) << self.PAGE_BITS)
+            res.append((addr, page.invalidation_count, page.pinned_mutable))
+        return res
+
+    def set_dirty_tracking(self, enabled):
+        self.track_dirty = enabled
+        if not enabled:
+            self.all_writes_tracked = False
+
+    def _mark_dirty(self, addr):
+        if self.track_dirty:
+            self.dirty[(addr - self.base_addr) >> self.PAGE_BITS] = DIRTY
+
+    def dirty_pages(self):
+        res = []
+        for page_index in range(len(self.dirty)):
+            if self.dirty[page_index] == DIRTY:
+                res.append(r_uint(self.base_addr) + (r_uint(page_index) << self.PAGE_BITS))
+        return res
+
+    def reset_dirty_pages(self):
+        for page_index in range(len(self.dirty)):
+            if self.dirty[page_index] == DIRTY:
+                self.dirty[page_index] = WRITTEN
+
+
+# tags are stored as bitmaps of r_uint words, one bit per byte address (bit i
+# of word n is the tag of address n * 64 + i). the tagged memories implement
+# _get_tag_word, which the bulk tag operations are built on
+
+def popcount(x):
+    x = x - ((x >> 1) & r_uint(0x5555555555555555))
+    x = (x & r_uint(0x3333333333333333)) + ((x >> 2) & r_uint(0x3333333333333333))
+    x = (x + (x >> 4)) & r_uint(0x0f0f0f0f0f0f0f0f)
+    return intmask((x * r_uint(0x0101010101010101)) >> 56)
+
+@specialize.argtype(0)
+def _process_tags(mem, start_addr, num_bytes, clear):
+    # count (and optionally clear) the tags of num_bytes addresses starting at
+    # start_addr, a whole tag word at a time
+    count = 0
+    addr = start_addr
+    end = start_addr + num_bytes
+    while addr < end:
+        bitmap, index, bit, room = mem._get_tag_word(addr)
+        chunk = end - addr
+        if chunk > room:
+            chunk = r_uint(room)
+        if chunk == 64:
+            mask = r_uint(-1)
+        else:
+            mask = ((r_uint(1) << chunk) - 1) << bit
+        data = bitmap[index]
+        count += popcount(data & mask)
+        if clear and data & mask:
+            bitmap[index] = data & ~mask
+            mem._mark_dirty(addr)
+        addr += chunk
+    return count
+
 
 class TaggedFlatMemory(FlatMemory):
-    def __init__(self, mmap=False, size=FlatMemory.SIZE, base_addr=0):
-        FlatMemory.__init__(self, mmap, size, base_addr)
-        self.tags = ['\x00'] * len(self.mem)
+    def __init__(self, mmap=False, size=FlatMemory.SIZE, base_addr=0, image=None, shared=False):
+        FlatMemory.__init__(self, mmap, size, base_addr, image, shared)
+        num_tag_words = (size + 63) // 64
+        if mmap:
+            self.tags = rffi.cast(rffi.UNSIGNEDP, mmap_zeroed(num_tag_words * 8))
+        else:
+            self.tags = [r_uint(0)] * num_tag_words
+
+    def close(self):
+        if not self.mmap or not self.tags:
+            return
+        FlatMemory.close(self)
+        munmap(self.tags, (self.size + 63) // 64 * 8)
+        self.tags = lltype.nullptr(rffi.UNSIGNEDP.TO)
+
+    @always_inline
+    def _split_tag_addr(self, addr):
+        addr -= self.base_addr
+        return addr >> 6, addr & 0b111111
+
+    def _get_tag_word(self, addr):
+        index, bit = self._split_tag_addr(addr)
+        return self.tags, index, bit, 64 - bit
 
     def read_tag_bit(self, addr):
-        mem_offset, inword_addr, _ = self._split_addr(addr, 1)
-        data = ord(self.tags[mem_offset])
-        return bool((data >> inword_addr) & 1)
+        index, bit = self._split_tag_addr(addr)
+        return bool((self.tags[index] >> bit) & 1)
 
     def write_tag_bit(self, addr, tag):
-        mem_offset, inword_addr, _ = self._split_addr(addr, 1)
-        mask = r_uint(1) << inword_addr
-        olddata = ord(self.tags[mem_offset])
-        self.tags[mem_offset] = chr((olddata & ~mask) | (r_uint(tag) << inword_addr))
+        self._mark_dirty(addr)
+        index, bit = self._split_tag_addr(addr)
+        mask = r_uint(1) << bit
+        olddata = self.tags[index]
+        self.tags[index] = (olddata & ~mask) | (r_uint(bool(tag)) << bit)
+
+    def clear_tags(self, start_addr, num_bytes):
+        """ Clear the tags of the num_bytes addresses starting at
+        start_addr. """
+        _process_tags(self, start_addr, num_bytes, True)
+
+    def count_tags(self, start_addr, num_bytes):
+        """ Count the set tags of the num_bytes addresses starting at
+        start_addr. """
+        return _process_tags(self, start_addr, num_bytes, False)
+
+
+class Block(object):
+    """ A block of BlockMemory. code is the CodePage that tracks the status of
+    the words in the block, it is created when the block is first used for
+    code. dirty has one entry per page of the block. """
+
+    _immutable_fields_ = ['block_addr', 'data', 'dirty']
+
+    def __init__(self, block_addr, num_words, num_pages):
+        self.block_addr = block_addr
+        self.data = [r_uint(0)] * num_words
+        self.code = None
+        self.dirty = [CLEAN] * num_pages
 
 
 class BlockMemory(MemBase):
@@ -214,55 +686,133 @@ class BlockMemory(MemBase):
     BLOCK_SIZE = 2 ** ADDRESS_BITS_BLOCK
     BLOCK_MASK = BLOCK_SIZE - 1
 
+    # the status of the words and the code versions are tracked per block, in
+    # the same way as FlatMemory does it per page
+
+    # dirty pages are tracked in pages of the same size as in FlatMemory (or
+    # per block, if the blocks are smaller than that)
+    PAGE_BITS = FlatMemory.PAGE_BITS
+
+    # blocks are only allocated when they are first written to (or used for
+    # code). until then, reads from them are served from zero_block, which is
+    # shared by all untouched blocks and never written to. the read/write
+    # cache can therefore contain zero_block, writes check for it and
+    # allocate the real block.
+
+    # there are two block caches, one for instruction fetches, one for other
+    # reads and writes. both are direct-mapped with BLOCK_CACHE_SIZE entries,
+    # block_addr is cached in the entry block_addr % BLOCK_CACHE_SIZE. that
+    # way, a guest that alternates between e.g. stack, heap and a memcpy
+    # destination in different blocks doesn't go to the blocks dict all the
+    # time. the cache lookup in a trace is an array read and a compare.
+    BLOCK_CACHE_SIZE = 16
+
+    _immutable_fields_ = ['track_dirty?', 'zero_block', 'cache_stats?',
+                          'cache_addrs', 'cache_blocks',
+                          'cache_addrs_executable', 'cache_blocks_executable']
+
     def __init__(self):
         self.blocks = {}
-        # we cache two different last blocks, one for instruction fetches, one
-        # for other reads and writes
-        self.last_block = None
-        self.last_block_executable = None
+        self.zero_block = self._new_block(r_uint(-1))
         # invalid block address because higher bits than ADDRESS_BITS_BLOCK are
         # set
-        self.last_block_addr = r_uint(-1)
-        self.last_block_addr_executable = r_uint(-1)
+        self.cache_addrs = [r_uint(-1)] * self.BLOCK_CACHE_SIZE
+        self.cache_blocks = [self.zero_block] * self.BLOCK_CACHE_SIZE
+        self.cache_addrs_executable = [r_uint(-1)] * self.BLOCK_CACHE_SIZE
+        self.cache_blocks_executable = [self.zero_block] * self.BLOCK_CACHE_SIZE
+        # hit rate statistics of the caches, only collected if cache_stats is
+        # set
+        self.cache_stats = False
+        self.cache_lookups = 0
+        self.cache_misses = 0
+
+        # statistics about code invalidation, see FlatMemory
+        self.num_code_pages = 0
+        self.invalidation_count = 0
+        self.invalidation_survivors = 0
+        self.num_pinned_pages = 0
+        self.smc_threshold = DEFAULT_SMC_THRESHOLD
+        self.track_dirty = False
+
+    @always_inline
+    def _page_bits(self):
+        return min(self.PAGE_BITS, self.ADDRESS_BITS_BLOCK)
+
+    @always_inline
+    def _cache_index(self, block_addr):
+        return intmask(block_addr & r_uint(self.BLOCK_CACHE_SIZE - 1))
 
     def get_block(self, block_addr, executable_flag):
         if jit.isconstant(block_addr):
             return self._get_block(block_addr)
+        if self.cache_stats:
+            self.cache_lookups += 1
+        index = self._cache_index(block_addr)
         if executable_flag:
             jit.conditional_call(
-                block_addr != self.last_block_addr_executable,
+                block_addr != self.cache_addrs_executable[index],
                 BlockMemory._fetch_and_set_block_executable,
                 self,
                 block_addr
             )
-            return self.last_block_executable
+            return self.cache_blocks_executable[index]
         else:
             jit.conditional_call(
-                block_addr != self.last_block_addr,
+                block_addr != self.cache_addrs[index],
                 BlockMemory._fetch_and_set_block,
                 self,
                 block_addr
             )
-            return self.last_block
-        return block
+            return self.cache_blocks[index]
 
     def _fetch_and_set_block(self, block_addr):
-        block = self._get_block(block_addr)
-        self.last_block = block
-        self.last_block_addr = block_addr
+        block = self.blocks.get(block_addr, self.zero_block)
+        index = self._cache_index(block_addr)
+        self.cache_blocks[index] = block
+        self.cache_addrs[index] = block_addr
+        if self.cache_stats:
+            self.cache_misses += 1
 
     def _fetch_and_set_block_executable(self, block_addr):
         block = self._get_block(block_addr)
-        self.last_block_executable = block
-        self.last_block_addr_executable = block_addr
+        index = self._cache_index(block_addr)
+        self.cache_blocks_executable[index] = block
+        self.cache_addrs_executable[index] = block_addr
+        if self.cache_stats:
+            self.cache_misses += 1
+
+    def _new_block(self, block_addr):
+        num_pages = 1 << (self.ADDRESS_BITS_BLOCK - self._page_bits())
+        return Block(block_addr, self.BLOCK_SIZE // 8, num_pages)
 
     @jit.elidable
     def _get_block(self, block_addr):
         if block_addr in self.blocks:
             return self.blocks[block_addr]
-        res = self.blocks[block_addr] = [r_uint(0)] * (self.BLOCK_SIZE // 8)
+        res = self.blocks[block_addr] = self._new_block(block_addr)
+        index = self._cache_index(block_addr)
+        if block_addr == self.cache_addrs[index]:
+            # the cache contains zero_block for this address
+            self.cache_blocks[index] = res
         return res
 
+    def _get_block_for_write(self, start_addr):
+        block, block_offset, inword_addr, mask = self._split_addr(start_addr, 1)
+        if block is self.zero_block:
+            block = self._get_block(start_addr >> self.ADDRESS_BITS_BLOCK)
+        return block
+
+    @jit.elidable
+    def _get_code_page(self, block):
+        page = block.code
+        if page is None:
+            page = block.code = CodePage(self.BLOCK_SIZE // 8)
+        return page
+
+    @always_inline
+    def _get_version(self, block):
+        return self._get_code_page(block).version
+
     @always_inline
     def _split_addr(self, start_addr, num_bytes, executable_flag=False):
         block_addr = start_addr >> self.ADDRESS_BITS_BLOCK
@@ -278,36 +828,224 @@ class BlockMemory(MemBase):
         return block, block_offset, inword_addr, mask
 
     def _aligned_read(self, start_addr, num_bytes, executable_flag):
+        if executable_flag:
+            jit.promote(start_addr)
         block, block_offset, inword_addr, mask = self._split_addr(start_addr, num_bytes, executable_flag)
-        data = block[block_offset]
+        if executable_flag:
+            self.mark_word_immutable(block, block_offset)
+        if ((executable_flag or jit.isconstant(start_addr)) and
+                self._get_status_word(block, block_offset, self._get_version(block)) == MEM_STATUS_IMMUTABLE):
+            data = self._immutable_read(block, block_offset, self._get_version(block))
+        else:
+            data = block.data[block_offset]
+            if executable_flag:
+                jit.promote(data)
         if num_bytes == 8:
             assert inword_addr == 0
             return data
         return (data >> (inword_addr * 8)) & mask
 
+    @jit.elidable_promote('all')
+    def _immutable_read(self, block, block_offset, version):
+        assert version is self._get_version(block)
+        return block.data[block_offset]
+
+    @jit.elidable_promote('all')
+    def _get_status_word(self, block, block_offset, version):
+        assert version is self._get_version(block)
+        return self._get_code_page(block).get_status(block_offset)
+
+    def get_status(self, addr):
+        block = self.blocks.get(addr >> self.ADDRESS_BITS_BLOCK, self.zero_block)
+        if block.code is None:
+            return MEM_STATUS_NORMAL
+        return block.code.get_status((addr & self.BLOCK_MASK) >> 3)
+
     def _aligned_write(self, start_addr, num_bytes, value):
         block, block_offset, inword_addr, mask = self._split_addr(start_addr, num_bytes, False)
+        if block is self.zero_block:
+            block = self._get_block(start_addr >> self.ADDRESS_BITS_BLOCK)
         if num_bytes == 8:
             assert inword_addr == 0
-            block[block_offset] = value
+            self._write_word(block, block_offset, value)
             return
         assert value & ~mask == 0
-        olddata = block[block_offset]
+        olddata = block.data[block_offset]
         mask <<= inword_addr * 8
         value <<= inword_addr * 8
-        block[block_offset] = (olddata & ~mask) | value
+        self._write_word(block, block_offset, (olddata & ~mask) | value)
+
+    def _write_word(self, block, block_offset, value):
+        if self.track_dirty:
+            block.dirty[block_offset >> (self._page_bits() - 3)] = DIRTY
+        page = block.code
+        if page is not None and page.is_immutable(block_offset):
+            oldval = block.data[block_offset]
+            if oldval != value:
+                self._invalidate(block, block_offset)
+        block.data[block_offset] = value
+
+    def _invalidate(self, block, block_offset):
+        page = self._get_code_page(block)
+        # only the traces that depend on code from this block are invalidated
+        pinned = page.invalidate(block_offset, self.smc_threshold)
+        survivors = self.num_code_pages - 1
+        self.invalidation_count += 1
+        self.invalidation_survivors += survivors
+        block_index = intmask(block.block_addr)
+        _debug_print_invalidating(block_offset, block_index, survivors)
+        if pinned:
+            self.num_pinned_pages += 1
+            _debug_print_pinning(block_index, page.invalidation_count)
+
+    @jit.not_in_trace
+    def mark_word_immutable(self, block, block_offset):
+        status = self._get_status_word(block, block_offset, self._get_version(block))
+        if status != MEM_STATUS_NORMAL:
+            return
+        page = self._get_code_page(block)
+        if page.pinned_mutable:
+            return
+        if not page.has_code:
+            self.num_code_pages += 1
+        page.set_immutable(block_offset)
+
+    # bulk writes (e.g. when loading a raw image) copy the words directly
+    # into the data of the blocks. that is only possible if the block has no
+    # code and dirty tracking is off, otherwise the words are written one by
+    # one with _write_word
+
+    def _bulk_block(self, addr, end):
+        """ Return the block of the aligned address addr, the offset of addr
+        in it, and the number of words from addr to end or the end of the
+        block. """
+        block = self._get_block(addr >> self.ADDRESS_BITS_BLOCK)
+        block_offset = intmask((addr & self.BLOCK_MASK) >> 3)
+        num_words = intmask((end - addr) >> 3)
+        num_words = min(num_words, self.BLOCK_SIZE // 8 - block_offset)
+        return block, block_offset, num_words
+
+    def write_bytes(self, start_addr, data):
+        addr = start_addr
+        end = start_addr + len(data)
+        index = 0
+        while addr < end and addr & 0b111:
+            self._aligned_write(addr, 1, r_uint(ord(data[index])))
+            addr += 1
+            index += 1
+        while end - addr >= 8:
+            block, block_offset, num_words = self._bulk_block(addr, end)
+            if block.code is None and not self.track_dirty:
+                block_data = block.data
+                for i in range(num_words):
+                    block_data[block_offset + i] = word_from_string(data, index + i * 8)
+            else:
+                for i in range(num_words):
+                    self._write_word(block, block_offset + i, word_from_string(data, index + i * 8))
+            addr += num_words * 8
+            index += num_words * 8
+        while addr < end:
+            self._aligned_write(addr, 1, r_uint(ord(data[index])))
+            addr += 1
+            index += 1
+
+    def fill(self, start_addr, num_bytes, byte=0):
+        byte = r_uint(byte & 0xff)
+        addr = start_addr
+        end = start_addr + num_bytes
+        while addr < end and addr & 0b111:
+            self._aligned_write(addr, 1, byte)
+            addr += 1
+        value = byte * r_uint(0x0101010101010101)
+        while end - addr >= 8:
+            if not value and addr & self.BLOCK_MASK == 0 and end - addr >= self.BLOCK_SIZE:
+                if (addr >> self.ADDRESS_BITS_BLOCK) not in self.blocks:
+                    # zeroing a whole block that was never written to
+                    addr += self.BLOCK_SIZE
+                    continue
+            block, block_offset, num_words = self._bulk_block(addr, end)
+            if block.code is None and not self.track_dirty:
+                block_data = block.data
+                for i in range(num_words):
+                    block_data[block_offset + i] = value
+            else:
+                for i in range(num_words):
+                    self._write_word(block, block_offset + i, value)
+            addr += num_words * 8
+        while addr < end:
+            self._aligned_write(addr, 1, byte)
+            addr += 1
 
     def memory_info(self):
         res = []
         for block_addr in self.blocks:
             block_offset = block_addr << self.ADDRESS_BITS_BLOCK
-            res.append(block_offset, block_offset + self.BLOCK_SIZE)
+            res.append((r_uint(block_offset), r_uint(block_offset + self.BLOCK_SIZE)))
+        return res
+
+    def used_ranges(self):
+        # blocks that were never written to aren't allocated
+        block_addrs = [r_uint(block_addr) for block_addr in self.blocks]
+        block_addrs.sort()
+        return [(block_addr << self.ADDRESS_BITS_BLOCK,
+                 (block_addr << self.ADDRESS_BITS_BLOCK) + self.BLOCK_SIZE)
+                for block_addr in block_addrs]
+
+    def set_smc_threshold(self, threshold):
+        self.smc_threshold = threshold
+
+    def page_invalidation_stats(self):
+        res = []
+        for block in self.blocks.itervalues():
+            page = block.code
+            if page is None or not page.invalidation_count:
+                continue
+            addr = r_uint(block.block_addr) << self.ADDRESS_BITS_BLOCK
+            res.append((addr, page.invalidation_count, page.pinned_mutable))
         return res
 
+    def set_block_cache_stats(self, enabled):
+        self.cache_stats = enabled
+        self.cache_lookups = 0
+        self.cache_misses = 0
+
+    def block_cache_stats(self):
+        return self.cache_lookups, self.cache_misses
+
+    def set_dirty_tracking(self, enabled):
+        self.track_dirty = enabled
+
+    def _mark_dirty(self, addr):
+        if self.track_dirty:
+            block = self._get_block_for_write(addr)
+            block.dirty[(addr & self.BLOCK_MASK) >> self._page_bits()] = DIRTY
+
+    def dirty_pages(self):
+        res = []
+        for block in self.blocks.itervalues():
+            block_start = r_uint(block.block_addr) << self.ADDRESS_BITS_BLOCK
+            for page_index in range(len(block.dirty)):
+                if block.dirty[page_index] == DIRTY:
+                    res.append(block_start + (r_uint(page_index) << self._page_bits()))
+        res.sort()
+        return res
+
+    def reset_dirty_pages(self):
+        for block in self.blocks.itervalues():
+            for page_index in range(len(block.dirty)):
+                if block.dirty[page_index] == DIRTY:
+                    block.dirty[page_index] = WRITTEN
+
 class TaggedBlockMemory(BlockMemory):
+    # like the data blocks, tag blocks are shared (in zero_tags) until they
+    # are first written to
+
+    _immutable_fields_ = ['zero_tags']
+
     def __init__(self):
         BlockMemory.__init__(self)
         self.tag_blocks = {}
+        self.zero_tags = self._new_tag_block()
         self.last_block_tags = None
         self.last_block_addr_tags = r_uint(-1)
 
@@ -330,91 +1068,257 @@ class TaggedBlockMemory(BlockMemory):
         return self.last_block_tags
 
     def _fetch_and_set_tag_block(self, block_addr):
-        block = self._get_tag_block(block_addr)
+        block = self.tag_blocks.get(block_addr, self.zero_tags)
         self.last_block_tags = block
         self.last_block_addr_tags = block_addr
 
-    @jit.elidable
+    def _new_tag_block(self):
+        return [r_uint(0)] * ((self.BLOCK_SIZE + 63) // 64)
+
     def _get_tag_block(self, block_addr):
         if block_addr in self.tag_blocks:
             return self.tag_blocks[block_addr]
-        res = self.tag_blocks[block_addr] = [r_uint(0)] * ((self.BLOCK_SIZE + 63) // 64)
+        res = self.tag_blocks[block_addr] = self._new_tag_block()
+        if block_addr == self.last_block_addr_tags:
+            self.last_block_tags = res
         return res
 
+    def _get_tag_word(self, addr):
+        block, block_offset, inword_addr = self._split_tag_addr(addr)
+        # a tag word never spans more than one block
+        if self.BLOCK_SIZE < 64:
+            room = self.BLOCK_SIZE - inword_addr
+        else:
+            room = 64 - inword_addr
+        return block, block_offset, inword_addr, room
+
     def read_tag_bit(self, addr):
         block, block_offset, inword_addr = self._split_tag_addr(addr)
         return bool((block[block_offset] >> inword_addr) & 0b1)
 
     def write_tag_bit(self, addr, tag):
+        self._mark_dirty(addr)
         tag = r_uint(bool(tag))
         block, block_offset, inword_addr = self._split_tag_addr(addr)
+        if block is self.zero_tags:
+            block = self._get_tag_block(addr >> self.ADDRESS_BITS_BLOCK)
         mask = r_uint(1) << inword_addr
         olddata = block[block_offset]
         block[block_offset] = (olddata & ~mask) | (tag << inword_addr)
 
+    def clear_tags(self, start_addr, num_bytes):
+        """ Clear the tags of the num_bytes addresses starting at
+        start_addr. """
+        _process_tags(self, start_addr, num_bytes, True)
+
+    def count_tags(self, start_addr, num_bytes):
+        """ Count the set tags of the num_bytes addresses starting at
+        start_addr. """
+        return _process_tags(self, start_addr, num_bytes, False)
+
+
+def _make_block_memory_class(basecls, address_bits_block):
+    if address_bits_block == basecls.ADDRESS_BITS_BLOCK:
+        return basecls
+    class cls(basecls):
+        ADDRESS_BITS_BLOCK = address_bits_block
+        BLOCK_SIZE = 2 ** ADDRESS_BITS_BLOCK
+        BLOCK_MASK = BLOCK_SIZE - 1
+    cls.__name__ = "%s%d" % (basecls.__name__, address_bits_block)
+    return cls
+
+# the supported block sizes: 4 KiB, 64 KiB and 1 MiB. very sparse memories
+# should use small blocks
+BLOCK_SIZE_BITS = [12, 16, BlockMemory.ADDRESS_BITS_BLOCK]
+_block_memory_classes = unrolling_iterable([
+    (address_bits_block,
+     _make_block_memory_class(BlockMemory, address_bits_block),
+     _make_block_memory_class(TaggedBlockMemory, address_bits_block))
+    for address_bits_block in BLOCK_SIZE_BITS])
+
+def block_memory(address_bits_block=BlockMemory.ADDRESS_BITS_BLOCK, tagged=False):
+    """ Make a BlockMemory (or a TaggedBlockMemory) with blocks of
+    2 ** address_bits_block bytes, which has to be one of
+    BLOCK_SIZE_BITS. """
+    for bits, cls, taggedcls in _block_memory_classes:
+        if bits == address_bits_block:
+            if tagged:
+                return taggedcls()
+            return cls()
+    raise ValueError
+
+
+class MemoryMap(MemBase):
+    """ An address space made up of any number of non-overlapping regions,
+    every one backed by its own memory object (which is accessed with
+    addresses relative to the start of the region). regions is a list of
+    tuples (address_base, size, mem), in any order. """
+
+    # the regions are sorted by address once. accesses find their region by a
+    # binary search over the start addresses. the JIT unrolls the search into a
+    # decision tree, which needs log2(number of regions) guards plus one for
+    # the end of the region. if the address is a constant (e.g. for
+    # instruction fetches) the dispatch is folded away completely.
+
+    _immutable_fields_ = ['bases[*]', 'ends[*]', 'mems[*]']
+
+    def __init__(self, regions):
+        assert regions
+        regions = regions[:]
+        # insertion sort, there are only a few regions
+        for i in range(1, len(regions)):
+            j = i
+            while j > 0 and regions[j - 1][0] > regions[j][0]:
+                regions[j - 1], regions[j] = regions[j], regions[j - 1]
+                j -= 1
+        bases = []
+        ends = []
+        mems = []
+        for address_base, size, mem in regions:
+            address_base = r_uint(address_base)
+            size = r_uint(size)
+            assert self.is_aligned(address_base)
+            assert self.is_aligned(size)
+            assert size
+            # no overflow
+            assert address_base + size > address_base
+            # no overlap with the previous region
+            assert not ends or ends[-1] <= address_base
+            bases.append(address_base)
+            ends.append(address_base + size)
+            mems.append(mem)
+        self.bases = bases
+        self.ends = ends
+        self.mems = mems
 
-class SplitMemory(MemBase):
-    # XXX should be generalized to N segments and auto-generated
-
-    _immutable_fields_ = ['mem1', 'address_base1', 'address_end1', 'mem2', 'address_base2', 'address_end2']
-
-    def __init__(self, mem1, address_base1, size1, mem2, address_base2, size2):
-        assert self.is_aligned(address_base1)
-        assert self.is_aligned(size1)
-        # fits in 63 bit
-        assert not (address_base1 + size1) & (r_uint(1) << 63)
-        self.mem1 = mem1
-        self.address_base1 = intmask(address_base1)
-        self.address_end1 = intmask(address_base1 + size1)
-
-        assert self.is_aligned(address_base2)
-        assert self.is_aligned(size2)
-        assert not (address_base2 + size2) & (r_uint(1) << 63)
-        self.mem2 = mem2
-        self.address_base2 = intmask(address_base2)
-        self.address_end2 = intmask(address_base2 + size2)
-
-    def _not_huge(self, start_addr):
-        # highest bit as a unsigned int not set
-        return not (start_addr & (r_uint(1)<<63))
-
-    def check_mem1(self, start_addr):
-        return self._not_huge(start_addr) and (self.address_base1 <= intmask(start_addr) < self.address_end1)
-
-    def check_mem1_fast(self, start_addr):
-        return self._not_huge(start_addr) and (intmask(start_addr) < self.address_end1)
-
-    def check_mem2(self, start_addr):
-        return self._not_huge(start_addr) and (self.address_base2 <= intmask(start_addr) < self.address_end2)
+    @jit.unroll_safe
+    def _find_region(self, start_addr):
+        """ Return the index of the region containing start_addr, or -1. """
+        low = 0
+        high = len(self.bases)
+        while high - low > 1:
+            middle = (low + high) >> 1
+            if start_addr >= self.bases[middle]:
+                low = middle
+            else:
+                high = middle
+        if self.bases[low] <= start_addr < self.ends[low]:
+            return low
+        return -1
 
     def _aligned_read(self, start_addr, num_bytes, executable_flag):
         if executable_flag:
             jit.promote(start_addr)
-        if self.address_base1:
-            if self.check_mem1(start_addr):
-                return self.mem1._aligned_read(start_addr - self.address_base1, num_bytes, executable_flag)
-        else:
-            if self.check_mem1_fast(start_addr):
-                return self.mem1._aligned_read(start_addr, num_bytes, executable_flag)
-        if self.check_mem2(start_addr):
-            return self.mem2._aligned_read(start_addr - self.address_base2, num_bytes, executable_flag)
-        raise ValueError
+        index = self._find_region(start_addr)
+        if index < 0:
+            raise ValueError
+        return self.mems[index]._aligned_read(start_addr - self.bases[index], num_bytes, executable_flag)
 
     def _aligned_write(self, start_addr, num_bytes, value):
-        if self.address_base1:
-            if self.check_mem1(start_addr):
-                return self.mem1._aligned_write(start_addr - self.address_base1, num_bytes, value)
-        else:
-            if self.check_mem1_fast(start_addr):
-                return self.mem1._aligned_write(start_addr, num_bytes, value)
-        if self.check_mem2(start_addr):
-            return self.mem2._aligned_write(start_addr - self.address_base2, num_bytes, value)
-        raise ValueError
+        index = self._find_region(start_addr)
+        if index < 0:
+            raise ValueError
+        return self.mems[index]._aligned_write(start_addr - self.bases[index], num_bytes, value)
+
+    def _region_chunk(self, addr, end):
+        index = self._find_region(addr)
+        if index < 0:
+            raise ValueError
+        chunk_end = self.ends[index]
+        if end < chunk_end:
+            chunk_end = end
+        return index, chunk_end
+
+    def read_bytes(self, start_addr, num_bytes):
+        res = StringBuilder(num_bytes)
+        addr = start_addr
+        end = start_addr + num_bytes
+        while addr < end:
+            index, chunk_end = self._region_chunk(addr, end)
+            res.append(self.mems[index].read_bytes(
+                addr - self.bases[index], intmask(chunk_end - addr)))
+            addr = chunk_end
+        return res.build()
+
+    def write_bytes(self, start_addr, data):
+        addr = start_addr
+        end = start_addr + len(data)
+        while addr < end:
+            index, chunk_end = self._region_chunk(addr, end)
+            start = intmask(addr - start_addr)
+            stop = intmask(chunk_end - start_addr)
+            assert start >= 0 and stop >= start
+            self.mems[index].write_bytes(addr - self.bases[index], data[start:stop])
+            addr = chunk_end
+
+    def fill(self, start_addr, num_bytes, byte=0):
+        addr = start_addr
+        end = start_addr + num_bytes
+        while addr < end:
+            index, chunk_end = self._region_chunk(addr, end)
+            self.mems[index].fill(addr - self.bases[index], intmask(chunk_end - addr), byte)
+            addr = chunk_end
 
     def close(self):
-        self.mem1.close()
-        self.mem2.close()
+        for mem in self.mems:
+            mem.close()
+
+    def set_smc_threshold(self, threshold):
+        for mem in self.mems:
+            mem.set_smc_threshold(threshold)
+
+    def page_invalidation_stats(self):
+        res = []
+        for index in range(len(self.mems)):
+            for addr, count, pinned in self.mems[index].page_invalidation_stats():
+                res.append((addr + self.bases[index], count, pinned))
+        return res
+
+    def set_dirty_tracking(self, enabled):
+        for mem in self.mems:
+            mem.set_dirty_tracking(enabled)
+
+    def dirty_pages(self):
+        res = []
+        for index in range(len(self.mems)):
+            for addr in self.mems[index].dirty_pages():
+                res.append(addr + self.bases[index])
+        return res
+
+    def reset_dirty_pages(self):
+        for mem in self.mems:
+            mem.reset_dirty_pages()
+
+    def set_block_cache_stats(self, enabled):
+        for mem in self.mems:
+            mem.set_block_cache_stats(enabled)
+
+    def block_cache_stats(self):
+        lookups = misses = 0
+        for mem in self.mems:
+            mem_lookups, mem_misses = mem.block_cache_stats()
+            lookups += mem_lookups
+            misses += mem_misses
+        return lookups, misses
 
     def memory_info(self):
-        return [(r_uint(self.address_base1), r_uint(self.address_end1)),
-                (r_uint(self.address_base2), r_uint(self.address_end2))]
+        return [(self.bases[index], self.ends[index])
+                for index in range(len(self.bases))]
+
+    def used_ranges(self):
+        res = []
+        for index in range(len(self.mems)):
+            ranges = self.mems[index].used_ranges()
+            if ranges is None:
+                return None
+            for start, end in ranges:
+                res.append((start + self.bases[index], end + self.bases[index]))
+        return res
+
+
+class SplitMemory(MemoryMap):
+    """ A MemoryMap with exactly two regions. """
+
+    def __init__(self, mem1, address_base1, size1, mem2, address_base2, size2):
+        MemoryMap.__init__(self, [(r_uint(address_base1), r_uint(size1), mem1),
+                                  (r_uint(address_base2), r_uint(size2), mem2)])
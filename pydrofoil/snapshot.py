@@ -0,0 +1,182 @@
+# Saving the complete state of an emulated machine to a file, and restoring it
+# later. The format is a simple binary one:
+#
+#   MAGIC, kind (a string naming the emulated architecture), followed by
+#   whatever the driver writes (its globals and the Sail registers), followed
+#   by the memory as a list of runs of non-zero pages:
+#   (start address, data)*, terminated by a run without data
+#
+# Integers are stored as 8 byte little endian words, strings and big integers
+# with their length in front. Pages that contain only zeroes are not stored,
+# so the size of a snapshot is proportional to the memory the guest actually
+# uses, not to the size of the emulated RAM.
+
+from rpython.rlib.rarithmetic import r_uint, intmask
+from rpython.rlib.rbigint import rbigint
+from rpython.rlib.rstring import StringBuilder
+
+MAGIC = "PYDROFOIL-SNAPSHOT-1\n"
+
+# memory is stored in units of PAGE_SIZE, runs of consecutive non-zero pages
+# are split after MAX_RUN_SIZE bytes
+PAGE_SIZE = 4096
+MAX_RUN_SIZE = 1024 * 1024
+ZERO_PAGE = "\x00" * PAGE_SIZE
+
+# the writer collects this many bytes before writing them to the file, the
+# reader reads this many bytes at once
+BUFFER_SIZE = 1024 * 1024
+
+
+class SnapshotError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+
+class SnapshotWriter(object):
+    def __init__(self, f, kind):
+        self.f = f
+        self.buffer = StringBuilder()
+        self.f.write(MAGIC)
+        self.write_str(kind)
+
+    def _flush_if_needed(self):
+        if self.buffer.getlength() >= BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        self.f.write(self.buffer.build())
+        self.buffer = StringBuilder()
+
+    def write_uint(self, value):
+        value = r_uint(value)
+        for i in range(8):
+            self.buffer.append(chr(intmask(value & 0xff)))
+            value >>= 8
+        self._flush_if_needed()
+
+    def write_int(self, value):
+        self.write_uint(r_uint(value))
+
+    def write_bool(self, value):
+        self.buffer.append(chr(int(value)))
+        self._flush_if_needed()
+
+    def write_str(self, data):
+        """ Write the string data, which can be None. """
+        if data is None:
+            self.write_int(-1)
+            return
+        self.write_int(len(data))
+        self.buffer.append(data)
+        self._flush_if_needed()
+
+    def write_bigint(self, rval):
+        # one more byte than needed for the bits, for the sign
+        num_bytes = rval.bit_length() // 8 + 1
+        self.write_str(rval.tobytes(num_bytes, "little", True))
+
+
+class SnapshotReader(object):
+    def __init__(self, f, kind):
+        self.f = f
+        self.buffer = ""
+        self.pos = 0
+        if self._read(len(MAGIC)) != MAGIC:
+            raise SnapshotError("not a snapshot file")
+        self.expect_str(kind, "emulator")
+
+    def _read(self, num_bytes):
+        if self.pos + num_bytes > len(self.buffer):
+            rest = self.buffer[self.pos:]
+            data = self.f.read(max(num_bytes - len(rest), BUFFER_SIZE))
+            self.buffer = rest + data
+            self.pos = 0
+            if num_bytes > len(self.buffer):
+                raise SnapshotError("snapshot file is truncated")
+        start = self.pos
+        self.pos += num_bytes
+        return self.buffer[start:self.pos]
+
+    def read_uint(self):
+        data = self._read(8)
+        value = r_uint(0)
+        for i in range(7, -1, -1):
+            value = (value << 8) | r_uint(ord(data[i]))
+        return value
+
+    def read_int(self):
+        return intmask(self.read_uint())
+
+    def read_bool(self):
+        return self._read(1) != "\x00"
+
+    def read_str(self):
+        length = self.read_int()
+        if length == -1:
+            return None
+        if length < 0:
+            raise SnapshotError("corrupted snapshot file")
+        return self._read(length)
+
+    def read_bigint(self):
+        data = self.read_str()
+        if data is None:
+            raise SnapshotError("corrupted snapshot file")
+        return rbigint.frombytes(data, "little", True)
+
+    def expect_str(self, expected, what):
+        """ Read a string and check that it is equal to expected. """
+        data = self.read_str()
+        if data != expected:
+            raise SnapshotError("snapshot was taken with a different %s" % (what, ))
+
+
+def save_memory(writer, mem):
+    """ Write the pages of mem that aren't all zeroes. Only the used_ranges of
+    mem are looked at, so that e.g. a huge lazily mmapped RAM isn't touched
+    page by page. """
+    ranges = mem.used_ranges()
+    if ranges is None:
+        raise SnapshotError("memory doesn't support snapshots")
+    for start, end in ranges:
+        run_start = start
+        run = StringBuilder()
+        addr = start
+        while addr < end:
+            size = intmask(min(r_uint(PAGE_SIZE), end - addr))
+            data = mem.read_bytes(addr, size)
+            if size == PAGE_SIZE:
+                is_zero = data == ZERO_PAGE
+            else:
+                is_zero = data == ZERO_PAGE[:size]
+            if is_zero or run.getlength() >= MAX_RUN_SIZE:
+                _write_run(writer, run_start, run)
+                run = StringBuilder()
+                run_start = addr
+            addr += size
+            if is_zero:
+                run_start = addr
+            else:
+                run.append(data)
+        _write_run(writer, run_start, run)
+    writer.write_uint(0)
+    writer.write_str("")
+
+def _write_run(writer, start, run):
+    if not run.getlength():
+        return
+    writer.write_uint(start)
+    writer.write_str(run.build())
+
+def load_memory(reader, mem):
+    """ Write the pages stored by save_memory back to mem. Pages that weren't
+    stored are not touched, so mem should contain only zeroes. """
+    while True:
+        start = reader.read_uint()
+        data = reader.read_str()
+        if data is None:
+            raise SnapshotError("corrupted snapshot file")
+        if not data:
+            break
+        mem.write_bytes(start, data)
@@ -1489,17 +1489,29 @@ def fast_read_mem_i_bv_i_isfetch(machine, addr_size, addr, n, isfetch):
     return mem.read(addr, n, executable_flag=isfetch)
 
 @jit.unroll_safe
-def _platform_read_mem_slowpath(machine, mem, read_kind, addr, n):
-    value = None
+def _read_mem_bytes(mem, addr, n):
+    # read n < 8 bytes, little endian
+    value = r_uint(0)
     for i in range(n - 1, -1, -1):
-        byteval = mem.read(addr + i, 1)
-        nextbyte = bitvector.SmallBitVector(8, byteval)
-        if value is None:
-            value = nextbyte
-        else:
-            value = value.append(nextbyte)
+        value = (value << 8) | mem.read(addr + i, 1)
     return value
 
+@jit.unroll_safe
+def _platform_read_mem_slowpath(machine, mem, read_kind, addr, n):
+    # accesses that are not 1, 2, 4 or 8 bytes wide. read whole 64-bit words
+    # and build the result from them directly
+    assert n > 0
+    if n < 8:
+        return bitvector.SmallBitVector(n * 8, _read_mem_bytes(mem, addr, n))
+    num_words = n >> 3
+    tail = n & 0b111
+    data = [r_uint(0)] * (num_words + bool(tail))
+    for i in range(num_words):
+        data[i] = mem.read(addr + i * 8, 8)
+    if tail:
+        data[num_words] = _read_mem_bytes(mem, addr + num_words * 8, tail)
+    return bitvector.GenericBitVector(n * 8, data)
+
 @unwrap("o o o i o")
 def platform_write_mem(machine, write_kind, addr_size, addr, n, data):
     assert addr_size in (64, 32)
@@ -1513,17 +1525,28 @@ def platform_write_mem(machine, write_kind, addr_size, addr, n, data):
     return True
 
 @jit.unroll_safe
-def _platform_write_mem_slowpath(machine, mem, write_kind, addr, n, data):
-    #if not objectmodel.we_are_translated():
-    #    import pdb; pdb.set_trace()
-    start = 0
-    stop = 7
+def _write_mem_bytes(mem, addr, n, value):
+    # write the n < 8 lowest bytes of value, little endian
     for i in range(n):
-        byte = data.subrange_unwrapped_res(stop, start)
-        mem.write(addr + i, 1, byte)
-        stop += 8
-        start += 8
-    assert start == data.size()
+        mem.write(addr + i, 1, value & 0xff)
+        value >>= 8
+
+@jit.unroll_safe
+def _platform_write_mem_slowpath(machine, mem, write_kind, addr, n, data):
+    # accesses that are not 1, 2, 4 or 8 bytes wide. write whole 64-bit words
+    assert n > 0
+    if n < 8:
+        _write_mem_bytes(mem, addr, n, data.touint())
+        return
+    num_words = n >> 3
+    tail = n & 0b111
+    for i in range(num_words):
+        word = data.subrange_unwrapped_res(i * 64 + 63, i * 64)
+        mem.write(addr + i * 8, 8, word)
+    if tail:
+        start = num_words * 64
+        value = data.subrange_unwrapped_res(start + tail * 8 - 1, start)
+        _write_mem_bytes(mem, addr + num_words * 8, tail, value)
 
 # isla stuff
 
@@ -1793,3 +1816,104 @@ def generate_convert_to_pypy_fvec(size, func):
         return space.newlist([func(space, el) for el in val])
     convert_to_pypy_fvec.__name__ += "_" + func.__name__
     return convert_to_pypy_fvec
+
+
+# saving and restoring the machine state (see pydrofoil/snapshot.py). like the
+# PyPy converters above, the code generator picks the functions per type
+
+@cache1
+def generate_snapshot_save_error(typname):
+    from pydrofoil.snapshot import SnapshotError
+    def snapshot_save_error(writer, val):
+        raise SnapshotError("values of type %s can't be saved" % (typname, ))
+    return snapshot_save_error
+
+@cache1
+def generate_snapshot_load_error(typname):
+    from pydrofoil.snapshot import SnapshotError
+    def snapshot_load_error(reader):
+        raise SnapshotError("values of type %s can't be loaded" % (typname, ))
+    return snapshot_load_error
+
+def snapshot_save_ruint(writer, val):
+    writer.write_uint(val)
+
+def snapshot_load_ruint(reader):
+    return reader.read_uint()
+
+@cache1
+def generate_snapshot_load_bitvector_ruint(width):
+    def c(reader):
+        return _mask(width, reader.read_uint())
+    c.func_name = "snapshot_load_bitvector_ruint_%s" % width
+    return c
+
+def snapshot_save_big_fixed_bitvector(writer, val):
+    writer.write_bigint(val.tobigint())
+
+@cache1
+def generate_snapshot_load_big_fixed_bitvector(width):
+    def c(reader):
+        return bitvector.from_bigint(width, reader.read_bigint())
+    c.func_name = "snapshot_load_big_fixed_bitvector_%s" % width
+    return c
+
+def snapshot_save_bitvector(writer, val):
+    writer.write_int(val.size())
+    writer.write_bigint(val.tobigint())
+
+def snapshot_load_bitvector(reader):
+    width = reader.read_int()
+    return bitvector.from_bigint(width, reader.read_bigint())
+
+def snapshot_save_machineint(writer, val):
+    writer.write_int(val)
+
+def snapshot_load_machineint(reader):
+    return reader.read_int()
+
+def snapshot_save_int(writer, val):
+    writer.write_bigint(val.tobigint())
+
+def snapshot_load_int(reader):
+    return Integer.from_bigint(reader.read_bigint())
+
+def snapshot_save_bool(writer, val):
+    writer.write_bool(val)
+
+def snapshot_load_bool(reader):
+    return reader.read_bool()
+
+def snapshot_save_unit(writer, val):
+    pass
+
+def snapshot_load_unit(reader):
+    return ()
+
+def snapshot_save_string(writer, val):
+    writer.write_str(val)
+
+def snapshot_load_string(reader):
+    return reader.read_str()
+
+@cache1
+def generate_snapshot_save_vec(func):
+    def snapshot_save_vec(writer, val):
+        if val is None:
+            writer.write_int(-1)
+            return
+        writer.write_int(len(val))
+        for el in val:
+            func(writer, el)
+    snapshot_save_vec.__name__ += "_" + func.__name__
+    return snapshot_save_vec
+
+@cache1
+def generate_snapshot_load_vec(func):
+    def snapshot_load_vec(reader):
+        length = reader.read_int()
+        if length == -1:
+            return None
+        return [func(reader) for i in range(length)][:]
+    snapshot_load_vec.__name__ += "_" + func.__name__
+    return snapshot_load_vec
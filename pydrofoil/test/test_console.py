@@ -0,0 +1,71 @@
+import os
+
+from pydrofoil import console
+
+
+def test_output_interactive(tmpdir):
+    path = tmpdir.join("out")
+    fd = os.open(str(path), os.O_WRONLY | os.O_CREAT)
+    out = console.ConsoleOutput(fd, buffer_size=8)
+    out.write_char("a")
+    out.write_char("b")
+    assert path.read() == ""
+    # flushed at a newline
+    out.write_char("\n")
+    assert path.read() == "ab\n"
+    out.write_char("c")
+    out.tick()
+    assert path.read() == "ab\nc"
+    # flushed when the buffer is full
+    for c in "012345678":
+        out.write_char(c)
+    assert path.read() == "ab\nc01234567"
+    out.close()
+    assert path.read() == "ab\nc012345678"
+    assert out.fd == -1
+
+
+def test_output_file(tmpdir):
+    path = tmpdir.join("out")
+    path.write("old content")
+    out = console.open_console_output(str(path))
+    assert path.read() == ""
+    out.write_char("a")
+    out.write_char("\n")
+    out.tick()
+    # a file is only written when the buffer is full
+    assert path.read() == ""
+    for i in range(console.OUTPUT_BUFFER_SIZE):
+        out.write_char("x")
+    assert path.size() == console.OUTPUT_BUFFER_SIZE
+    out.close()
+    assert path.read() == "a\n" + "x" * console.OUTPUT_BUFFER_SIZE
+
+
+def test_input_file(tmpdir, monkeypatch):
+    monkeypatch.setattr(console, "INPUT_CHUNK_SIZE", 2)
+    path = tmpdir.join("in")
+    path.write("ls\n")
+    inp = console.open_console_input(str(path))
+    assert not inp.needs_poll
+    assert [inp.read_char() for i in range(5)] == [ord("l"), ord("s"), ord("\n"), -1, -1]
+    inp.close()
+
+
+def test_input_pipe(monkeypatch):
+    monkeypatch.setattr(console, "INPUT_POLL_INTERVAL", 3)
+    rfd, wfd = os.pipe()
+    inp = console.ConsoleInput(rfd)
+    assert inp.needs_poll
+    # nothing there yet, this doesn't block
+    assert inp.read_char() == -1
+    os.write(wfd, "ab")
+    # the pipe is only polled again after INPUT_POLL_INTERVAL calls
+    assert [inp.read_char() for i in range(3)] == [-1, -1, -1]
+    assert inp.read_char() == ord("a")
+    assert inp.read_char() == ord("b")
+    os.close(wfd)
+    for i in range(4):
+        inp.read_char()
+    assert inp.eof
+    os.close(rfd)
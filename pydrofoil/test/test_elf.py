@@ -28,3 +28,119 @@ def test_elf_riscv32():
     assert section1.addr == 0x80000000
     assert section2.addr == 0x80001000
 
+
+def _load_segments(fn):
+    # reference: the PT_LOAD segments as (addr, content, memsz)
+    with open(fn, "rb") as f:
+        ehdr, is_64bit = elf.read_header(f)
+        res = []
+        for index in range(ehdr.phnum):
+            f.seek(ehdr.phoff + index * ehdr.phentsize)
+            phdr = elf.ElfProgramHeader(f.read(ehdr.phentsize), is_64bit)
+            if phdr.type != elf.ElfProgramHeader.PT_LOAD:
+                continue
+            f.seek(phdr.offset)
+            res.append((phdr.paddr, f.read(phdr.filesz), phdr.memsz))
+    return res
+
+def test_elf_read_process_image(monkeypatch):
+    from rpython.rlib.rarithmetic import r_uint
+    from pydrofoil import mem as mem_mod
+    # small chunks, to have more than one per segment
+    monkeypatch.setattr(elf, "LOAD_CHUNK_SIZE", 24)
+    for fn in [elffile, elffile32]:
+        segments = _load_segments(fn)
+        assert segments
+        m = mem_mod.BlockMemory()
+        for addr, content, memsz in segments:
+            # garbage, to check that the rest of the segment is zeroed
+            m.fill(r_uint(addr), memsz + 16, 0xff)
+        with open(fn, "rb") as f:
+            entry = elf.elf_read_process_image(m, f)
+        assert entry == 0x80000000
+        for addr, content, memsz in segments:
+            assert m.read_bytes(r_uint(addr), len(content)) == content
+            tail = memsz - len(content)
+            assert m.read_bytes(r_uint(addr + len(content)), tail) == "\x00" * tail
+            assert m.read_bytes(r_uint(addr + memsz), 16) == "\xff" * 16
+
+def test_elf_load():
+    from rpython.rlib.rarithmetic import r_uint
+    from pydrofoil import mem as mem_mod
+    for fn in [elffile, elffile32, os.path.join(toplevel, "riscv/input/dhrystone.riscv")]:
+        with open(fn, "rb") as f:
+            img = elf.elf_reader(f)
+        m1 = mem_mod.BlockMemory()
+        with open(fn, "rb") as f:
+            entry1 = elf.elf_read_process_image(m1, f)
+        m2 = mem_mod.BlockMemory()
+        with open(fn, "rb") as f:
+            entry2, img2 = elf.elf_load(m2, f)
+        assert entry1 == entry2
+        assert img2.symbols == img.symbols
+        assert img2.sections == []
+        assert "tohost" in img2.symbols
+        for addr, content, memsz in _load_segments(fn):
+            assert m2.read_bytes(r_uint(addr), memsz) == m1.read_bytes(r_uint(addr), memsz)
+
+def test_elf_load_strtab_at_end(tmpdir):
+    import struct
+    from pydrofoil import mem as mem_mod
+    # move the string table of the symbols behind the section headers
+    with open(elffile, "rb") as f:
+        data = f.read()
+    shoff, = struct.unpack("<Q", data[0x28:0x30])
+    shentsize, shnum = struct.unpack("<HH", data[0x3a:0x3e])
+    shdrs = [data[shoff + i * shentsize:shoff + (i + 1) * shentsize] for i in range(shnum)]
+    symtab, = [shdr for shdr in shdrs if struct.unpack("<I", shdr[4:8])[0] == 2]
+    strtab_index, = struct.unpack("<I", symtab[0x28:0x2c])
+    strtab = shdrs[strtab_index]
+    offset, size = struct.unpack("<QQ", strtab[0x18:0x28])
+    assert offset < shoff
+    strtab = strtab[:0x18] + struct.pack("<Q", len(data)) + strtab[0x20:]
+    shdrs[strtab_index] = strtab
+    data = (data[:shoff] + "".join(shdrs) + data[shoff + shnum * shentsize:] +
+            data[offset:offset + size])
+    path = tmpdir.join("strtab_at_end.elf")
+    path.write(data, mode="wb")
+    with open(elffile, "rb") as f:
+        img = elf.elf_reader(f)
+    with open(str(path), "rb") as f:
+        entry, img2 = elf.elf_load(mem_mod.BlockMemory(), f)
+    assert img2.symbols == img.symbols
+
+def test_symbol_index():
+    from rpython.rlib.rarithmetic import r_uint
+    entries = [(r_uint(0x100), r_uint(0x10), "f"),
+               (r_uint(0x80), r_uint(0), "label"),
+               (r_uint(0x200), r_uint(0), "alias"),
+               (r_uint(0x200), r_uint(0x20), "g"),
+               (r_uint(0x300), r_uint(0), "end")]
+    index = elf.SymbolIndex(entries)
+    assert index.names == ["label", "f", "g", "end"]
+    assert index.lookup(r_uint(0x7f)) == ("", 0)
+    assert index.lookup(r_uint(0x80)) == ("label", 0)
+    assert index.lookup(r_uint(0xff)) == ("label", 0x7f)
+    assert index.lookup(r_uint(0x10f)) == ("f", 0xf)
+    # after the end of f
+    assert index.lookup(r_uint(0x110)) == ("", 0)
+    assert index.lookup(r_uint(0x21f)) == ("g", 0x1f)
+    assert index.lookup(r_uint(0x220)) == ("", 0)
+    assert index.lookup(r_uint(0x12345)) == ("end", 0x12045)
+    assert index.format_address(r_uint(0x100)) == "f"
+    assert index.format_address(r_uint(0x104)) == "f+0x4"
+    assert index.format_address(r_uint(0x110)) == ""
+    assert len(elf.SymbolIndex([])) == 0
+    assert elf.SymbolIndex([]).find(r_uint(0x100)) == -1
+
+def test_symbol_index_elf():
+    from rpython.rlib.rarithmetic import r_uint
+    with open(os.path.join(toplevel, "riscv/input/dhrystone.riscv"), "rb") as f:
+        img = elf.elf_reader(f)
+    index = img.get_symbol_index()
+    assert index.format_address(r_uint(0x8000217c)) == "Proc_1"
+    assert index.format_address(r_uint(0x8000218a)) == "Proc_1+0xe"
+    with open(elffile, "rb") as f:
+        img = elf.elf_reader(f)
+    index = img.get_symbol_index()
+    assert index.format_address(r_uint(0x80000008)) == "trap_vector+0x4"
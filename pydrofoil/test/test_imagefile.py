@@ -0,0 +1,124 @@
+import os
+import gzip
+import zlib
+import random
+
+import pytest
+
+from rpython.rlib import rzlib
+from rpython.rlib.rarithmetic import r_uint
+
+from pydrofoil import imagefile, elf, mem as mem_mod
+
+toplevel = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+elffile = os.path.join(toplevel, "riscv/input/rv64ui-p-addi.elf")
+
+def make_data(size):
+    rng = random.Random(size)
+    # compressible, but not trivially
+    return "".join(chr(rng.randrange(16)) for i in range(size))
+
+def write_gzip(path, data):
+    f = gzip.open(str(path), "wb")
+    f.write(data)
+    f.close()
+
+def test_is_compressed():
+    assert imagefile.is_compressed("\x1f\x8b")
+    assert imagefile.is_compressed(zlib.compress("abc")[:2])
+    assert imagefile.is_compressed(zlib.compress("abc", 9)[:2])
+    assert not imagefile.is_compressed("\x7fE")
+    assert not imagefile.is_compressed("\xd0\x0d")
+    assert not imagefile.is_compressed("M")
+
+def test_open_image_plain(tmpdir):
+    path = tmpdir.join("plain")
+    path.write("abcdefgh", mode="wb")
+    f = imagefile.open_image(str(path))
+    assert isinstance(f, imagefile.PlainImageFile)
+    assert f.read(3) == "abc"
+    f.seek(6)
+    assert f.read(100) == "gh"
+    f.close()
+
+@pytest.mark.parametrize("kind", ["gzip", "zlib"])
+def test_compressed_read_seek(tmpdir, monkeypatch, kind):
+    monkeypatch.setattr(imagefile, "CHUNK_SIZE", 1000)
+    data = make_data(4000)
+    path = tmpdir.join("image")
+    if kind == "gzip":
+        write_gzip(path, data)
+    else:
+        path.write(zlib.compress(data), mode="wb")
+    f = imagefile.open_image(str(path))
+    assert isinstance(f, imagefile.CompressedImageFile)
+    assert f.read(5) == data[:5]
+    assert f.read(2500) == data[5:2505]
+    # backwards in the current chunk
+    f.seek(2100)
+    assert f.read(10) == data[2100:2110]
+    # forwards
+    f.seek(3777)
+    assert f.read(3000) == data[3777:]
+    assert f.read(10) == ""
+    # backwards before the current chunk
+    f.seek(123)
+    assert f.read(1000) == data[123:1123]
+    f.seek(0)
+    assert f.read(5000) == data
+    f.close()
+
+def test_compressed_truncated(tmpdir):
+    path = tmpdir.join("image.gz")
+    compressed = zlib.compress(make_data(4000))
+    path.write(compressed[:len(compressed) // 2], mode="wb")
+    f = imagefile.open_image(str(path))
+    with pytest.raises(rzlib.RZlibError):
+        f.read(4000)
+    f.close()
+
+def test_load_raw(tmpdir, monkeypatch):
+    monkeypatch.setattr(imagefile, "CHUNK_SIZE", 256)
+    data = make_data(1001)
+    path = tmpdir.join("image.gz")
+    write_gzip(path, data)
+    m = mem_mod.BlockMemory()
+    f = imagefile.open_image(str(path))
+    assert imagefile.load_raw(m, r_uint(0x1003), f) == len(data)
+    f.close()
+    assert m.read_bytes(r_uint(0x1003), len(data)) == data
+
+def test_elf_load_compressed(tmpdir, monkeypatch):
+    monkeypatch.setattr(imagefile, "CHUNK_SIZE", 4096)
+    with open(elffile, "rb") as f:
+        data = f.read()
+    path = tmpdir.join("elf.gz")
+    write_gzip(path, data)
+    m1 = mem_mod.BlockMemory()
+    with open(elffile, "rb") as f:
+        entry1, img1 = elf.elf_load(m1, f)
+    m2 = mem_mod.BlockMemory()
+    f = imagefile.open_image(str(path))
+    entry2, img2 = elf.elf_load(m2, f)
+    f.close()
+    assert entry1 == entry2
+    assert img1.symbols == img2.symbols
+    assert m2.read_bytes(r_uint(0x80000000), 0x2000) == m1.read_bytes(r_uint(0x80000000), 0x2000)
+
+def test_elf_load_compressed_single_pass(tmpdir, monkeypatch):
+    monkeypatch.setattr(imagefile, "CHUNK_SIZE", 256)
+    starts = []
+    orig_start = imagefile.CompressedImageFile._start
+    def _start(self):
+        starts.append(self.tell() if self.stream else None)
+        orig_start(self)
+    monkeypatch.setattr(imagefile.CompressedImageFile, "_start", _start)
+    path = tmpdir.join("elf.gz")
+    with open(elffile, "rb") as f:
+        write_gzip(path, f.read())
+    f = imagefile.open_image(str(path))
+    entry, img = elf.elf_load(mem_mod.BlockMemory(), f)
+    f.close()
+    assert "tohost" in img.symbols
+    # the file was never decompressed from the start again
+    assert starts == [None]
@@ -339,3 +339,70 @@ files "x.sail"
     support_code = "from pydrofoil.test.nand2tetris import supportcodenand as supportcode"
     res = parse_and_make_code(s, support_code)
     assert "machine._reg_zPC = r_uint(0xcafeL)" in res
+
+def test_register_snapshot(tmpdir):
+    import py
+    from pydrofoil import snapshot
+    from pydrofoil.bitvector import Integer
+    s = """
+struct zpair {
+  zfirst: %bv8,
+  zsecond: %i
+}
+
+union zoption {
+  zNone: %unit,
+  zSome: %struct zpair
+}
+
+register zPC : %bv16
+
+register zcount : %i
+
+register zflag : %bool
+
+register zlast : %union zoption
+
+register zregs : %vec(%bv64)
+
+val zinitializze_registers : (%unit) ->  %unit
+
+fn zinitializze_registers(zgsz32) {
+  return = () `1;
+  end;
+}
+
+files "x.sail"
+
+"""
+    support_code = "from pydrofoil.test.nand2tetris import supportcodenand as supportcode"
+    res = parse_and_make_code(s, support_code)
+    d = {}
+    exec py.code.Source(res).compile() in d
+    Machine = d['Machine']
+    assert [name for name, _, _ in Machine._all_register_snapshot] == [
+        'PC', 'count', 'flag', 'last', 'regs']
+    machine = Machine()
+    machine._reg_zPC = rarithmetic.r_uint(0xcafe)
+    (machine._reg_zcount_val_or_sign, machine._reg_zcount_data) = Integer.fromlong(-(1 << 80)).pack()
+    machine._reg_zflag = True
+    pair = d['Struct_zpair'](rarithmetic.r_uint(0x17), Integer.fromint(5).pack())
+    machine._reg_zlast = d['Union_zoption_zSome'](pair)
+    machine._reg_zregs = [rarithmetic.r_uint(1), rarithmetic.r_uint(2)]
+
+    path = str(tmpdir.join("snap"))
+    with open(path, "wb") as f:
+        writer = snapshot.SnapshotWriter(f, "test")
+        for name, save, load in Machine._all_register_snapshot:
+            save(machine, writer)
+        writer.flush()
+    machine2 = Machine()
+    with open(path, "rb") as f:
+        reader = snapshot.SnapshotReader(f, "test")
+        for name, save, load in Machine._all_register_snapshot:
+            load(machine2, reader)
+    assert machine2._reg_zPC == 0xcafe
+    assert Integer.unpack(machine2._reg_zcount_val_or_sign, machine2._reg_zcount_data).tobigint().tolong() == -(1 << 80)
+    assert machine2._reg_zflag is True
+    assert machine2._reg_zlast.eq(machine._reg_zlast)
+    assert machine2._reg_zregs == [1, 2]
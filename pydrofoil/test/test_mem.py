@@ -6,6 +6,7 @@ import random
 from collections import defaultdict
 from pydrofoil import mem
 from rpython.rlib.rarithmetic import r_uint, intmask
+from rpython.rtyper.lltypesystem import rffi
 
 from hypothesis import given, assume, strategies, settings
 from hypothesis.stateful import Bundle, RuleBasedStateMachine, rule, initialize
@@ -63,6 +64,31 @@ def test_tag_write_read():
                 assert mem.read_tag_bit(addr) == data[offset]
     mem.close()
 
+@pytest.mark.parametrize("memcls", [TagTBM, mem.TaggedFlatMemory])
+def test_clear_count_tags(memcls):
+    m = memcls()
+    model = [False] * 1024
+    for i in range(len(model)):
+        if random.randrange(3) == 0:
+            model[i] = True
+            m.write_tag_bit(r_uint(i), True)
+    assert m.count_tags(r_uint(0), r_uint(1024)) == sum(model)
+    for start, length in [(0, 0), (0, 64), (3, 5), (5, 200), (63, 2),
+                          (64, 128), (100, 17), (500, 524)]:
+        assert m.count_tags(r_uint(start), r_uint(length)) == sum(model[start:start + length])
+    for start, length in [(5, 3), (60, 10), (128, 64), (300, 333)]:
+        m.clear_tags(r_uint(start), r_uint(length))
+        for i in range(start, start + length):
+            model[i] = False
+        for i in range(len(model)):
+            assert m.read_tag_bit(r_uint(i)) == model[i]
+        assert m.count_tags(r_uint(0), r_uint(1024)) == sum(model)
+    m.close()
+
+def test_popcount():
+    for x in [0, 1, 0b1011, r_uint(-1), r_uint(0x8000000000000001)]:
+        assert mem.popcount(r_uint(x)) == bin(x).count("1")
+
 
 ints = strategies.integers(-sys.maxint-1, sys.maxint)
 uints = strategies.builds(
@@ -148,54 +174,221 @@ class FlatMemComparison(MemComparison):
 TestFlatMem = FlatMemComparison.TestCase
 
 
+def statuses(m, num_words=2 * mem.FlatMemory.WORDS_PER_PAGE):
+    return [m.get_status(i) for i in range(num_words)]
+
+@pytest.mark.skipif(not hasattr(rffi, "UNSIGNEDP"), reason="needs rffi.UNSIGNEDP")
+def test_mmap_memory():
+    m = mem.TaggedFlatMemory(True, 1024 * 1024, 0x80000000)
+    assert m.read(0x80000000, 8) == 0
+    assert m.read(0x800ffff8, 8) == 0
+    m.write(0x80000010, 8, r_uint(0x0a1b2c3d4e5f6789))
+    assert m.read(0x80000010, 8) == 0x0a1b2c3d4e5f6789
+    assert m.read(0x80000012, 2) == 0x4e5f
+    assert not m.read_tag_bit(0x80000010)
+    m.write_tag_bit(0x80000010, True)
+    assert m.read_tag_bit(0x80000010)
+    m.write_tag_bit(0x800fffff, True)
+    assert m.count_tags(0x80000000, 1024 * 1024) == 2
+    m.clear_tags(0x80000000, 1024 * 1024)
+    assert m.count_tags(0x80000000, 1024 * 1024) == 0
+    m.close()
+    # closing twice is fine
+    m.close()
+
+@pytest.mark.skipif(not hasattr(rffi, "UNSIGNEDP"), reason="needs rffi.UNSIGNEDP")
+def test_mmap_image_private(tmpdir):
+    image = tmpdir.join("image.bin")
+    image.write("".join(chr(i) for i in range(16)) + "abc", "wb")
+    m = mem.FlatMemory(True, 0x10000, image=str(image))
+    assert m.read(0, 8) == 0x0706050403020100
+    assert m.read(8, 8) == 0x0f0e0d0c0b0a0908
+    assert m.read(16, 4) == 0x636261
+    # after the end of the file the memory is zero
+    assert m.read(0x20, 8) == 0
+    assert m.read(0xfff8, 8) == 0
+    m.write(0, 8, r_uint(0x1122334455667788))
+    m.write(0x20, 8, r_uint(0x17))
+    assert m.read(0, 8) == 0x1122334455667788
+    assert m.read(0x20, 8) == 0x17
+    m.close()
+    # the file is not changed
+    assert image.read("rb") == "".join(chr(i) for i in range(16)) + "abc"
+
+@pytest.mark.skipif(not hasattr(rffi, "UNSIGNEDP"), reason="needs rffi.UNSIGNEDP")
+def test_mmap_image_shared(tmpdir):
+    image = tmpdir.join("image.bin")
+    image.write("\x00" * 16, "wb")
+    m = mem.FlatMemory(True, 0x1000, image=str(image), shared=True)
+    m.write(8, 4, r_uint(0x64636261))
+    m.close()
+    assert image.read("rb") == "\x00" * 8 + "abcd" + "\x00" * 4
+
+@pytest.mark.skipif(not hasattr(rffi, "UNSIGNEDP"), reason="needs rffi.UNSIGNEDP")
+def test_mmap_image_used_ranges(tmpdir):
+    image = tmpdir.join("image.bin")
+    image.write("a" * 0x1800, "wb")
+    m = mem.FlatMemory(True, 0x10000, image=str(image), track_dirty=True)
+    m.write(0x1ff8, 8, r_uint(1))
+    m.write(0x5000, 8, r_uint(1))
+    assert m.used_ranges() == [(0, 0x2000), (0x5000, 0x6000)]
+    m.close()
+
+@pytest.mark.skipif(not hasattr(rffi, "UNSIGNEDP"), reason="needs rffi.UNSIGNEDP")
+def test_mmap_image_missing(tmpdir):
+    with pytest.raises(OSError):
+        mem.FlatMemory(True, 0x1000, image=str(tmpdir.join("missing.bin")))
+
 def test_invalidation_logic():
     m = mem.FlatMemory()
     m.write(0, 8, 0x0a1b2c3d4e5f6789)
     m.write(8, 8, 0xdeaddeaddeaddead)
     assert m._aligned_read(0, 8, False) == 0x0a1b2c3d4e5f6789
-    assert set(m.status) == {mem.MEM_STATUS_NORMAL}
-    v1 = m.version
+    assert set(statuses(m)) == {mem.MEM_STATUS_NORMAL}
+    v1 = m._get_version(0)
 
     assert m._aligned_read(0, 8, True) == 0x0a1b2c3d4e5f6789
-    v2 = m.version
+    v2 = m._get_version(0)
     # going from normal -> immutable does not change version
     assert v1 is v2
-    assert m.status[0] == mem.MEM_STATUS_IMMUTABLE
-    assert set(m.status[1:]) == {mem.MEM_STATUS_NORMAL}
+    assert statuses(m)[0] == mem.MEM_STATUS_IMMUTABLE
+    assert set(statuses(m)[1:]) == {mem.MEM_STATUS_NORMAL}
 
     assert m._aligned_read(8, 8, True) == 0xdeaddeaddeaddead
-    v3 = m.version
+    v3 = m._get_version(0)
     assert v2 is v3
-    assert m.status[:2] == [mem.MEM_STATUS_IMMUTABLE] * 2
-    assert set(m.status[2:]) == {mem.MEM_STATUS_NORMAL}
+    assert statuses(m)[:2] == [mem.MEM_STATUS_IMMUTABLE] * 2
+    assert set(statuses(m)[2:]) == {mem.MEM_STATUS_NORMAL}
 
     m.write(8, 8, 0xdeaddeaddeaddead) # same value!
-    v3 = m.version
+    v3 = m._get_version(0)
     assert v2 is v3
-    assert m.status[:2] == [mem.MEM_STATUS_IMMUTABLE] * 2
-    assert set(m.status[2:]) == {mem.MEM_STATUS_NORMAL}
+    assert statuses(m)[:2] == [mem.MEM_STATUS_IMMUTABLE] * 2
+    assert set(statuses(m)[2:]) == {mem.MEM_STATUS_NORMAL}
 
     for val in [1, 2, 3, 4]:
         m.write(8, 8, val) # different value!
-        assert m.status[:2] == [mem.MEM_STATUS_IMMUTABLE, mem.MEM_STATUS_MUTABLE]
-        assert set(m.status[2:]) == {mem.MEM_STATUS_NORMAL}
-    v4 = m.version
+        assert statuses(m)[:2] == [mem.MEM_STATUS_IMMUTABLE, mem.MEM_STATUS_MUTABLE]
+        assert set(statuses(m)[2:]) == {mem.MEM_STATUS_NORMAL}
+    v4 = m._get_version(0)
     assert v4 is not v3
 
     # re-reading as executable does not change the status
     assert m._aligned_read(8, 8, True) == 4
-    assert m.status[:2] == [mem.MEM_STATUS_IMMUTABLE, mem.MEM_STATUS_MUTABLE]
-    assert set(m.status[2:]) == {mem.MEM_STATUS_NORMAL}
-    v5 = m.version
+    assert statuses(m)[:2] == [mem.MEM_STATUS_IMMUTABLE, mem.MEM_STATUS_MUTABLE]
+    assert set(statuses(m)[2:]) == {mem.MEM_STATUS_NORMAL}
+    v5 = m._get_version(0)
     assert v4 is v5
 
     # writing to a normal word does not change the status or the version
     m._aligned_write(16, 8, 0x17)
-    assert m.status[:2] == [mem.MEM_STATUS_IMMUTABLE, mem.MEM_STATUS_MUTABLE]
-    assert set(m.status[2:]) == {mem.MEM_STATUS_NORMAL}
-    v6 = m.version
+    assert statuses(m)[:2] == [mem.MEM_STATUS_IMMUTABLE, mem.MEM_STATUS_MUTABLE]
+    assert set(statuses(m)[2:]) == {mem.MEM_STATUS_NORMAL}
+    v6 = m._get_version(0)
     assert v4 is v6
 
+def test_status_bitmaps():
+    m = mem.FlatMemory()
+    # no status is stored for pages that never contained code
+    assert m.code_pages == [None] * len(m.code_pages)
+    m.write(0x2008, 8, 0x17)
+    assert m.code_pages == [None] * len(m.code_pages)
+    assert m._aligned_read(0x2008, 8, True) == 0x17
+    page = m.code_pages[2]
+    assert [i for i, p in enumerate(m.code_pages) if p is not None] == [2]
+    assert len(page.immutable_bits) == len(page.mutable_bits) == mem.FlatMemory.WORDS_PER_PAGE // 64
+    assert page.immutable_bits[0] == 0b10
+    assert m.get_status(0x2008 // 8) == mem.MEM_STATUS_IMMUTABLE
+    assert m.get_status(0x2010 // 8) == mem.MEM_STATUS_NORMAL
+    m.write(0x2008, 8, 0x18)
+    assert page.immutable_bits[0] == 0
+    assert page.mutable_bits[0] == 0b10
+    assert m.get_status(0x2008 // 8) == mem.MEM_STATUS_MUTABLE
+    # last word of the page
+    assert m._aligned_read(0x2ff8, 8, True) == 0
+    assert page.immutable_bits[-1] == r_uint(1) << 63
+    assert m.get_status(0x2ff8 // 8) == mem.MEM_STATUS_IMMUTABLE
+    assert m.get_status(0x3000 // 8) == mem.MEM_STATUS_NORMAL
+
+def test_invalidation_per_page():
+    m = mem.FlatMemory()
+    page_size = 1 << m.PAGE_BITS
+    for page in range(3):
+        m.write(page * page_size, 8, 0x1234)
+        assert m.read(page * page_size, 8, True) == 0x1234
+    assert m.num_code_pages == 3
+    versions = [m._get_version(page << m.WORDS_PER_PAGE_BITS) for page in range(3)]
+
+    # writing code in page 1 only changes the version of page 1
+    m.write(page_size, 8, 0x5678)
+    assert m._get_version(0) is versions[0]
+    assert m._get_version(1 << m.WORDS_PER_PAGE_BITS) is not versions[1]
+    assert m._get_version(2 << m.WORDS_PER_PAGE_BITS) is versions[2]
+    # the other two code pages survived the invalidation
+    assert m.invalidation_count == 1
+    assert m.invalidation_survivors == 2
+
+    # all words of a page share the version
+    assert m._get_version((1 << m.WORDS_PER_PAGE_BITS) + 17) is m._get_version(1 << m.WORDS_PER_PAGE_BITS)
+
+    # the other pages still read immutably
+    read_offsets = []
+    def _immutable_read(offset, v):
+        read_offsets.append(offset)
+        return m.mem[offset]
+    m._immutable_read = _immutable_read
+    assert m.read(0, 8, True) == 0x1234
+    assert m.read(2 * page_size, 8, True) == 0x1234
+    assert m.read(page_size, 8, True) == 0x5678
+    assert read_offsets == [0, 2 << m.WORDS_PER_PAGE_BITS]
+
+def test_smc_threshold_pins_page():
+    m = mem.FlatMemory()
+    m.set_smc_threshold(3)
+    page_size = 1 << m.PAGE_BITS
+    m.write(0, 8, 0x1234)
+    m.read(0, 8, True)
+    for i in range(3):
+        # each time the code is executed and then modified
+        assert m.read(page_size + 8 * i, 8, True) == 0
+        m.write(page_size + 8 * i, 8, i + 1)
+    assert m.invalidation_count == 3
+    assert m.num_pinned_pages == 1
+    assert m.page_invalidation_stats() == [(page_size, 3, True)]
+    # the words of the pinned page don't become immutable any more
+    assert m.read(page_size, 8, True) == 1
+    assert m.get_status(page_size // 8) == mem.MEM_STATUS_MUTABLE
+    assert m.read(page_size + 64, 8, True) == 0
+    assert m.get_status((page_size + 64) // 8) == mem.MEM_STATUS_NORMAL
+    version = m._get_version(page_size // 8)
+    m.write(page_size + 64, 8, 5)
+    assert m._get_version(page_size // 8) is version
+    assert m.invalidation_count == 3
+    # other pages are not affected
+    assert m.get_status(0) == mem.MEM_STATUS_IMMUTABLE
+
+def test_smc_threshold_disabled():
+    m = mem.FlatMemory()
+    m.set_smc_threshold(0)
+    for i in range(100):
+        m.read(0, 8, True)
+        m.write(0, 8, i + 1)
+        m.code_pages[0].immutable_bits[0] = r_uint(0)
+        m.code_pages[0].mutable_bits[0] = r_uint(0)
+    assert m.invalidation_count == 100
+    assert m.num_pinned_pages == 0
+    assert m.page_invalidation_stats() == [(0, 100, False)]
+
+def test_split_memory_invalidation_stats():
+    mem1 = mem.FlatMemory(False, 0x1000)
+    mem2 = mem.FlatMemory(False, 0x10000)
+    m = mem.SplitMemory(mem1, 0, 0x1000, mem2, 0x80000000, 0x10000)
+    m.set_smc_threshold(1)
+    assert mem1.smc_threshold == mem2.smc_threshold == 1
+    m.read(0x80002000, 8, True)
+    m.write(0x80002000, 8, 1)
+    assert m.page_invalidation_stats() == [(0x80002000, 1, True)]
+
 
 def test_immutable_reads():
     m = mem.FlatMemory()
@@ -222,26 +415,405 @@ def test_immutable_reads():
     assert m.read(0, 8, True) == 17
     assert read_offsets == []
 
+@pytest.mark.parametrize("memcls", [TBM, TagTBM])
+def test_block_invalidation_logic(memcls):
+    m = memcls()
+    block_size = m.BLOCK_SIZE
+    m.write(0, 8, 0x0a1b2c3d4e5f6789)
+    m.write(block_size, 8, 0x1234)
+    assert m.read(0, 8, True) == 0x0a1b2c3d4e5f6789
+    assert m.read(block_size, 8, True) == 0x1234
+    assert m.get_status(0) == mem.MEM_STATUS_IMMUTABLE
+    assert m.get_status(8) == mem.MEM_STATUS_NORMAL
+    assert m.num_code_pages == 2
+    block0 = m._get_block(r_uint(0))
+    block1 = m._get_block(r_uint(1))
+    v0 = m._get_version(block0)
+    v1 = m._get_version(block1)
+
+    # writing the same value or to a normal word does not invalidate
+    m.write(0, 8, 0x0a1b2c3d4e5f6789)
+    m.write(8, 8, 0x17)
+    assert m._get_version(block0) is v0
+    assert m.invalidation_count == 0
+
+    # a partial write of an executed word invalidates only its block
+    m.write(2, 2, 0xffff)
+    assert m.get_status(0) == mem.MEM_STATUS_MUTABLE
+    assert m._get_version(block0) is not v0
+    assert m._get_version(block1) is v1
+    assert m.invalidation_count == 1
+    assert m.invalidation_survivors == 1
+    assert m.read(0, 8, True) == 0x0a1b2c3dffff6789
+    assert m.get_status(0) == mem.MEM_STATUS_MUTABLE
+
+def test_block_immutable_reads():
+    m = TBM()
+    m.write(0, 8, 0x0a1b2c3d4e5f6789)
+    m.write(8, 8, 0xdeaddeaddeaddead)
+    assert m.read(0, 8, True) == 0x0a1b2c3d4e5f6789
+
+    read_offsets = []
+    def _immutable_read(block, offset, v):
+        read_offsets.append((block.block_addr, offset))
+        return block.data[offset]
+    m._immutable_read = _immutable_read
+    assert m.read(0, 8, True) == 0x0a1b2c3d4e5f6789
+    assert m.read(8, 8, True) == 0xdeaddeaddeaddead
+    assert m.read(m.BLOCK_SIZE, 8, True) == 0
+    assert read_offsets == [(0, 0), (0, 1), (1, 0)]
+
+    # but not if its mutable
+    del read_offsets[:]
+    m.write(0, 8, 17)
+    assert m.read(0, 8, True) == 17
+    assert read_offsets == []
+
+def test_block_smc_threshold():
+    m = TBM()
+    m.set_smc_threshold(2)
+    m.read(0, 8, True)
+    m.read(8, 8, True)
+    m.write(0, 8, 1)
+    m.write(8, 8, 1)
+    assert m.page_invalidation_stats() == [(0, 2, True)]
+    assert m.num_pinned_pages == 1
+    m.read(16, 8, True)
+    assert m.get_status(16) == mem.MEM_STATUS_NORMAL
+
+def test_memory_map():
+    regions = [
+        (0x80000000, 0x2000, mem.FlatMemory(False, 0x2000)),
+        (0x1000, 0x1000, mem.FlatMemory(False, 0x1000)),
+        (0x90000000, 0x100, mem.FlatMemory(False, 0x100)),
+        (0, 0x1000, mem.FlatMemory(False, 0x1000)),
+        (0x10000000, 0x1000, TBM()),
+    ]
+    m = mem.MemoryMap(regions)
+    assert m.memory_info() == [(0, 0x1000), (0x1000, 0x2000),
+                               (0x10000000, 0x10001000),
+                               (0x80000000, 0x80002000),
+                               (0x90000000, 0x90000100)]
+    for base, size, submem in regions:
+        for offset in [0, 8, size - 8]:
+            addr = r_uint(base + offset)
+            m.write(addr, 8, addr + 1)
+            assert submem.read(r_uint(offset), 8) == addr + 1
+            assert m.read(addr, 8) == addr + 1
+            assert m.read(addr, 4, True) == (addr + 1) & 0xffffffff
+    for addr in [0x2000, 0x10001000, 0x7ffffff8, 0x80002000, 0x90000100,
+                 r_uint(-8)]:
+        with pytest.raises(ValueError):
+            m.read(r_uint(addr), 8)
+        with pytest.raises(ValueError):
+            m.write(r_uint(addr), 8, r_uint(0))
+
+def test_memory_map_find_region():
+    bases = [r_uint(i * 0x1000) for i in range(7)]
+    m = mem.MemoryMap([(base, 0x800, mem.FlatMemory(False, 0x800)) for base in bases])
+    for i, base in enumerate(bases):
+        assert m._find_region(base) == i
+        assert m._find_region(base + 0x7f8) == i
+        assert m._find_region(base + 0x800) == -1
+    assert m._find_region(r_uint(0x7000)) == -1
+
+def test_memory_map_overlap():
+    with pytest.raises(AssertionError):
+        mem.MemoryMap([(0, 0x2000, mem.FlatMemory(False, 0x2000)),
+                       (0x1000, 0x1000, mem.FlatMemory(False, 0x1000))])
+
+@pytest.mark.parametrize("memcls", [TBM, TagTBM, mem.FlatMemory, mem.TaggedFlatMemory])
+def test_bulk_operations(memcls):
+    m = memcls()
+    model = ["\x00"] * 512
+    data = "".join(chr(random.randrange(256)) for i in range(300))
+    for start in [0, 1, 7, 8, 13]:
+        for length in [0, 1, 5, 8, 9, 17, 300]:
+            chunk = data[start:start + length]
+            m.write_bytes(r_uint(start), chunk)
+            model[start:start + len(chunk)] = list(chunk)
+            assert m.read_bytes(r_uint(start), length) == "".join(model[start:start + length])
+            assert "".join(chr(m.read(r_uint(i), 1)) for i in range(512)) == "".join(model)
+            m.fill(r_uint(start + 3), length, 0x5a)
+            model[start + 3:start + 3 + length] = ["\x5a"] * length
+            assert m.read_bytes(r_uint(0), 512) == "".join(model)
+    m.fill(r_uint(0), 512)
+    assert m.read_bytes(r_uint(0), 512) == "\x00" * 512
+
+def test_bulk_write_invalidates():
+    m = mem.FlatMemory()
+    m.write(0x1000, 8, 0x17)
+    m.read(0x1000, 8, True)
+    version = m._get_version(0x1000 // 8)
+    m.write_bytes(r_uint(0x1000), "\x17\x00\x00\x00\x00\x00\x00\x00")
+    assert m._get_version(0x1000 // 8) is version
+    m.write_bytes(r_uint(0xffe), "abcdefghijkl")
+    assert m._get_version(0x1000 // 8) is not version
+    assert m.get_status(0x1000 // 8) == mem.MEM_STATUS_MUTABLE
+    assert m.read_bytes(r_uint(0xffe), 12) == "abcdefghijkl"
+    m.read(0x2000, 8, True)
+    m.fill(r_uint(0x1ffc), 16, 0)
+    assert m.invalidation_count == 1
+    m.fill(r_uint(0x1ffc), 16, 1)
+    assert m.invalidation_count == 2
+
+def test_block_bulk_write():
+    m = TBM()
+    data = "".join(chr(random.randrange(256)) for i in range(3 * TBM.BLOCK_SIZE))
+    m.write_bytes(r_uint(4), data)
+    assert len(m.blocks) == 4
+    assert m.read_bytes(r_uint(4), len(data)) == data
+    for i in range(0, 3 * TBM.BLOCK_SIZE - 8, 8):
+        assert m.read(r_uint(8 + i), 8) == mem.word_from_string(data, 4 + i)
+
+    # filling whole blocks with zeroes doesn't allocate them
+    m.fill(r_uint(0x10000), 4 * TBM.BLOCK_SIZE)
+    assert len(m.blocks) == 4
+    m.fill(r_uint(0), 3 * TBM.BLOCK_SIZE)
+    assert m.read_bytes(r_uint(0), 3 * TBM.BLOCK_SIZE + 4) == "\x00" * (3 * TBM.BLOCK_SIZE) + data[-4:]
+
+def test_block_bulk_write_invalidates():
+    m = TBM()
+    m.write(TBM.BLOCK_SIZE + 8, 8, 0x17)
+    m.read(TBM.BLOCK_SIZE + 8, 8, True)
+    block = m._get_block(r_uint(1))
+    version = m._get_version(block)
+    m.write_bytes(r_uint(TBM.BLOCK_SIZE + 8), "\x17\x00\x00\x00\x00\x00\x00\x00")
+    assert m._get_version(block) is version
+    m.write_bytes(r_uint(0), "a" * (2 * TBM.BLOCK_SIZE))
+    assert m._get_version(block) is not version
+    assert m.invalidation_count == 1
+    assert m.read(TBM.BLOCK_SIZE + 8, 8) == mem.word_from_string("a" * 8, 0)
+
+    m.set_dirty_tracking(True)
+    m.fill(r_uint(3 * TBM.BLOCK_SIZE), TBM.BLOCK_SIZE, 1)
+    m.write_bytes(r_uint(5 * TBM.BLOCK_SIZE), "b" * 16)
+    assert m.dirty_pages() == [r_uint(3 * TBM.BLOCK_SIZE), r_uint(5 * TBM.BLOCK_SIZE)]
+
+def test_memory_map_bulk_operations():
+    mem1 = mem.FlatMemory(False, 0x1000)
+    mem2 = TBM()
+    m = mem.MemoryMap([(0, 0x1000, mem1), (0x1000, 0x1000, mem2)])
+    m.write_bytes(r_uint(0xffc), "abcdefgh")
+    assert mem1.read_bytes(r_uint(0xffc), 4) == "abcd"
+    assert mem2.read_bytes(r_uint(0), 4) == "efgh"
+    assert m.read_bytes(r_uint(0xffa), 12) == "\x00\x00abcdefgh\x00\x00"
+    m.fill(r_uint(0xffe), 4, ord("x"))
+    assert m.read_bytes(r_uint(0xffc), 8) == "abxxxxgh"
+    with pytest.raises(ValueError):
+        m.read_bytes(r_uint(0x1ffc), 8)
+    with pytest.raises(ValueError):
+        m.fill(r_uint(0x2000), 8)
+
+@pytest.mark.parametrize("memcls", [TBM, TagTBM, mem.FlatMemory])
+def test_unaligned_accesses(memcls):
+    m = memcls()
+    model = [random.randrange(256) for i in range(64)]
+    for i, byte in enumerate(model):
+        m.write(r_uint(i), 1, r_uint(byte))
+    def model_read(addr, num_bytes):
+        res = 0
+        for i in range(num_bytes - 1, -1, -1):
+            res = (res << 8) | model[addr + i]
+        return res
+    for num_bytes in [2, 4, 8]:
+        for addr in range(1, 48):
+            if addr % num_bytes == 0:
+                continue
+            assert m.read(r_uint(addr), num_bytes) == model_read(addr, num_bytes)
+            value = random.randrange(1 << (num_bytes * 8))
+            m.write(r_uint(addr), num_bytes, r_uint(value))
+            for i in range(num_bytes):
+                model[addr + i] = (value >> (i * 8)) & 0xff
+            for i in range(64):
+                assert m.read(r_uint(i), 1) == model[i]
+
+def test_unaligned_write_invalidation():
+    m = mem.FlatMemory()
+    m.write(8, 8, 0x1122334455667788)
+    assert m.read(8, 8, True) == 0x1122334455667788
+    # unaligned write that keeps the executed word unchanged
+    m.write(6, 4, 0x77880000)
+    assert m.invalidation_count == 0
+    assert m.get_status(1) == mem.MEM_STATUS_IMMUTABLE
+    m.write(14, 4, 0x12345678)
+    assert m.invalidation_count == 1
+    assert m.read(8, 8) == 0x5678334455667788
+    assert m.read(16, 8) == 0x1234
+
 def test_block_caching():
     m = TBM()
-    assert m.last_block_addr == r_uint(-1)
+    assert m.cache_addrs == [r_uint(-1)] * TBM.BLOCK_CACHE_SIZE
     m.write(r_uint(8), 8, r_uint(0x0102030405060708))
-    assert m.last_block_addr == r_uint(0)
-    assert m.last_block[8 >> 3] == r_uint(0x0102030405060708)
-    block1 = m.last_block
-
-    m.write(r_uint(0x10000008), 8, r_uint(0xfa11))
-    assert m.last_block_addr == r_uint(0x200000)
-    assert m.last_block[8 >> 3] == r_uint(0xfa11)
-    block2 = m.last_block
-    assert block2 is not block1
+    assert m.cache_addrs[0] == r_uint(0)
+    block1 = m.cache_blocks[0]
+    assert block1.data[8 >> 3] == r_uint(0x0102030405060708)
+
+    # a different cache entry
+    m.write(r_uint(0x10000088), 8, r_uint(0xfa11))
+    assert m.cache_addrs[1] == r_uint(0x200001)
+    block2 = m.cache_blocks[1]
+    assert block2.data[8 >> 3] == r_uint(0xfa11)
+    assert m.cache_blocks[0] is block1
+
+    # the same cache entry as block1
+    m.write(r_uint(0x808), 8, r_uint(0xbeef))
+    assert m.cache_addrs[0] == r_uint(0x10)
+    block3 = m.cache_blocks[0]
+    assert block3 is not block1
 
     assert m.read(r_uint(8), 8, False) == r_uint(0x0102030405060708)
-    assert m.last_block_addr == r_uint(0)
-    assert m.last_block is block1
-
-    assert m.read(r_uint(0x10000008), 8, True) == r_uint(0xfa11)
-    assert m.last_block_addr == r_uint(0)
-    assert m.last_block is block1
-    assert m.last_block_addr_executable == r_uint(0x200000)
-    assert m.last_block_executable is block2
+    assert m.cache_addrs[0] == r_uint(0)
+    assert m.cache_blocks[0] is block1
+
+    assert m.read(r_uint(0x10000088), 8, True) == r_uint(0xfa11)
+    assert m.cache_addrs[0] == r_uint(0)
+    assert m.cache_blocks[0] is block1
+    assert m.cache_addrs_executable[1] == r_uint(0x200001)
+    assert m.cache_blocks_executable[1] is block2
+
+def test_block_cache_stats():
+    m = TBM()
+    m.read(r_uint(0), 8)
+    assert m.block_cache_stats() == (0, 0)
+    m.set_block_cache_stats(True)
+    # 16 blocks fit into the cache
+    for i in range(10):
+        for block_index in range(TBM.BLOCK_CACHE_SIZE):
+            m.write(r_uint(block_index * TBM.BLOCK_SIZE), 8, r_uint(i))
+    lookups, misses = m.block_cache_stats()
+    assert lookups == 10 * TBM.BLOCK_CACHE_SIZE
+    assert misses == TBM.BLOCK_CACHE_SIZE - 1
+    m.set_block_cache_stats(False)
+    assert m.block_cache_stats() == (0, 0)
+
+@pytest.mark.parametrize("memcls", [TBM, TagTBM, mem.FlatMemory])
+def test_dirty_pages(memcls):
+    m = memcls()
+    m.write(r_uint(0x1008), 8, r_uint(1))
+    # tracking is off by default
+    assert m.dirty_pages() == []
+    m.set_dirty_tracking(True)
+    m.write(r_uint(0x1008), 8, r_uint(2))
+    m.write(r_uint(0x3001), 1, r_uint(3))
+    m.write_bytes(r_uint(0x5ffe), "abcd")
+    if memcls is TBM:
+        # the blocks are smaller than a page
+        assert m.dirty_pages() == [0x1000, 0x3000, 0x5f80, 0x6000]
+    elif memcls is TagTBM:
+        assert m.dirty_pages() == [0x1000, 0x3000, 0x5ff0, 0x6000]
+    else:
+        assert m.dirty_pages() == [0x1000, 0x3000, 0x5000, 0x6000]
+    m.reset_dirty_pages()
+    assert m.dirty_pages() == []
+    m.read(r_uint(0x1008), 8)
+    assert m.dirty_pages() == []
+    m.set_dirty_tracking(False)
+    m.write(r_uint(0x1008), 8, r_uint(2))
+    assert m.dirty_pages() == []
+
+@pytest.mark.parametrize("memcls", [TagTBM, mem.TaggedFlatMemory])
+def test_dirty_pages_tags(memcls):
+    m = memcls()
+    m.set_dirty_tracking(True)
+    m.write_tag_bit(r_uint(0x2010), True)
+    assert len(m.dirty_pages()) == 1
+    assert m.dirty_pages()[0] <= 0x2010
+    m.reset_dirty_pages()
+    # clearing tags that are not set doesn't dirty anything
+    m.clear_tags(r_uint(0x4000), r_uint(0x100))
+    assert m.dirty_pages() == []
+    m.clear_tags(r_uint(0x2000), r_uint(0x100))
+    assert len(m.dirty_pages()) == 1
+
+def test_memory_map_dirty_pages():
+    m1 = mem.FlatMemory(False, 0x10000)
+    m2 = mem.FlatMemory(False, 0x10000)
+    m = mem.MemoryMap([(r_uint(0x80000000), r_uint(0x10000), m2),
+                       (r_uint(0x1000), r_uint(0x10000), m1)])
+    m.set_dirty_tracking(True)
+    m.write(r_uint(0x80002000), 8, r_uint(1))
+    m.write(r_uint(0x1000), 8, r_uint(1))
+    assert m.dirty_pages() == [0x1000, 0x80002000]
+    m.reset_dirty_pages()
+    assert m.dirty_pages() == []
+
+def test_used_ranges_flat():
+    m = mem.FlatMemory(False, 0x10000)
+    m.write(r_uint(0x1008), 8, r_uint(1))
+    # without dirty tracking, everything could be used
+    assert m.used_ranges() == [(0, 0x10000)]
+    m = mem.FlatMemory(False, 0x10000, track_dirty=True)
+    assert m.used_ranges() == []
+    m.write(r_uint(0x1008), 8, r_uint(1))
+    m.write_bytes(r_uint(0x2ffe), "abcd")
+    m.write(r_uint(0xfff8), 8, r_uint(1))
+    # consecutive pages are merged
+    assert m.used_ranges() == [(0x1000, 0x4000), (0xf000, 0x10000)]
+    # pages written before the reset are still used
+    m.reset_dirty_pages()
+    assert m.dirty_pages() == []
+    assert m.used_ranges() == [(0x1000, 0x4000), (0xf000, 0x10000)]
+    # writes aren't tracked anymore
+    m.set_dirty_tracking(False)
+    assert m.used_ranges() == [(0, 0x10000)]
+
+def test_used_ranges_block_memory_map():
+    m1 = mem.FlatMemory(False, 0x10000)
+    m2 = TBM()
+    m = mem.MemoryMap([(r_uint(0x80000000), r_uint(0x100000), m2),
+                       (r_uint(0x1000), r_uint(0x10000), m1)])
+    m.write(r_uint(0x80000000 + 5 * TBM.BLOCK_SIZE + 8), 8, r_uint(1))
+    m.write(r_uint(0x80000000 + 2 * TBM.BLOCK_SIZE), 8, r_uint(1))
+    # reads don't allocate blocks
+    m.read(r_uint(0x80000000 + 7 * TBM.BLOCK_SIZE), 8)
+    assert m.used_ranges() == [
+        (0x1000, 0x11000),
+        (0x80000000 + 2 * TBM.BLOCK_SIZE, 0x80000000 + 3 * TBM.BLOCK_SIZE),
+        (0x80000000 + 5 * TBM.BLOCK_SIZE, 0x80000000 + 6 * TBM.BLOCK_SIZE)]
+
+def test_block_zero_block():
+    m = TBM()
+    for i in range(100):
+        assert m.read(r_uint(i * 0x1000 + 8), 8) == 0
+    # reads don't allocate blocks
+    assert m.blocks == {}
+    assert m.cache_blocks[0] is m.zero_block
+    m.write(r_uint(0x5008), 4, r_uint(0x1234))
+    assert len(m.blocks) == 1
+    assert m.cache_blocks[m._cache_index(r_uint(0x5008) >> TBM.ADDRESS_BITS_BLOCK)] is not m.zero_block
+    assert m.read(r_uint(0x5008), 8) == 0x1234
+    assert m.zero_block.data == [r_uint(0)] * (TBM.BLOCK_SIZE // 8)
+    assert m.memory_info() == [(r_uint(0x5000), r_uint(0x5000 + TBM.BLOCK_SIZE))]
+
+    # allocating the block outside of the write path (e.g. for constant
+    # addresses in the JIT) updates the cache
+    assert m.read(r_uint(0x9000), 8) == 0
+    assert m.cache_blocks[m._cache_index(r_uint(0x9000) >> TBM.ADDRESS_BITS_BLOCK)] is m.zero_block
+    m._get_block(r_uint(0x9000) >> TBM.ADDRESS_BITS_BLOCK).data[0] = r_uint(5)
+    assert m.read(r_uint(0x9000), 8) == 5
+
+def test_tag_zero_block():
+    m = TagTBM()
+    for i in range(100):
+        assert not m.read_tag_bit(r_uint(i * 0x1000))
+    assert m.count_tags(r_uint(0), r_uint(0x100000)) == 0
+    m.clear_tags(r_uint(0), r_uint(0x100000))
+    assert m.tag_blocks == {}
+    m.write_tag_bit(r_uint(0x3004), True)
+    assert len(m.tag_blocks) == 1
+    assert m.read_tag_bit(r_uint(0x3004))
+    assert m.zero_tags == [r_uint(0)]
+
+@pytest.mark.parametrize("bits", mem.BLOCK_SIZE_BITS)
+def test_block_memory_sizes(bits):
+    m = mem.block_memory(bits)
+    assert m.BLOCK_SIZE == 2 ** bits
+    m.write(r_uint(0x123458), 8, r_uint(1))
+    assert m.memory_info() == [(r_uint(0x123458) & ~r_uint(m.BLOCK_MASK),
+                                (r_uint(0x123458) & ~r_uint(m.BLOCK_MASK)) + m.BLOCK_SIZE)]
+    m = mem.block_memory(bits, tagged=True)
+    assert isinstance(m, mem.TaggedBlockMemory)
+    assert m.BLOCK_SIZE == 2 ** bits
+    with pytest.raises(ValueError):
+        mem.block_memory(13)
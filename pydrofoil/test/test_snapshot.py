@@ -0,0 +1,135 @@
+import pytest
+
+from rpython.rlib.rarithmetic import r_uint
+from rpython.rlib.rbigint import rbigint
+
+from pydrofoil import snapshot, mem as mem_mod
+
+class TBM(mem_mod.BlockMemory):
+    ADDRESS_BITS_BLOCK = 14
+    BLOCK_SIZE = 2 ** ADDRESS_BITS_BLOCK
+    BLOCK_MASK = BLOCK_SIZE - 1
+
+def reader_for(path, kind="test"):
+    return snapshot.SnapshotReader(open(str(path), "rb"), kind)
+
+def test_write_read_values(tmpdir):
+    path = tmpdir.join("snap")
+    with open(str(path), "wb") as f:
+        w = snapshot.SnapshotWriter(f, "test")
+        w.write_uint(r_uint(0xdeadbeefcafe))
+        w.write_int(-5)
+        w.write_bool(True)
+        w.write_bool(False)
+        w.write_str("abc")
+        w.write_str(None)
+        w.write_str("")
+        for value in [0, 1, -1, 255, -256, 1 << 100, -(3 << 90)]:
+            w.write_bigint(rbigint.fromlong(value))
+        w.flush()
+    with open(str(path), "rb") as f:
+        r = snapshot.SnapshotReader(f, "test")
+        assert r.read_uint() == 0xdeadbeefcafe
+        assert r.read_int() == -5
+        assert r.read_bool() is True
+        assert r.read_bool() is False
+        assert r.read_str() == "abc"
+        assert r.read_str() is None
+        assert r.read_str() == ""
+        for value in [0, 1, -1, 255, -256, 1 << 100, -(3 << 90)]:
+            assert r.read_bigint().tolong() == value
+        with pytest.raises(snapshot.SnapshotError):
+            r.read_uint()
+
+def test_read_wrong_kind(tmpdir):
+    path = tmpdir.join("snap")
+    with open(str(path), "wb") as f:
+        snapshot.SnapshotWriter(f, "riscv64").flush()
+    with pytest.raises(snapshot.SnapshotError) as excinfo:
+        reader_for(path, "riscv32")
+    assert excinfo.value.msg == "snapshot was taken with a different emulator"
+    path.write("garbage", mode="wb")
+    with pytest.raises(snapshot.SnapshotError):
+        reader_for(path, "riscv64")
+
+def test_buffering(tmpdir, monkeypatch):
+    monkeypatch.setattr(snapshot, "BUFFER_SIZE", 16)
+    path = tmpdir.join("snap")
+    with open(str(path), "wb") as f:
+        w = snapshot.SnapshotWriter(f, "test")
+        for i in range(100):
+            w.write_uint(r_uint(i))
+            w.write_str("x" * i)
+        w.flush()
+    with open(str(path), "rb") as f:
+        r = snapshot.SnapshotReader(f, "test")
+        for i in range(100):
+            assert r.read_uint() == i
+            assert r.read_str() == "x" * i
+
+def small_flat_memory():
+    return mem_mod.FlatMemory(False, 0x30000)
+
+@pytest.mark.parametrize("memcls", [TBM, small_flat_memory])
+def test_save_load_memory(tmpdir, monkeypatch, memcls):
+    monkeypatch.setattr(snapshot, "MAX_RUN_SIZE", 2 * snapshot.PAGE_SIZE)
+    m = memcls()
+    m.write_bytes(r_uint(0x10), "abc")
+    m.write_bytes(r_uint(0x2ff8), "x" * (4 * snapshot.PAGE_SIZE))
+    m.write(r_uint(0x20000), 8, r_uint(0x1234))
+    path = tmpdir.join("snap")
+    with open(str(path), "wb") as f:
+        w = snapshot.SnapshotWriter(f, "test")
+        snapshot.save_memory(w, m)
+        w.flush()
+    # only the non-zero pages are stored
+    assert path.size() < 8 * snapshot.PAGE_SIZE
+
+    m2 = memcls()
+    with open(str(path), "rb") as f:
+        snapshot.load_memory(snapshot.SnapshotReader(f, "test"), m2)
+    assert m2.read_bytes(r_uint(0), 0x30000) == m.read_bytes(r_uint(0), 0x30000)
+
+def test_save_memory_only_used_ranges(tmpdir, monkeypatch):
+    m = mem_mod.FlatMemory(False, 0x100000, track_dirty=True)
+    m.write_bytes(r_uint(0x3000), "abc")
+    m.write(r_uint(0x80000), 8, r_uint(0))
+    reads = []
+    orig_read_bytes = m.read_bytes
+    def read_bytes(start_addr, num_bytes):
+        reads.append(start_addr)
+        return orig_read_bytes(start_addr, num_bytes)
+    m.read_bytes = read_bytes
+    path = tmpdir.join("snap")
+    with open(str(path), "wb") as f:
+        w = snapshot.SnapshotWriter(f, "test")
+        snapshot.save_memory(w, m)
+        w.flush()
+    # the pages that were never written to aren't read
+    assert reads == [0x3000, 0x80000]
+    m2 = mem_mod.FlatMemory(False, 0x100000)
+    with open(str(path), "rb") as f:
+        snapshot.load_memory(snapshot.SnapshotReader(f, "test"), m2)
+    assert m2.read_bytes(r_uint(0), 0x100000) == m.read_bytes(r_uint(0), 0x100000)
+
+def test_save_memory_map(tmpdir):
+    mem1 = mem_mod.FlatMemory(False, 0x1000)
+    mem2 = TBM()
+    m = mem_mod.MemoryMap([(r_uint(0), r_uint(0x1000), mem1),
+                           (r_uint(0x80000000), r_uint(0x10000), mem2)])
+    m.write(r_uint(0x8), 8, r_uint(17))
+    m.write(r_uint(0x80001000), 8, r_uint(42))
+    path = tmpdir.join("snap")
+    with open(str(path), "wb") as f:
+        w = snapshot.SnapshotWriter(f, "test")
+        snapshot.save_memory(w, m)
+        w.flush()
+    mem3 = TBM()
+    m2 = mem_mod.MemoryMap([(r_uint(0), r_uint(0x1000), mem_mod.FlatMemory(False, 0x1000)),
+                            (r_uint(0x80000000), r_uint(0x10000), mem3)])
+    with open(str(path), "rb") as f:
+        snapshot.load_memory(snapshot.SnapshotReader(f, "test"), m2)
+    assert m2.read(r_uint(0x8), 8) == 17
+    assert m2.read(r_uint(0x80001000), 8) == 42
+    # the zero pages of the block memory weren't allocated
+    assert len(mem3.blocks) == 1
@@ -1256,6 +1256,27 @@ def test_platform_write_mem_large():
     assert res.tobigint().tolong() == 0xe1c4a990796451403124191009040100L
     assert res.size() == 128
 
+@pytest.mark.parametrize("n", [3, 7, 16, 21, 32, 64])
+@pytest.mark.parametrize("offset", [0, 1, 5, 8])
+def test_platform_read_write_mem_wide(n, offset):
+    m = FakeMachine()
+    value = 0
+    for i in range(n):
+        value |= ((i * 37 + 11) & 0xff) << (i * 8)
+    addr = bitvector.from_ruint(64, r_uint(0x80000000 + offset))
+    supportcode.platform_write_mem(
+        m, "write", 64, addr, Integer.fromint(n),
+        bitvector.from_bigint(n * 8, rbigint.fromlong(value)))
+    # check the individual bytes
+    for i in range(n):
+        assert m.g.mem.read(r_uint(0x80000000 + offset + i), 1) == (value >> (i * 8)) & 0xff
+    assert m.g.mem.read(r_uint(0x80000000 + offset + n), 1) == 0
+    res = supportcode.platform_read_mem(m, "read", 64, addr, Integer.fromint(n))
+    assert res.size() == n * 8
+    assert res.tobigint().tolong() == value
+    if n > 8:
+        assert isinstance(res, GenericBitVector)
+
 #section for test file for sparse bitvectors
 
 
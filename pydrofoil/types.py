@@ -14,6 +14,8 @@ def unique(cls):
         instances[args] = res
         res.convert_to_pypy = "supportcode.generate_convert_to_pypy_error(%r)" % (cls.__name__ + str(id(res)))
         res.convert_from_pypy = "supportcode.generate_convert_from_pypy_error(%r)" % (cls.__name__ + str(id(res)))
+        res.snapshot_save = "supportcode.generate_snapshot_save_error(%r)" % (cls.__name__, )
+        res.snapshot_load = "supportcode.generate_snapshot_load_error(%r)" % (cls.__name__, )
         return res
     cls.__new__ = staticmethod(__new__)
     return cls
@@ -24,6 +26,10 @@ def singleton(cls):
         cls._INSTANCE.convert_to_pypy = "supportcode.generate_convert_to_pypy_error(%r)" % (cls.__name__ + str(id(cls._INSTANCE)))
     if not hasattr(cls._INSTANCE, 'convert_from_pypy'):
         cls._INSTANCE.convert_from_pypy = "supportcode.generate_convert_from_pypy_error(%r)" % (cls.__name__ + str(id(cls._INSTANCE)))
+    if not hasattr(cls._INSTANCE, 'snapshot_save'):
+        cls._INSTANCE.snapshot_save = "supportcode.generate_snapshot_save_error(%r)" % (cls.__name__, )
+    if not hasattr(cls._INSTANCE, 'snapshot_load'):
+        cls._INSTANCE.snapshot_load = "supportcode.generate_snapshot_load_error(%r)" % (cls.__name__, )
 
     def __new__(cls):
         return cls._INSTANCE
@@ -46,6 +52,8 @@ class Union(Type):
         self.demangled_name = demangle(name)
         self.convert_to_pypy = 'convert_to_pypy_%s' % name
         self.convert_from_pypy = 'convert_from_pypy_%s' % name
+        self.snapshot_save = 'snapshot_save_%s' % name
+        self.snapshot_load = 'snapshot_load_%s' % name
         self.names = names
         self.names_list = [demangle(name) for name in names]
         self.typs = typs
@@ -140,6 +148,8 @@ class Vec(Type):
         self.typ = typ
         self.convert_from_pypy = "supportcode.generate_convert_from_pypy_vec(%s)" % (typ.convert_from_pypy, )
         self.convert_to_pypy = "supportcode.generate_convert_to_pypy_vec(%s)" % (typ.convert_to_pypy, )
+        self.snapshot_save = "supportcode.generate_snapshot_save_vec(%s)" % (typ.snapshot_save, )
+        self.snapshot_load = "supportcode.generate_snapshot_load_vec(%s)" % (typ.snapshot_load, )
 
     def sail_repr(self):
         return "vector(?, %s)" % (self.typ.sail_repr(), )
@@ -157,6 +167,8 @@ class FVec(Type):
         self.typ = typ
         self.convert_from_pypy = "supportcode.generate_convert_from_pypy_fvec(%s, %s)" % (number, typ.convert_from_pypy, )
         self.convert_to_pypy = "supportcode.generate_convert_to_pypy_fvec(%s, %s)" % (number, typ.convert_to_pypy, )
+        self.snapshot_save = "supportcode.generate_snapshot_save_vec(%s)" % (typ.snapshot_save, )
+        self.snapshot_load = "supportcode.generate_snapshot_load_vec(%s)" % (typ.snapshot_load, )
 
     def sail_repr(self):
         return "vector(%s, %s)" % (self.number, self.typ.sail_repr())
@@ -227,6 +239,8 @@ class SmallFixedBitVector(FixedBitVector):
         self.width = width
         self.convert_to_pypy = "supportcode.generate_convert_to_pypy_bitvector_ruint(%s)" % width
         self.convert_from_pypy = "supportcode.generate_convert_from_pypy_bitvector_ruint(%s)" % width
+        self.snapshot_save = "supportcode.snapshot_save_ruint"
+        self.snapshot_load = "supportcode.generate_snapshot_load_bitvector_ruint(%s)" % width
 
     def sail_repr(self):
         return "bits(%s)" % (self.width, )
@@ -245,6 +259,8 @@ class BigFixedBitVector(FixedBitVector):
         self.uninitialized_value = "bitvector.SparseBitVector(%s, r_uint(0))" % width
         self.convert_to_pypy = "supportcode.generate_convert_to_pypy_big_fixed_bitvector(%s)" % width
         self.convert_from_pypy = "supportcode.generate_convert_from_pypy_big_fixed_bitvector(%s)" % width
+        self.snapshot_save = "supportcode.snapshot_save_big_fixed_bitvector"
+        self.snapshot_load = "supportcode.generate_snapshot_load_big_fixed_bitvector(%s)" % width
 
     def sail_repr(self):
         return "bits(%s)" % (self.width, )
@@ -258,6 +274,8 @@ class GenericBitVector(Type):
     uninitialized_value = "bitvector.UNITIALIZED_BV"
     convert_to_pypy = "supportcode.convert_to_pypy_bitvector"
     convert_from_pypy = "supportcode.convert_from_pypy_bitvector"
+    snapshot_save = "supportcode.snapshot_save_bitvector"
+    snapshot_load = "supportcode.snapshot_load_bitvector"
 
     def sail_repr(self):
         return 'bits(?)'
@@ -270,6 +288,8 @@ class MachineInt(Type):
     uninitialized_value = "-0xfefe"
     convert_to_pypy = "supportcode.convert_to_pypy_machineint"
     convert_from_pypy = "supportcode.convert_from_pypy_machineint"
+    snapshot_save = "supportcode.snapshot_save_machineint"
+    snapshot_load = "supportcode.snapshot_load_machineint"
 
 
     def sail_repr(self):
@@ -283,6 +303,8 @@ class Int(Type):
     uninitialized_value = "UninitInt"
     convert_to_pypy = "supportcode.convert_to_pypy_int"
     convert_from_pypy = "supportcode.convert_from_pypy_int"
+    snapshot_save = "supportcode.snapshot_save_int"
+    snapshot_load = "supportcode.snapshot_load_int"
 
     def __repr__(self):
         return "%s()" % (type(self).__name__, )
@@ -292,6 +314,8 @@ class Bool(Type):
     uninitialized_value = "False"
     convert_to_pypy = "supportcode.convert_to_pypy_bool"
     convert_from_pypy = "supportcode.convert_from_pypy_bool"
+    snapshot_save = "supportcode.snapshot_save_bool"
+    snapshot_load = "supportcode.snapshot_load_bool"
 
     def __repr__(self):
         return "%s()" % (type(self).__name__, )
@@ -304,6 +328,8 @@ class Unit(Type):
     uninitialized_value = "()"
     convert_to_pypy = "supportcode.convert_to_pypy_unit"
     convert_from_pypy = "supportcode.convert_from_pypy_unit"
+    snapshot_save = "supportcode.snapshot_save_unit"
+    snapshot_load = "supportcode.snapshot_load_unit"
 
     def sail_repr(self):
         return 'unit'
@@ -318,6 +344,8 @@ class String(Type):
     uninitialized_value = "None"
     convert_to_pypy = "supportcode.convert_to_pypy_string"
     convert_from_pypy = "supportcode.convert_from_pypy_string"
+    snapshot_save = "supportcode.snapshot_save_string"
+    snapshot_load = "supportcode.snapshot_load_string"
 
     def sail_repr(self):
         return 'string'
@@ -126,6 +126,19 @@ class GDBServer:
         machine.register_callback("memory_write", handle_mem_write)
         machine.register_callback("memory_read", handle_mem_read)
         
+    def describe_address(self, addr: int) -> str:
+        """
+        Format `addr` together with the ELF symbol it belongs to, if any.
+        """
+        lookup_symbol = getattr(self.machine, "lookup_symbol", None)
+        symbol = lookup_symbol(addr) if lookup_symbol is not None else None
+        if symbol is None:
+            return hex(addr)
+        name, offset = symbol
+        if offset:
+            return "%s <%s+%#x>" % (hex(addr), name, offset)
+        return "%s <%s>" % (hex(addr), name)
+
     def handle(self, packet: bytes) -> bytes:
         packet = _parse_gdb_packet(packet)
         if packet.command == "?":
@@ -138,19 +151,12 @@ class GDBServer:
 
     @arguments("hex,hex")
     def m(self, addr: int, length: int) -> bytes:
-        memory = bytearray()
-        for i in range(length):
-            value = self.machine.read_memory(addr + i, 1)
-            memory += _int2hex(value, 1)
-
-        return _make_packet(bytes(memory))
+        memory = self.machine.read_memory_bytes(addr, length)
+        return _make_packet(memory.hex().encode("ascii"))
 
     @arguments("hex,hex,bytes")
     def M(self, addr: int, length: int, data: bytes) -> bytes:
-        for i in range(length):
-            value = _hex2int(data[i*2:i*2+2])
-            self.machine.write_memory(addr + i, value, 1)
-
+        self.machine.write_memory_bytes(addr, bytes.fromhex(data[:length*2].decode("ascii")))
         return _make_packet(b"OK")
 
     @arguments("*hex")
@@ -174,6 +180,7 @@ class GDBServer:
             addr = self.machine.read_register("pc")
             if addr in self.breakpoints or self.hit_watchpoint:
                 break
+        print("STOPPED AT:", self.describe_address(addr))
 
         return _make_packet(b"S05") # TODO is this the correct reply?
 
@@ -51,9 +51,9 @@ def test_handle_m():
         def __init__(self):
             self.addrs = []
 
-        def read_memory(self, addr, width):
-            self.addrs.append(addr)
-            return 1
+        def read_memory_bytes(self, addr, length):
+            self.addrs.append((addr, length))
+            return b"\x01" * length
         
         def register_callback(self, event, callback):
             pass
@@ -62,7 +62,7 @@ def test_handle_m():
     server = GDBServer(machine)
     resp = server.handle(b"$m10,5#2f")
     assert resp == b"+$0101010101#e5"
-    assert machine.addrs == [16, 17, 18, 19, 20]
+    assert machine.addrs == [(16, 5)]
 
 def test_handle_M():
     class DummyMachine:
@@ -70,9 +70,9 @@ def test_handle_M():
             self.addrs = []
             self.values = []
 
-        def write_memory(self, addr, value, width):
+        def write_memory_bytes(self, addr, data):
             self.addrs.append(addr)
-            self.values.append(value)
+            self.values.append(data)
 
         def register_callback(self, event, callback):
             pass
@@ -81,8 +81,8 @@ def test_handle_M():
     server = GDBServer(machine)
     resp = server.handle(b"$M10,5:0102030405#38")
     assert resp == b"+$OK#9a"
-    assert machine.addrs == [16, 17, 18, 19, 20]
-    assert machine.values == [1, 2, 3, 4, 5]
+    assert machine.addrs == [16]
+    assert machine.values == [b"\x01\x02\x03\x04\x05"]
 
 def test_handle_s():
     class DummyMachine:
@@ -301,4 +301,19 @@ def test_poll_socket():
     assert socket.msgs[0][2:-3] == b"S05"
     assert socket.msgs[1][2:-3] == b"S05"
     assert socket.msgs[2][2:-3] == b"S05"
-    assert machine.pc == 3
\ No newline at end of file
+    assert machine.pc == 3
+
+
+def test_describe_address():
+    class DummyMachine:
+        def lookup_symbol(self, addr):
+            if addr >= 0x80000000:
+                return ("main", addr - 0x80000000)
+            return None
+
+        def register_callback(self, event, callback):
+            pass
+    server = GDBServer(DummyMachine())
+    assert server.describe_address(0x80000000) == "0x80000000 <main>"
+    assert server.describe_address(0x80000010) == "0x80000010 <main+0x10>"
+    assert server.describe_address(0x1000) == "0x1000"
@@ -457,11 +457,14 @@ class MachineAbstractBase(object):
         if dtb:
             self.machine.g._create_dtb()
         init_mem(space, self.machine, MemoryObserver)
+        # the emulated memory is mmapped, unmap it when the machine dies
+        self.register_finalizer(space)
         if w_callbacks:
             mem = ApplevelCallbackMemory(space, w_callbacks.w_mem_read8_intercept,
                                          w_callbacks.w_mem_write8_intercept)
             observer = self.machine.g.mem
             assert isinstance(observer, MemoryObserver)
+            observer.wrapped.close()
             observer.wrapped = mem
         if elf is not None:
             entry = load_sail(space, self.machine, elf)
@@ -475,6 +478,12 @@ class MachineAbstractBase(object):
         self._insn_cnt = 0 # used to check whether a tick has been reached
         self._tick = False # should the next step tick
 
+    def _finalize_(self):
+        mem = self.machine.g.mem
+        if mem is not None:
+            self.machine.g.mem = None
+            mem.close()
+
     def reset(self):
         initialize_registers(self.space, self.machine)
         self.machine.set_pc(self.reset_pc)
@@ -562,6 +571,37 @@ class MachineAbstractBase(object):
         except ValueError:
             raise oefmt(self.space.w_IndexError, "memory access out of bounds")
 
+    @unwrap_spec(address=r_uint, length=int)
+    def read_memory_bytes(self, address, length):
+        """ Read length bytes of memory starting at address, returned as a
+        bytes object. """
+        if length < 0:
+            raise oefmt(self.space.w_ValueError, "length must not be negative")
+        try:
+            return self.space.newbytes(self.machine.g.mem.read_bytes(address, length))
+        except ValueError:
+            raise oefmt(self.space.w_IndexError, "memory access out of bounds")
+
+    @unwrap_spec(address=r_uint, data="bytes")
+    def write_memory_bytes(self, address, data):
+        """ Write the bytes data to memory starting at address. """
+        try:
+            self.machine.g.mem.write_bytes(address, data)
+        except ValueError:
+            raise oefmt(self.space.w_IndexError, "memory access out of bounds")
+
+    @unwrap_spec(address=r_uint, length=int, byte=int)
+    def fill_memory(self, address, length, byte=0):
+        """ Set length bytes of memory starting at address to byte. """
+        if length < 0:
+            raise oefmt(self.space.w_ValueError, "length must not be negative")
+        if not 0 <= byte <= 0xff:
+            raise oefmt(self.space.w_ValueError, "byte must be between 0 and 255")
+        try:
+            self.machine.g.mem.fill(address, length, byte)
+        except ValueError:
+            raise oefmt(self.space.w_IndexError, "memory access out of bounds")
+
     def memory_info(self):
         """ Return information about the emulated memory of the model. Returns
         a list of tuples of the form
@@ -581,6 +621,63 @@ class MachineAbstractBase(object):
         space.call_method(w_res, "sort")
         return w_res
 
+    @unwrap_spec(threshold=int)
+    def set_smc_threshold(self, threshold):
+        """ Set the number of code invalidations after which a memory page is
+        treated as permanently mutable (0 disables this). """
+        if threshold < 0:
+            raise oefmt(self.space.w_ValueError, "threshold must not be negative")
+        self.machine.g.mem.set_smc_threshold(threshold)
+
+    def page_invalidation_stats(self):
+        """ Return information about self-modifying code. Returns a list of
+        tuples of the form
+
+        (page_address, invalidation_count, pinned)
+
+        for all memory pages that had their code modified at least once.
+        pinned is True if the page is now treated as permanently mutable. """
+        space = self.space
+        res_w = []
+        for addr, count, pinned in self.machine.g.mem.page_invalidation_stats():
+            res_w.append(space.newtuple([
+                space.newint(addr),
+                space.newint(count),
+                space.newbool(pinned),
+            ]))
+        return space.newlist(res_w)
+
+    @unwrap_spec(address=r_uint)
+    def lookup_symbol(self, address):
+        """ Return a tuple (symbol_name, offset) for the function (or object)
+        of the loaded ELF file that contains address, or None. """
+        space = self.space
+        index = self.machine.g.symbol_index
+        if index is None:
+            return space.w_None
+        name, offset = index.lookup(address)
+        if not name:
+            return space.w_None
+        return space.newtuple2(space.newtext(name), space.newint(offset))
+
+    @unwrap_spec(enabled=bool)
+    def set_dirty_tracking(self, enabled):
+        """ Switch on or off the tracking of which memory pages are written
+        to. """
+        self.machine.g.mem.set_dirty_tracking(enabled)
+
+    def dirty_pages(self):
+        """ Return the sorted list of the addresses of the memory pages that
+        were written to since dirty tracking was switched on or
+        reset_dirty_pages was called. """
+        space = self.space
+        return space.newlist([space.newint(addr)
+                              for addr in self.machine.g.mem.dirty_pages()])
+
+    def reset_dirty_pages(self):
+        """ Mark all memory pages as clean again. """
+        self.machine.g.mem.reset_dirty_pages()
+
     @unwrap_spec(limit=int)
     def run(self, limit=0):
         """ Run the emulator, either for a given number of steps if limit is
@@ -632,12 +729,45 @@ class MemoryObserver(mem_mod.MemBase):
             self.memory_observer.append(("write", start_addr, num_bytes, value))
         return self.wrapped.write(start_addr, num_bytes, value)
 
+    def read_bytes(self, start_addr, num_bytes):
+        return self.wrapped.read_bytes(start_addr, num_bytes)
+
+    def write_bytes(self, start_addr, data):
+        return self.wrapped.write_bytes(start_addr, data)
+
+    def fill(self, start_addr, num_bytes, byte=0):
+        return self.wrapped.fill(start_addr, num_bytes, byte)
+
     def close(self):
         return self.wrapped.close()
 
     def memory_info(self):
         return self.wrapped.memory_info()
 
+    def used_ranges(self):
+        return self.wrapped.used_ranges()
+
+    def set_smc_threshold(self, threshold):
+        self.wrapped.set_smc_threshold(threshold)
+
+    def page_invalidation_stats(self):
+        return self.wrapped.page_invalidation_stats()
+
+    def set_block_cache_stats(self, enabled):
+        self.wrapped.set_block_cache_stats(enabled)
+
+    def block_cache_stats(self):
+        return self.wrapped.block_cache_stats()
+
+    def set_dirty_tracking(self, enabled):
+        self.wrapped.set_dirty_tracking(enabled)
+
+    def dirty_pages(self):
+        return self.wrapped.dirty_pages()
+
+    def reset_dirty_pages(self):
+        self.wrapped.reset_dirty_pages()
+
 
 class ApplevelCallbackMemory(mem_mod.MemBase):
     def __init__(self, space, w_read, w_write):
@@ -720,7 +850,16 @@ W_RISCV64.typedef = TypeDef("_pydrofoil.RISCV64",
     register_info = interp2app(W_RISCV64.get_register_info),
     read_memory = interp2app(W_RISCV64.read_memory),
     write_memory = interp2app(W_RISCV64.write_memory),
+    read_memory_bytes = interp2app(W_RISCV64.read_memory_bytes),
+    write_memory_bytes = interp2app(W_RISCV64.write_memory_bytes),
+    fill_memory = interp2app(W_RISCV64.fill_memory),
     memory_info = interp2app(W_RISCV64.memory_info),
+    set_smc_threshold = interp2app(W_RISCV64.set_smc_threshold),
+    page_invalidation_stats = interp2app(W_RISCV64.page_invalidation_stats),
+    lookup_symbol = interp2app(W_RISCV64.lookup_symbol),
+    set_dirty_tracking = interp2app(W_RISCV64.set_dirty_tracking),
+    dirty_pages = interp2app(W_RISCV64.dirty_pages),
+    reset_dirty_pages = interp2app(W_RISCV64.reset_dirty_pages),
     run = interp2app(W_RISCV64.run),
     set_verbosity = interp2app(W_RISCV64.set_verbosity),
     disassemble_last_instruction = interp2app(W_RISCV64.disassemble_last_instruction),
@@ -756,7 +895,16 @@ W_RISCV32.typedef = TypeDef("_pydrofoil.RISCV32",
     register_info = interp2app(W_RISCV32.get_register_info),
     read_memory = interp2app(W_RISCV32.read_memory),
     write_memory = interp2app(W_RISCV32.write_memory),
+    read_memory_bytes = interp2app(W_RISCV32.read_memory_bytes),
+    write_memory_bytes = interp2app(W_RISCV32.write_memory_bytes),
+    fill_memory = interp2app(W_RISCV32.fill_memory),
     memory_info = interp2app(W_RISCV32.memory_info),
+    set_smc_threshold = interp2app(W_RISCV32.set_smc_threshold),
+    page_invalidation_stats = interp2app(W_RISCV32.page_invalidation_stats),
+    lookup_symbol = interp2app(W_RISCV32.lookup_symbol),
+    set_dirty_tracking = interp2app(W_RISCV32.set_dirty_tracking),
+    dirty_pages = interp2app(W_RISCV32.dirty_pages),
+    reset_dirty_pages = interp2app(W_RISCV32.reset_dirty_pages),
     run = interp2app(W_RISCV32.run),
     set_verbosity = interp2app(W_RISCV32.set_verbosity),
     disassemble_last_instruction = interp2app(W_RISCV32.disassemble_last_instruction),
@@ -139,6 +139,52 @@ def test_memory_info():
     info = cpu.memory_info()
     assert info == [(0, 0x800000), (0x80000000, 0x4000000 + 0x80000000)]
 
+def test_memory_bytes():
+    cpu = _pydrofoil.RISCV64()
+    cpu.write_memory_bytes(0x80000003, b"abcdefghijk")
+    assert cpu.read_memory_bytes(0x80000001, 14) == b"\x00\x00abcdefghijk\x00"
+    assert cpu.read_memory(0x80000008, 1) == ord("f")
+    cpu.fill_memory(0x80000004, 3, 0x41)
+    assert cpu.read_memory_bytes(0x80000003, 5) == b"aAAAe"
+    cpu.fill_memory(0x80000000, 16)
+    assert cpu.read_memory_bytes(0x80000000, 16) == b"\x00" * 16
+    with raises(IndexError):
+        cpu.read_memory_bytes(0x70000000, 8)
+    with raises(ValueError):
+        cpu.fill_memory(0x80000000, 8, 256)
+
+def test_page_invalidation_stats():
+    cpu = _pydrofoil.RISCV64(addielf)
+    cpu.set_smc_threshold(2)
+    with raises(ValueError):
+        cpu.set_smc_threshold(-1)
+    cpu.run(100)
+    assert cpu.page_invalidation_stats() == []
+    # overwrite the reset vector, which was executed
+    cpu.write_memory(0x1000, 0)
+    assert cpu.page_invalidation_stats() == [(0x1000, 1, False)]
+    cpu.write_memory(0x1008, 0)
+    assert cpu.page_invalidation_stats() == [(0x1000, 2, True)]
+
+def test_lookup_symbol():
+    cpu = _pydrofoil.RISCV64(addielf)
+    assert cpu.lookup_symbol(0x80000000) == ("_start", 0)
+    assert cpu.lookup_symbol(0x80000008) == ("trap_vector", 4)
+    assert cpu.lookup_symbol(0x1000) is None
+    cpu = _pydrofoil.RISCV64()
+    assert cpu.lookup_symbol(0x80000000) is None
+
+def test_dirty_pages():
+    cpu = _pydrofoil.RISCV64(addielf)
+    cpu.write_memory(0x80001000, 1)
+    assert cpu.dirty_pages() == []
+    cpu.set_dirty_tracking(True)
+    cpu.write_memory(0x80001008, 1)
+    cpu.write_memory(0x80003000, 1)
+    assert cpu.dirty_pages() == [0x80001000, 0x80003000]
+    cpu.reset_dirty_pages()
+    assert cpu.dirty_pages() == []
+
 def test_set_verbosity():
     # smoke test
     cpu = _pydrofoil.RISCV64(addielf)
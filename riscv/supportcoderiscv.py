@@ -4,13 +4,17 @@ from pydrofoil.supportcode import *
 from pydrofoil.supportcode import _platform_read_mem_slowpath, _platform_write_mem_slowpath
 from pydrofoil.bitvector import Integer
 from pydrofoil import elf
+from pydrofoil import imagefile
 from pydrofoil import mem as mem_mod
+from pydrofoil import snapshot
+from pydrofoil import console
 
 from rpython.rlib.nonconst import NonConstant
 from rpython.rlib.objectmodel import we_are_translated, always_inline, specialize
 from rpython.rlib.jit import JitDriver, promote
 from rpython.rlib.rarithmetic import r_uint, intmask, ovfcheck
 from rpython.rlib.rrandom import Random
+from rpython.rlib.rstring import StringBuilder
 from rpython.rlib import jit
 from rpython.rlib import debug as rdebug
 from rpython.rlib import rsignal
@@ -133,7 +137,8 @@ class Globals(object):
         'rv_rom_base?', 'rv_rom_size?', 'mem?',
         'rv_ram_base?', 'rv_ram_size?',
         'rv_enable_dirty_update?', 'rv_enable_misaligned?',
-        'rv_insns_per_tick?',
+        'rv_insns_per_tick?', 'max_tick_batch?', 'skip_idle?',
+        'console_input?',
         '_mem_ranges?[*]',
         'rv64'
     ]
@@ -173,16 +178,49 @@ class Globals(object):
         self.rv_clint_size = r_uint(0xc0000)
 
         self.rv_htif_tohost = r_uint(0x80001000)
+        # the address of the HTIF fromhost word, 0 if the ELF file has none
+        self.rv_htif_fromhost = r_uint(0)
         self.rv_insns_per_tick = 100
+        # let up to this many clock ticks pass at once while no timer
+        # interrupt is due, see Machine.next_tick_deadline. 1 ticks the clock
+        # every rv_insns_per_tick instructions
+        self.max_tick_batch = 1
+        # advance the clock to the next timer interrupt when the guest
+        # executes wfi, see Machine.skip_idle_time
+        self.skip_idle = False
+        self.idle_ticks_skipped = 0
 
         self.dtb = None
-
-        self.term_fd = 1
+        # the content of the ROM built by init_sail_reset_vector, and the
+        # entry point and dtb it was built for
+        self.rom_content = None
+        self.rom_content_entry = r_uint(0)
+        self.rom_content_dtb = None
+        # use a sparse BlockMemory instead of a FlatMemory for ROM and RAM
+        self.use_block_memory = False
+        self.block_memory_bits = mem_mod.BlockMemory.ADDRESS_BITS_BLOCK
+        # files that are mapped as the initial content of ROM and RAM
+        self.rom_image = None
+        self.ram_image = None
+        self.ram_image_shared = False
+        # track the pages written to in a FlatMemory from the start, so that
+        # saving a snapshot only needs to look at them
+        self.track_dirty_pages = False
+
+        # where the output of the guest goes
+        self.console = console.ConsoleOutput(1)
+        # where the input of the guest comes from, if anywhere
+        self.console_input = None
+        # the guest asked for a character of console input via HTIF and
+        # didn't get one yet
+        self.console_read_pending = False
 
         self.reservation = r_uint(0)
         self.reservation_valid = False
 
         self.dump_dict = {}
+        # the symbols of the loaded ELF file, to annotate addresses
+        self.symbol_index = None
 
         self.config_print_instr = True
         self.config_print_reg = True
@@ -371,8 +409,7 @@ def cancel_reservation(machine, _):
     return ()
 
 def plat_term_write(machine, s):
-    import os
-    os.write(machine.g.term_fd, chr(s & 0xff))
+    machine.g.console.write_char(chr(s & 0xff))
     return ()
 
 def plat_insns_per_tick(machine, _):
@@ -384,6 +421,63 @@ def plat_htif_tohost(machine, _):
 def memea(len, n):
     return ()
 
+# console input
+
+# the HTIF command for console input: device 1 (the console), command 0
+# (getchar). The guest requests a character by writing it to tohost, the
+# answer in fromhost has the character in the lowest byte
+HTIF_CONSOLE_GETCHAR = r_uint(1) << 56
+# the device and command are in the upper 16 bits of an HTIF command
+HTIF_COMMAND_SHIFT = 48
+
+def record_console_request(machine):
+    """ Called when the clock ticks, before tick_platform acknowledges (and
+    clears) the command the guest wrote to tohost. Remember a request for
+    console input, it is answered by poll_console_input. """
+    tohost = machine._reg_zhtif_tohost
+    if tohost >> HTIF_COMMAND_SHIFT == HTIF_CONSOLE_GETCHAR >> HTIF_COMMAND_SHIFT:
+        machine.g.console_read_pending = True
+
+def poll_console_input(machine):
+    """ Called when the clock ticks. Like the bcd device of Spike, answer a
+    pending request of the guest with the next character of the console input
+    via the HTIF fromhost word, once the guest has consumed the previous
+    answer (which it acknowledges by setting fromhost to 0). There is one
+    character per request, the guest also consumes fromhost while it is
+    waiting for its output to be handled, so answering without a request
+    would lose characters. """
+    g = machine.g
+    if not g.console_read_pending:
+        return
+    mem = g.mem
+    if mem.read(g.rv_htif_fromhost, 8) != 0:
+        return
+    c = g.console_input.read_char()
+    if c < 0:
+        return
+    g.console_read_pending = False
+    mem.write(g.rv_htif_fromhost, 8, HTIF_CONSOLE_GETCHAR | r_uint(c))
+
+def set_htif_fromhost(g, img):
+    # fromhost is optional, it is only needed for console input
+    if "fromhost" in img.symbols:
+        g.rv_htif_fromhost = r_uint(img.get_symbol("fromhost"))
+
+# ticking the clock
+
+def _ticks_until(mtime, timecmp, ticks):
+    """ Return the number of ticks until mtime reaches timecmp, if that is
+    fewer than ticks. """
+    if mtime < timecmp and timecmp - mtime < ticks:
+        return timecmp - mtime
+    return ticks
+
+# idle skipping
+
+WFI_INSTRUCTION = r_uint(0x10500073)
+MIE_MTIE = r_uint(1 << 7)
+MCOUNTINHIBIT_CY = r_uint(1)
+
 def instr_announce(machine, _):
     return ()
 
@@ -398,50 +492,55 @@ def init_sail(machine, elf_entry):
 def is_32bit_model(machine):
     return not machine.rv64
 
-@specialize.argtype(0)
-def init_sail_reset_vector(machine, entry):
-    RST_VEC_SIZE = 8
+RST_VEC_SIZE = 8
+ROM_ALIGN = 0x1000
+
+def build_rom_image(rv64, entry, dtb):
+    """ Build the content of the ROM: the reset vector, which jumps to entry
+    with the address of the device tree in a1, followed by the device tree
+    blob dtb (or None), zero-filled to the next page boundary. """
     reset_vec = [ # 32 bit entries
         r_uint(0x297),                                      # auipc  t0,0x0
         r_uint(0x28593 + (RST_VEC_SIZE * 4 << 20)),         # addi   a1, t0, &dtb
         r_uint(0xf1402573),                                 # csrr   a0, mhartid
-        r_uint(0x0182a283)  # lw     t0,24(t0)
-        if is_32bit_model(machine) else
-        r_uint(0x0182b283), # ld     t0,24(t0)
+        r_uint(0x0182b283)  # ld     t0,24(t0)
+        if rv64 else
+        r_uint(0x0182a283), # lw     t0,24(t0)
         r_uint(0x28067),                                    # jr     t0
         r_uint(0),
         r_uint(entry & 0xffffffff),
         r_uint(entry >> 32),
     ]
-
-
-    rv_rom_base = DEFAULT_RSTVEC
-    addr = r_uint(rv_rom_base)
-    for i, fourbytes in enumerate(reset_vec):
+    res = StringBuilder()
+    for fourbytes in reset_vec:
         for j in range(4):
-            machine.g.mem.write(addr, 1, fourbytes & 0xff)
-            #write_mem(machine, addr, fourbytes & 0xff) # little endian
-            addr += 1
+            res.append(chr(intmask(fourbytes & 0xff))) # little endian
             fourbytes >>= 8
         assert fourbytes == 0
-    if machine.g.dtb:
-        for i, char in enumerate(machine.g.dtb):
-            machine.g.mem.write(addr, 1, r_uint(ord(char)))
-            #write_mem(machine, addr, r_uint(ord(char)))
-            addr += 1
-
-    align = 0x1000
+    if dtb:
+        res.append(dtb)
     # zero-fill to page boundary
-    rom_end = r_uint((addr + align - 1) / align * align)
-    for i in range(intmask(addr), rom_end):
-        #write_mem(machine, addr, 0)
-        machine.g.mem.write(addr, 1, 0)
-        addr += 1
+    size = res.getlength()
+    res.append_multiple_char('\x00', (size + ROM_ALIGN - 1) // ROM_ALIGN * ROM_ALIGN - size)
+    return res.build()
+
+@specialize.argtype(0)
+def init_sail_reset_vector(machine, entry):
+    g = machine.g
+    # the ROM content only depends on the entry point and the dtb, reuse it
+    # when the machine is reset
+    if (g.rom_content is None or g.rom_content_entry != entry or
+            g.rom_content_dtb != g.dtb):
+        g.rom_content = build_rom_image(not is_32bit_model(machine), entry, g.dtb)
+        g.rom_content_entry = entry
+        g.rom_content_dtb = g.dtb
+    rv_rom_base = DEFAULT_RSTVEC
+    g.mem.write_bytes(r_uint(rv_rom_base), g.rom_content)
 
     # set rom size
-    rv_rom_size = rom_end - rv_rom_base
-    if machine.g.rv_rom_size != rv_rom_size:
-        machine.g.rv_rom_size = rv_rom_size
+    rv_rom_size = r_uint(len(g.rom_content))
+    if g.rv_rom_size != rv_rom_size:
+        g.rv_rom_size = rv_rom_size
 
     # boot at reset vector
     return r_uint(rv_rom_base)
@@ -495,16 +594,30 @@ Run the Pydrofoil RISC-V emulator on elf_file.
 --rv32                          run emulator in 32bit mode
 -l/--inst-limit <limit>         exit after limit instructions have been executed
 --instructions-per-tick <num>   tick the emulated clock every num instructions (default: 100)
+--max-tick-batch <num>          advance the clock by up to num ticks at once while no timer interrupt is due (default: 1)
 --verbose                       print a detailed trace of every instruction executed
 --print-kips                    print kip/s every 2**20 instructions
+--skip-idle                     when the guest waits for an interrupt with wfi, advance the clock straight to the next timer interrupt
 --jit <options>                 set JIT options (try --jit help for details)
---dump <file>                   load elf file disassembly from file
+--dump <file>                   load elf file disassembly from file (to show instructions in JIT logs, function names come from the elf symbols)
 -b/--device-tree-blob <file>    load dtb from file (usually not needed, Pydrofoil has a dtb built-in)
 --disable-vext                  disable vector extension
 -d/--enable-dirty-update        enable dirty update
 -m/--enable-misaligned          enable misagligned memory accesses
 -i/--mtval-has-illegal-inst-bits
 --ram-size <num>                set emulated RAM size (in MiB)
+--smc-threshold <num>           pin a memory page as mutable after num code invalidations (default: 16, 0 to disable)
+--smc-stats                     print per-page self-modifying code statistics at exit
+--block-memory                  emulate memory with sparse 1 MiB blocks instead of flat memory
+--block-size <num>              set the block size of --block-memory (in KiB: 4, 64 or 1024)
+--block-cache-stats             print the hit rate of the block cache of --block-memory at exit
+--rom-image <file>              map file as the initial content of the ROM (copy-on-write)
+--ram-image <file>              map file as the initial content of the RAM (copy-on-write)
+--ram-image-shared              write changes of the RAM back to the --ram-image file
+--console-output <file>         write the output of the guest to file instead of the terminal
+--console-input <file>          feed the content of file (- for stdin) to the guest as console input, via HTIF
+--save-snapshot <file>          save the complete machine state to file when the emulator stops
+--load-snapshot <file>          resume from the machine state in file instead of booting elf_file
 --version                       print the version of pydrofoil-riscv
 --help                          print this information and exit
 """
@@ -579,6 +692,8 @@ def _main(argv, *machineclasses):
 
     dump_file = parse_args(argv, "--dump")
     per_tick = parse_args(argv, "--instructions-per-tick")
+    max_tick_batch = parse_args(argv, "--max-tick-batch")
+    skip_idle = parse_flag(argv, "--skip-idle")
 
     jitopts = parse_args(argv, "--jit")
     if jitopts:
@@ -606,6 +721,19 @@ def _main(argv, *machineclasses):
 
     ram_size = parse_args(argv, "-z", "--ram-size")
 
+    smc_threshold = parse_args(argv, "--smc-threshold")
+    smc_stats = parse_flag(argv, "--smc-stats")
+    block_memory = parse_flag(argv, "--block-memory")
+    block_size = parse_args(argv, "--block-size")
+    block_cache_stats = parse_flag(argv, "--block-cache-stats")
+    rom_image = parse_args(argv, "--rom-image")
+    ram_image = parse_args(argv, "--ram-image")
+    ram_image_shared = parse_flag(argv, "--ram-image-shared")
+    console_output = parse_args(argv, "--console-output")
+    console_input = parse_args(argv, "--console-input")
+    save_snapshot_file = parse_args(argv, "--save-snapshot")
+    load_snapshot_file = parse_args(argv, "--load-snapshot")
+
     verbose = parse_flag(argv, "--verbose")
 
     print_kips = parse_flag(argv, "--print-kips")
@@ -626,14 +754,69 @@ def _main(argv, *machineclasses):
         iterations = int(argv[2])
     else:
         iterations = 1
+    if load_snapshot_file and iterations != 1:
+        print "ERROR: --load-snapshot can't be combined with iterations"
+        return 1
+    if load_snapshot_file and (rom_image or ram_image or ram_image_shared):
+        # the snapshot only stores the non-zero pages, so it has to be loaded
+        # into empty memory
+        print "ERROR: --load-snapshot can't be combined with --rom-image, --ram-image or --ram-image-shared"
+        return 1
     #init_logs()
 
     machine = machinecls()
+    if console_output:
+        machine.g.console = console.open_console_output(console_output)
+    elif verbose:
+        # keep the output of the guest in order with the trace
+        machine.g.console = console.ConsoleOutput(1, buffer_size=1)
+
     if ram_size:
         ram_size = int(ram_size)
         print "setting ram-size to %s MiB" % ram_size
         machine.g.rv_ram_size = r_uint(ram_size << 20)
+    if block_memory:
+        machine.g.use_block_memory = True
+    if block_size:
+        block_size = int(block_size)
+        for bits in mem_mod.BLOCK_SIZE_BITS:
+            if block_size << 10 == 1 << bits:
+                machine.g.block_memory_bits = bits
+                break
+        else:
+            print "ERROR: unsupported block size: %s KiB" % (block_size, )
+            return 1
+        if not block_memory:
+            print "ERROR: --block-size needs --block-memory"
+            return 1
+    if rom_image or ram_image:
+        if block_memory:
+            print "ERROR: memory images can't be used with --block-memory"
+            return 1
+        for image in [rom_image, ram_image]:
+            if image and check_file_missing(image):
+                return -1
+        if rom_image:
+            if os.stat(rom_image).st_size > mem_mod.FlatMemory.SIZE:
+                print "ERROR: ROM image is larger than the ROM: %s" % (rom_image, )
+                return 1
+            machine.g.rom_image = rom_image
+        if ram_image:
+            if os.stat(ram_image).st_size > intmask(machine.g.rv_ram_size):
+                print "ERROR: RAM image is larger than the RAM: %s" % (ram_image, )
+                return 1
+            machine.g.ram_image = ram_image
+            machine.g.ram_image_shared = ram_image_shared
+    elif ram_image_shared:
+        print "ERROR: --ram-image-shared needs --ram-image"
+        return 1
+    if save_snapshot_file:
+        machine.g.track_dirty_pages = True
     init_mem(machine)
+    if smc_threshold:
+        machine.g.mem.set_smc_threshold(int(smc_threshold))
+    if block_cache_stats:
+        machine.g.mem.set_block_cache_stats(True)
     if blob:
         if check_file_missing(blob):
             return -1
@@ -659,16 +842,41 @@ def _main(argv, *machineclasses):
         machine.g.config_print_reg = False
         machine.g.config_print_mem_access = False
         machine.g.config_print_platform = False
-    entry = load_sail(machine, file)
-    machine.set_pc(init_sail(machine, entry))
+    if load_snapshot_file:
+        if check_file_missing(load_snapshot_file):
+            return -1
+        load_symbols(machine, file)
+        try:
+            load_snapshot(machine, load_snapshot_file)
+        except snapshot.SnapshotError as e:
+            print "ERROR: can't load snapshot %s: %s" % (load_snapshot_file, e.msg)
+            return 1
+        print "resuming from snapshot", load_snapshot_file
+        entry = r_uint(0)
+    else:
+        entry = load_sail(machine, file)
+        machine.set_pc(init_sail(machine, entry))
     if dump_file:
         if check_file_missing(dump_file):
             return -1
         print "dump file", dump_file
         machine.g.dump_dict = parse_dump_file(dump_file)
+    if console_input:
+        if not machine.g.rv_htif_fromhost:
+            print "ERROR: --console-input needs an ELF file with a fromhost symbol"
+            return 1
+        machine.g.console_input = console.open_console_input(console_input)
     if per_tick:
         ipt = int(per_tick)
         machine.g.rv_insns_per_tick = ipt
+    if max_tick_batch:
+        batch = int(max_tick_batch)
+        if batch < 1:
+            print "ERROR: --max-tick-batch must be at least 1"
+            return 1
+        machine.g.max_tick_batch = batch
+    if skip_idle:
+        machine.g.skip_idle = True
 
     # prepare SIGINT signal handler
     if we_are_translated():
@@ -676,29 +884,93 @@ def _main(argv, *machineclasses):
 
     machine.g._init_ranges()
 
-    for i in range(iterations):
-        machine.run_sail(limit, print_kips)
-        if i:
-            machine.set_pc(init_sail(machine, entry))
+    try:
+        try:
+            for i in range(iterations):
+                machine.run_sail(limit, print_kips)
+                if i:
+                    machine.set_pc(init_sail(machine, entry))
+        except ExitNow:
+            # ctrl-c was pressed, the state is still consistent
+            if save_snapshot_file:
+                save_snapshot_and_report(machine, save_snapshot_file)
+            raise
+    finally:
+        # the end of the output of the guest is the most interesting part
+        # after a crash, write it out on every way out
+        machine.g.console.close()
+        if machine.g.console_input is not None:
+            machine.g.console_input.close()
+    if save_snapshot_file:
+        if not save_snapshot_and_report(machine, save_snapshot_file):
+            return 1
+    if smc_stats:
+        print_smc_stats(machine.g.mem)
+    if block_cache_stats:
+        print_block_cache_stats(machine.g.mem)
     #flush_logs()
     #close_logs()
     return 0
 
+def print_smc_stats(mem):
+    stats = mem.page_invalidation_stats()
+    total = 0
+    pinned = 0
+    for addr, count, is_pinned in stats:
+        total += count
+        if is_pinned:
+            pinned += 1
+    print "Code invalidations: %s in %s pages, %s pages pinned as mutable" % (
+        total, len(stats), pinned)
+    for addr, count, is_pinned in stats:
+        if is_pinned:
+            print "  page 0x%x: %s invalidations (pinned)" % (addr, count)
+        else:
+            print "  page 0x%x: %s invalidations" % (addr, count)
+
+def print_block_cache_stats(mem):
+    lookups, misses = mem.block_cache_stats()
+    if not lookups:
+        print "Block cache: no lookups"
+        return
+    hits = lookups - misses
+    print "Block cache: %s lookups, %s hits (%s%%), %s misses" % (
+        lookups, hits, hits * 100 // lookups, misses)
+
+def symbol_suffix(g, pc):
+    """ Return " <symbol+0xoffset>" for pc, if it belongs to a symbol of the
+    loaded ELF file. """
+    if g.symbol_index is None:
+        return ''
+    location = g.symbol_index.format_address(pc)
+    if not location:
+        return ''
+    return " <%s>" % (location, )
+
 def get_printable_location(pc, do_show_times, insn_limit, tick, g):
     if tick:
         return "TICK 0x%x" % (pc, )
     if g.dump_dict and pc in g.dump_dict:
         return "0x%x: %s" % (pc, g.dump_dict[pc])
-    return hex(pc)
+    return "0x%x%s" % (pc, symbol_suffix(g, pc))
 
 def init_mem(machine, memwrappercls=None):
     g = machine.g
     oldmem = g.mem
     if oldmem:
         oldmem.close()
-    mem1 = mem_mod.FlatMemory(False)
-    mem2 = mem_mod.FlatMemory(False, g.rv_ram_size)
-    mem = mem_mod.SplitMemory(mem1, 0, mem1.size, mem2, g.rv_ram_base, g.rv_ram_size)
+    if g.use_block_memory:
+        mem = mem_mod.block_memory(g.block_memory_bits)
+    else:
+        # both memories are mmapped, so only the pages that are used by the
+        # guest are ever allocated
+        mem1 = mem_mod.FlatMemory(True, image=g.rom_image,
+                                  track_dirty=g.track_dirty_pages)
+        mem2 = mem_mod.FlatMemory(True, g.rv_ram_size, image=g.ram_image,
+                                  shared=g.ram_image_shared,
+                                  track_dirty=g.track_dirty_pages)
+        mem = mem_mod.MemoryMap([(r_uint(0), r_uint(mem1.size), mem1),
+                                 (g.rv_ram_base, g.rv_ram_size, mem2)])
     if memwrappercls is not None:
         mem = memwrappercls(mem)
     g.mem = mem
@@ -706,18 +978,95 @@ def init_mem(machine, memwrappercls=None):
 def load_sail(machine, fn):
     g = machine.g
     mem = machine.g.mem
-    with open(fn, "rb") as f:
-        entrypoint = elf.elf_read_process_image(mem, f) # load process image
-    with open(fn, "rb") as f:
-        img = elf.elf_reader(f) # for the symbols
+    # the ELF file can be gzip or zlib compressed
+    f = imagefile.open_image(fn)
+    try:
+        # load process image and symbols
+        entrypoint, img = elf.elf_load(mem, f)
+    finally:
+        f.close()
 
     g.rv_htif_tohost = r_uint(img.get_symbol('tohost'))
+    set_htif_fromhost(g, img)
+    g.symbol_index = img.get_symbol_index()
     print "tohost located at 0x%x" % g.rv_htif_tohost
 
     print "ELF Entry @ 0x%x" % entrypoint
     assert entrypoint == 0x80000000 # XXX for now
     return entrypoint
 
+def load_symbols(machine, fn):
+    """ Read only the symbols of the ELF file fn, used when the memory content
+    comes from a snapshot. """
+    f = imagefile.open_image(fn)
+    try:
+        img = elf.elf_reader(f)
+    finally:
+        f.close()
+    machine.g.symbol_index = img.get_symbol_index()
+    set_htif_fromhost(machine.g, img)
+
+# snapshots
+
+def snapshot_kind(machine):
+    if is_32bit_model(machine):
+        return "pydrofoil-riscv32"
+    return "pydrofoil-riscv64"
+
+@specialize.argtype(0)
+def save_snapshot(machine, fn):
+    """ Write the complete state of machine to the file fn: the Globals that
+    change while the emulator runs, all Sail registers and the memory. """
+    g = machine.g
+    with open(fn, "wb") as f:
+        writer = snapshot.SnapshotWriter(f, snapshot_kind(machine))
+        writer.write_uint(g.rv_ram_base)
+        writer.write_uint(g.rv_ram_size)
+        writer.write_uint(g.rv_rom_size)
+        writer.write_uint(g.rv_htif_tohost)
+        writer.write_uint(g.reservation)
+        writer.write_bool(g.reservation_valid)
+        writer.write_bool(g.console_read_pending)
+        writer.write_int(len(machine._all_register_snapshot))
+        for name, save, _ in machine._all_register_snapshot:
+            writer.write_str(name)
+            save(machine, writer)
+        snapshot.save_memory(writer, g.mem)
+        writer.flush()
+
+@specialize.argtype(0)
+def save_snapshot_and_report(machine, fn):
+    """ Save a snapshot and print the outcome. Returns False if the snapshot
+    couldn't be saved. """
+    try:
+        save_snapshot(machine, fn)
+    except snapshot.SnapshotError as e:
+        print "ERROR: can't save snapshot %s: %s" % (fn, e.msg)
+        return False
+    print "saved snapshot", fn
+    return True
+
+@specialize.argtype(0)
+def load_snapshot(machine, fn):
+    """ Restore the state of machine from the file fn written by
+    save_snapshot. The memory of machine must not have been written to. """
+    g = machine.g
+    with open(fn, "rb") as f:
+        reader = snapshot.SnapshotReader(f, snapshot_kind(machine))
+        if reader.read_uint() != g.rv_ram_base or reader.read_uint() != g.rv_ram_size:
+            raise snapshot.SnapshotError("snapshot was taken with a different RAM size")
+        g.rv_rom_size = reader.read_uint()
+        g.rv_htif_tohost = reader.read_uint()
+        g.reservation = reader.read_uint()
+        g.reservation_valid = reader.read_bool()
+        g.console_read_pending = reader.read_bool()
+        if reader.read_int() != len(machine._all_register_snapshot):
+            raise snapshot.SnapshotError("snapshot was taken with a different Sail model")
+        for name, _, load in machine._all_register_snapshot:
+            reader.expect_str(name, "Sail model")
+            load(machine, reader)
+        snapshot.load_memory(reader, g.mem)
+
 # printing
 
 
@@ -802,16 +1151,19 @@ def get_main(outriscv, rv64):
             suffix = ' need_step'
         if g.dump_dict and pc in g.dump_dict:
             return "%s 0x%x: %s%s" % (prefix, pc, g.dump_dict[pc], suffix)
-        return "%s 0x%x%s" % (prefix, pc, suffix)
+        return "%s 0x%x%s%s" % (prefix, pc, symbol_suffix(g, pc), suffix)
 
     driver = JitDriver(
         get_printable_location=get_printable_location,
         greens=['pc', 'do_show_times', 'insn_limit', 'tick', 'need_step_no', 'g'],
-        reds=['insn_cnt', 'machine'],
+        reds=['insn_cnt', 'tick_deadline', 'machine'],
         virtualizables=['machine'],
         name=prefix,
         is_recursive=True)
 
+    # models with the Sstc extension have a supervisor timer as well
+    has_stimecmp = hasattr(outriscv.Machine, "_reg_zstimecmp")
+
     for name in dir(outriscv):
         if name.startswith("func_zchecked_mem_"):
             patch_checked_mem_function(outriscv, name)
@@ -850,6 +1202,75 @@ def get_main(outriscv, rv64):
         def init_model(self):
             return outriscv.func_zinit_model(self, ())
 
+        def advance_clock(self, ticks):
+            """ Advance the clock by ticks > 0 ticks at once, with a single
+            call each to tick_clock and tick_platform. """
+            if ticks > 1:
+                self._reg_zmtime += ticks - 1
+                if not self._reg_zmcountinhibit.zbits & MCOUNTINHIBIT_CY:
+                    self._reg_zmcycle += ticks - 1
+            g = self.g
+            self.tick_clock()
+            if g.console_input is not None:
+                record_console_request(self)
+            self.tick_platform()
+            g.console.tick()
+            if g.console_input is not None:
+                poll_console_input(self)
+
+        def next_tick_deadline(self):
+            """ Return the number of instructions to run before the clock
+            needs to be advanced next. That is the instruction count of the
+            next timer interrupt (of mtimecmp, or stimecmp with Sstc), but at
+            most max_tick_batch ticks, to bound how stale mtime can get for
+            the guest and how late a timer interrupt fires if the guest moves
+            the timer closer. While the guest has written to tohost, the
+            platform has to handle that at the next tick. """
+            g = self.g
+            ticks = r_uint(g.max_tick_batch)
+            if ticks > 1:
+                if self._reg_zhtif_tohost:
+                    ticks = r_uint(1)
+                mtime = self._reg_zmtime
+                ticks = _ticks_until(mtime, self._reg_zmtimecmp, ticks)
+                if has_stimecmp:
+                    ticks = _ticks_until(mtime, self._reg_zstimecmp, ticks)
+            return intmask(ticks) * g.rv_insns_per_tick
+
+        def shorten_tick_deadline(self, insn_cnt, tick_deadline):
+            """ The guest wrote to tohost in the middle of a batch of ticks:
+            end the batch at the end of the current tick, so that the platform
+            handles the write as soon as without batching. """
+            rv_insns_per_tick = self.g.rv_insns_per_tick
+            rest = insn_cnt % rv_insns_per_tick
+            if rest == 0:
+                # the current tick just ended
+                return insn_cnt
+            return min(insn_cnt - rest + rv_insns_per_tick, tick_deadline)
+
+        def skip_idle_time(self):
+            """ Called after the guest executed a wfi instruction. Unless an
+            enabled interrupt is pending already, the guest has nothing to do
+            until the timer fires, so advance mtime straight to mtimecmp
+            instead of running the idle loop tick by tick. mcycle advances
+            together with mtime, like in tick_clock. minstret stays unchanged,
+            no instructions were retired in between. """
+            if self._reg_zmip.zbits & self._reg_zmie.zbits:
+                return
+            if not self._reg_zmie.zbits & MIE_MTIE:
+                # the timer interrupt can't wake up the guest
+                return
+            mtime = self._reg_zmtime
+            mtimecmp = self._reg_zmtimecmp
+            if mtime < mtimecmp:
+                delta = mtimecmp - mtime
+                self.g.idle_ticks_skipped += intmask(delta)
+            else:
+                delta = r_uint(1)
+            # raises the timer interrupt before the next instruction, instead
+            # of at the next regular tick
+            self.advance_clock(delta)
+
         def initialize_registers(self):
             return outriscv.func_zinitializze_registers(self, ())
 
@@ -869,11 +1290,14 @@ def get_main(outriscv, rv64):
 
         def run_sail(self, insn_limit, do_show_times):
             self.step_no = 0
+            # the clock is advanced after tick_deadline instructions, a
+            # multiple of rv_insns_per_tick
+            tick_deadline = self.next_tick_deadline()
             # we update self.step_no only every TICK, *unless*:
             # - we want to continually print kps
             # - we want to print every instruction
             # - we are less than one TICK away from the insn_limit
-            need_step_no = do_show_times or self.g.config_print_instr or (insn_limit and insn_limit - self.step_no < self.g.rv_insns_per_tick)
+            need_step_no = do_show_times or self.g.config_print_instr or (insn_limit and insn_limit - self.step_no < tick_deadline)
             insn_cnt = 0
             tick = False
 
@@ -884,6 +1308,7 @@ def get_main(outriscv, rv64):
             while 1:
                 driver.jit_merge_point(pc=self._reg_zPC, tick=tick,
                         insn_limit=insn_limit, need_step_no=need_step_no, insn_cnt=insn_cnt,
+                        tick_deadline=tick_deadline,
                         do_show_times=do_show_times, machine=self, g=g)
                 if self._reg_zhtif_done or (insn_limit != 0 and need_step_no and self.step_no >= insn_limit):
                     break
@@ -892,17 +1317,19 @@ def get_main(outriscv, rv64):
                     if not need_step_no:
                         # self.step_no wasn't updated since the last tick
                         self.step_no += insn_cnt
-                    if insn_cnt == g.rv_insns_per_tick:
+                    if g.rv_insns_per_tick and insn_cnt == tick_deadline:
+                        # (with --instructions-per-tick 0 the clock never
+                        # ticks, only the kips are printed)
                         insn_cnt = 0
-                        self.tick_clock()
-                        self.tick_platform()
+                        self.advance_clock(r_uint(tick_deadline // g.rv_insns_per_tick))
+                        tick_deadline = self.next_tick_deadline()
                     else:
                         assert do_show_times and (self.step_no & 0xfffff) == 0
                         curr = time.time()
                         print "kips:", 0x100000 / 1000. / (curr - g.interval_start)
                         g.interval_start = curr
                     tick = False
-                    need_step_no = do_show_times or self.g.config_print_instr or (insn_limit and insn_limit - self.step_no < self.g.rv_insns_per_tick)
+                    need_step_no = do_show_times or self.g.config_print_instr or (insn_limit and insn_limit - self.step_no < tick_deadline)
                     continue
                 # run a Sail step
                 prev_pc = self._reg_zPC
@@ -914,6 +1341,7 @@ def get_main(outriscv, rv64):
                     step_no = None
                 stepped = self.step(step_no)
                 if self.have_exception:
+                    g.console.flush()
                     print "ended with exception!"
                     print self.current_exception
                     print "from", self.throw_location
@@ -927,9 +1355,16 @@ def get_main(outriscv, rv64):
                         self.step_no += 1
                     if rv_insns_per_tick:
                         insn_cnt += 1
+                    if (g.skip_idle and self._reg_zinstbits == WFI_INSTRUCTION
+                            and self._reg_zPC == prev_pc + 4):
+                        # wfi was executed, not trapped
+                        self.skip_idle_time()
+                    if (g.max_tick_batch > 1 and self._reg_zhtif_tohost and
+                            rv_insns_per_tick and tick_deadline > rv_insns_per_tick):
+                        tick_deadline = self.shorten_tick_deadline(insn_cnt, tick_deadline)
 
                 tick_cond = (do_show_times and (self.step_no & 0xffffffff) == 0) | (
-                        rv_insns_per_tick and insn_cnt == rv_insns_per_tick)
+                        rv_insns_per_tick and insn_cnt == tick_deadline)
                 if tick_cond:
                     tick = True
                 elif prev_pc >= self._reg_zPC: # backward jump
@@ -940,9 +1375,11 @@ def get_main(outriscv, rv64):
                             break
                     driver.can_enter_jit(pc=self._reg_zPC, tick=tick,
                             insn_limit=insn_limit, need_step_no=need_step_no, insn_cnt=insn_cnt,
+                            tick_deadline=tick_deadline,
                             do_show_times=do_show_times, machine=self, g=g)
             # loop end
 
+            g.console.flush()
             interval_end = time.time()
             p = rsignal.pypysig_getaddr_occurred()
             ctrlc = False
@@ -958,6 +1395,8 @@ def get_main(outriscv, rv64):
             print "Instructions: %s" % (self.step_no, )
             print "Total time (s): %s" % (interval_end - self.g.total_start)
             print "Perf: %s Kips" % (self.step_no / 1000. / (interval_end - self.g.total_start), )
+            if g.skip_idle:
+                print "Idle ticks skipped: %s" % (g.idle_ticks_skipped, )
             if ctrlc:
                 raise ExitNow
 
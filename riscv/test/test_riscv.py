@@ -90,6 +90,22 @@ def test_compare_dtbs():
         target = f.read()
     assert target == g.dtb
 
+def test_build_rom_image():
+    from riscv import supportcoderiscv
+    from rpython.rlib.rarithmetic import r_uint
+    g = supportcoderiscv.Globals()
+    g._create_dtb()
+    rom = supportcoderiscv.build_rom_image(True, r_uint(0x80000000), g.dtb)
+    assert len(rom) % 0x1000 == 0
+    assert rom[:4] == "\x97\x02\x00\x00" # auipc t0,0x0
+    assert rom[12:16] == "\x83\xb2\x82\x01" # ld t0,24(t0)
+    assert rom[24:32] == "\x00\x00\x00\x80\x00\x00\x00\x00"
+    assert rom[32:32 + len(g.dtb)] == g.dtb
+    assert rom[32 + len(g.dtb):] == "\x00" * (len(rom) - 32 - len(g.dtb))
+    rom32 = supportcoderiscv.build_rom_image(False, r_uint(0x80000000), None)
+    assert len(rom32) == 0x1000
+    assert rom32[12:16] == "\x83\xa2\x82\x01" # lw t0,24(t0)
+
 # testing disassembly
 
 def test_dis_instructions(riscvmain):
@@ -124,6 +140,252 @@ def test_dis_instructions(riscvmain):
         res.append(outriscv.func_zassembly_forwards(m, outriscv.func_zext_decode(m, m._reg_zinstbits)))
     assert "illegal" not in "\n".join(res)
 
+def make_machine(riscvmain):
+    from riscv import supportcoderiscv
+    m = riscvmain._machinecls()
+    supportcoderiscv.init_mem(m)
+    m.g.config_print_instr = False
+    m.g.config_print_reg = False
+    m.g.config_print_mem_access = False
+    m.g.config_print_platform = False
+    return m
+
+def test_snapshot_save_load(riscvmain, tmpdir):
+    from riscv import supportcoderiscv
+    from rpython.rlib.rarithmetic import r_uint
+    elf = elfs[1]
+    m1 = make_machine(riscvmain)
+    entry = supportcoderiscv.load_sail(m1, elf)
+    m1.set_pc(supportcoderiscv.init_sail(m1, entry))
+    m1.g._init_ranges()
+    m1.run_sail(1000, False)
+    snap1 = tmpdir.join("snap1")
+    supportcoderiscv.save_snapshot(m1, str(snap1))
+
+    m2 = make_machine(riscvmain)
+    supportcoderiscv.load_symbols(m2, elf)
+    supportcoderiscv.load_snapshot(m2, str(snap1))
+    m2.g._init_ranges()
+    assert m2._reg_zPC == m1._reg_zPC
+    assert m2.g.rv_htif_tohost == m1.g.rv_htif_tohost
+    ram_base = m1.g.rv_ram_base
+    assert m2.g.mem.read_bytes(ram_base, 0x10000) == m1.g.mem.read_bytes(ram_base, 0x10000)
+    # all registers and the memory are the same
+    snap2 = tmpdir.join("snap2")
+    supportcoderiscv.save_snapshot(m2, str(snap2))
+    assert snap2.read("rb") == snap1.read("rb")
+
+    # and execution continues in the same way
+    m1.run_sail(0, False)
+    m2.run_sail(0, False)
+    assert m2.step_no == m1.step_no
+    assert m2._reg_zhtif_done
+    assert m2._reg_zhtif_exit_code == 0
+    supportcoderiscv.save_snapshot(m1, str(snap1))
+    supportcoderiscv.save_snapshot(m2, str(snap2))
+    assert snap2.read("rb") == snap1.read("rb")
+
+def test_snapshot_options(riscvmain, tmpdir):
+    snap = tmpdir.join("snap")
+    image = tmpdir.join("image")
+    image.write("\x00" * 4096, mode="wb")
+    assert riscvmain(['executable', elfs[0], "--save-snapshot", str(snap)]) == 0
+    assert snap.check()
+    assert riscvmain(['executable', elfs[0], "--load-snapshot", str(snap)]) == 0
+    # the snapshot has to be loaded into empty memory
+    assert riscvmain(['executable', elfs[0], "--load-snapshot", str(snap),
+                      "--ram-image", str(image)]) == 1
+
+def test_skip_idle_time(riscvmain):
+    from riscv import supportcoderiscv
+    from rpython.rlib.rarithmetic import r_uint
+    m = riscvmain._machinecls()
+    supportcoderiscv.init_mem(m)
+    entry = supportcoderiscv.load_sail(m, elfs[0])
+    m._reg_zPC = supportcoderiscv.init_sail(m, entry)
+    m.g.config_print_platform = False
+    m._reg_zmie.zbits = r_uint(0)
+    m._reg_zmtime = r_uint(100)
+    m._reg_zmtimecmp = r_uint(5000)
+    minstret = m._reg_zminstret
+    # the timer interrupt is disabled, waiting for it would hang forever
+    m.skip_idle_time()
+    assert m._reg_zmtime == 100
+    m._reg_zmie.zbits = supportcoderiscv.MIE_MTIE
+    mcycle = m._reg_zmcycle
+    m.skip_idle_time()
+    assert m._reg_zmtime == 5000
+    assert m._reg_zmcycle == mcycle + 4900
+    assert m._reg_zminstret == minstret
+    assert m.g.idle_ticks_skipped == 4900
+    # the timer interrupt is pending now
+    assert m._reg_zmip.zbits & supportcoderiscv.MIE_MTIE
+    m.skip_idle_time()
+    assert m._reg_zmtime == 5000
+
+def test_next_tick_deadline(riscvmain):
+    from rpython.rlib.rarithmetic import r_uint
+    m = riscvmain._machinecls()
+    m.g.max_tick_batch = 16
+    m._reg_zmtime = r_uint(100)
+    m._reg_zmtimecmp = r_uint(105)
+    assert m.next_tick_deadline() == 5 * m.g.rv_insns_per_tick
+    m._reg_zmtimecmp = r_uint(1000)
+    assert m.next_tick_deadline() == 16 * m.g.rv_insns_per_tick
+    # the timer interrupt is pending already
+    m._reg_zmtimecmp = r_uint(50)
+    m._reg_zhtif_tohost = r_uint(0)
+    assert m.next_tick_deadline() == 16 * m.g.rv_insns_per_tick
+    # the guest wrote to tohost, the platform has to handle that at the next tick
+    m._reg_zhtif_tohost = r_uint(1)
+    assert m.next_tick_deadline() == m.g.rv_insns_per_tick
+    # batching is off by default
+    assert riscvmain._machinecls().g.max_tick_batch == 1
+
+def test_shorten_tick_deadline(riscvmain):
+    m = riscvmain._machinecls()
+    ipt = m.g.rv_insns_per_tick
+    assert m.shorten_tick_deadline(3 * ipt + 5, 16 * ipt) == 4 * ipt
+    assert m.shorten_tick_deadline(3 * ipt, 16 * ipt) == 3 * ipt
+    assert m.shorten_tick_deadline(15 * ipt + 1, 16 * ipt) == 16 * ipt
+
+def test_tohost_handled_within_one_tick(riscvmain):
+    from riscv import supportcoderiscv
+    # the riscv-tests end by writing their exit code to tohost. With batched
+    # ticks, that write must still be handled within the same tick window as
+    # without batching
+    steps = []
+    for batch in [1, 16]:
+        m = make_machine(riscvmain)
+        m.g.max_tick_batch = batch
+        entry = supportcoderiscv.load_sail(m, elfs[0])
+        m.set_pc(supportcoderiscv.init_sail(m, entry))
+        m.g._init_ranges()
+        m.run_sail(0, False)
+        assert m._reg_zhtif_done
+        steps.append(m.step_no)
+    assert abs(steps[1] - steps[0]) < m.g.rv_insns_per_tick
+
+def test_max_tick_batch(riscvmain):
+    # the riscv-tests don't depend on the clock
+    riscvmain(['executable', elfs[0], "--max-tick-batch", "1"])
+    riscvmain(['executable', elfs[0], "--max-tick-batch", "1000"])
+
+def test_no_ticks(riscvmain):
+    from riscv import supportcoderiscv
+    # the clock never ticks, printing the kips must still work
+    m = make_machine(riscvmain)
+    m.g.rv_insns_per_tick = 0
+    entry = supportcoderiscv.load_sail(m, elfs[0])
+    m.set_pc(supportcoderiscv.init_sail(m, entry))
+    m.g._init_ranges()
+    assert m.next_tick_deadline() == 0
+    m.run_sail(10000, True)
+    assert riscvmain(['executable', elfs[0], "--instructions-per-tick", "0",
+                      "--print-kips", "-l", "10000"]) == 0
+
+def test_poll_console_input(riscvmain, tmpdir):
+    from riscv import supportcoderiscv
+    from pydrofoil import console
+    from rpython.rlib.rarithmetic import r_uint
+    path = tmpdir.join("input")
+    path.write("ab")
+    m = riscvmain._machinecls()
+    supportcoderiscv.init_mem(m)
+    fromhost = m.g.rv_ram_base + 0x2000
+    m.g.rv_htif_fromhost = fromhost
+    m.g.console_input = console.open_console_input(str(path))
+    # the guest didn't ask for input
+    m._reg_zhtif_tohost = supportcoderiscv.HTIF_CONSOLE_GETCHAR | (r_uint(1) << 48) | ord("x")
+    supportcoderiscv.record_console_request(m)
+    supportcoderiscv.poll_console_input(m)
+    assert m.g.mem.read(fromhost, 8) == 0
+    m._reg_zhtif_tohost = supportcoderiscv.HTIF_CONSOLE_GETCHAR
+    supportcoderiscv.record_console_request(m)
+    supportcoderiscv.poll_console_input(m)
+    assert m.g.mem.read(fromhost, 8) == supportcoderiscv.HTIF_CONSOLE_GETCHAR | ord("a")
+    # one character per request
+    m.g.mem.write(fromhost, 8, r_uint(0))
+    supportcoderiscv.poll_console_input(m)
+    assert m.g.mem.read(fromhost, 8) == 0
+
+class HtifGuest(object):
+    """ Does what the HTIF console code of riscv-pk (and similarly OpenSBI)
+    does, advancing the clock of machine while it waits. """
+
+    def __init__(self, machine):
+        self.machine = machine
+        self.console_buf = 0
+
+    def check_fromhost(self):
+        from rpython.rlib.rarithmetic import r_uint
+        mem = self.machine.g.mem
+        fh = mem.read(self.machine.g.rv_htif_fromhost, 8)
+        if not fh:
+            return
+        mem.write(self.machine.g.rv_htif_fromhost, 8, r_uint(0))
+        assert fh >> 56 == 1
+        if (fh >> 48) & 0xff == 0:
+            self.console_buf = 1 + int(fh & 0xff)
+
+    def set_tohost(self, dev, cmd, data):
+        from rpython.rlib.rarithmetic import r_uint
+        m = self.machine
+        for i in range(100):
+            if not m._reg_zhtif_tohost:
+                break
+            self.check_fromhost()
+            m.advance_clock(r_uint(1))
+        else:
+            assert 0, "tohost is never acknowledged"
+        m._reg_zhtif_tohost = (r_uint(dev) << 56) | (r_uint(cmd) << 48) | r_uint(data)
+
+    def putchar(self, c):
+        self.set_tohost(1, 1, ord(c))
+
+    def getchar(self):
+        self.check_fromhost()
+        ch = self.console_buf
+        if ch >= 0:
+            self.console_buf = -1
+            self.set_tohost(1, 0, 0)
+        return ch - 1
+
+def test_console_input_while_printing(riscvmain, tmpdir):
+    from riscv import supportcoderiscv
+    from pydrofoil import console
+    path = tmpdir.join("input")
+    path.write("ls -l\n")
+    m = make_machine(riscvmain)
+    entry = supportcoderiscv.load_sail(m, elfs[0])
+    m.set_pc(supportcoderiscv.init_sail(m, entry))
+    assert m.g.rv_htif_fromhost
+    m.g.console = console.open_console_output(str(tmpdir.join("output")))
+    m.g.console_input = console.open_console_input(str(path))
+    guest = HtifGuest(m)
+    typed = []
+    for i in range(1000):
+        ch = guest.getchar()
+        if ch >= 0:
+            typed.append(chr(ch))
+            if ch == ord("\n"):
+                break
+        # input that arrives while the guest waits for its output to be
+        # handled must not be lost
+        for c in "> ":
+            guest.putchar(c)
+    assert "".join(typed) == "ls -l\n"
+
+def test_console_output_written_on_error(riscvmain, tmpdir, monkeypatch):
+    path = tmpdir.join("output")
+    def run_sail(self, insn_limit, do_show_times):
+        self.g.console.write_char("x")
+        raise ValueError
+    monkeypatch.setattr(riscvmain._machinecls, "run_sail", run_sail)
+    with pytest.raises(ValueError):
+        riscvmain(['executable', elfs[0], "--console-output", str(path)])
+    assert path.read() == "x"
+
 def test_enable_options_smoke_test(riscvmain):
     elf = elfs[0]
     riscvmain(['executable', elf, "--enable-dirty-update", "--enable-misaligned", "--mtval-has-illegal-inst-bits", "--ram-size", 128])